@@ -1,23 +1,51 @@
 # app.py
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, send_file, Response, stream_with_context, copy_current_request_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 from PIL import Image
 from io import BytesIO
-import os, uuid as py_uuid, hashlib, psycopg2, base64, random, string
+import os, uuid as py_uuid, hashlib, psycopg2, base64, random, string, socket
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.extras
+from contextlib import contextmanager
 from instagrapi import Client
 from apscheduler.schedulers.background import BackgroundScheduler
 import threading
 import time
+import heapq
+import select
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, TimeoutError as FutureTimeout
 import logging
 from cryptography.fernet import Fernet
 import json
+import hmac
 import requests
-from collections import defaultdict
-from datetime import datetime, timedelta
+from collections import defaultdict, OrderedDict, deque
+from array import array
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
 import razorpay
+import re
+import mimetypes
+import sqlite3
+import csv
+import io
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # only needed for IMAGE_STORE=s3
+    boto3 = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for Parquet exports
+    pa = pq = None
+import numpy as np
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 until_date = datetime.now()
 since_date = until_date - timedelta(days=30)
@@ -86,7 +114,6 @@ client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 BASE_IMAGE_DIR = "static/images"
 BASE_CAPTION_DIR = "static/captions"
 os.makedirs(BASE_IMAGE_DIR, exist_ok=True)
-os.makedirs(BASE_CAPTION_DIR, exist_ok=True)
 
 DB_CONFIG = {
     'host': os.getenv("POSTGRES_HOST"),
@@ -95,15 +122,234 @@ DB_CONFIG = {
     'dbname': os.getenv("POSTGRES_DB")
 }
 
+# Default Graph account (see graph_token). Only shown to users who haven't connected
+# their own when GRAPH_DEFAULT_ACCOUNT_FOR_ALL=1, e.g. a single-tenant deployment.
 ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
 IG_BUSINESS_ID = os.getenv("IG_USER_ID")
+GRAPH_DEFAULT_ACCOUNT_FOR_ALL = os.getenv("GRAPH_DEFAULT_ACCOUNT_FOR_ALL") == "1"
 
 # --------------------------------------------------
 # DB utils
 # --------------------------------------------------
 
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))
+
+class PooledConnection:
+    """
+    Thin proxy around a pooled psycopg2 connection.
+    close() hands the connection back to the pool instead of closing the socket,
+    so existing `conn.close()` call sites keep working unchanged.
+    """
+    def __init__(self, pool, conn, created_at):
+        self._pool = pool
+        self._conn = conn
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to pool")
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool._release(conn, self._created_at)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def __del__(self):
+        # Safety net for code paths that forget to close()
+        try:
+            self.close()
+        except Exception:
+            pass
+
+class PostgresConnectionPool:
+    """
+    Bounded, thread-safe psycopg2 connection pool.
+    - connections are opened lazily up to `maxconn`
+    - idle connections are health-checked (SELECT 1) before reuse
+    - connections older than `max_lifetime` seconds are recycled
+    """
+    def __init__(self, config, maxconn=10, timeout=10.0, max_lifetime=1800.0, health_check_idle=30.0):
+        self._config = config
+        self._maxconn = maxconn
+        self._timeout = timeout
+        self._max_lifetime = max_lifetime
+        self._health_check_idle = health_check_idle
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, created_at, last_used)]
+        self._size = 0   # open connections, idle + checked out
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total_ms": 0.0,
+            "wait_time_max_ms": 0.0,
+            "exhausted": 0,
+            "timeouts": 0,
+            "connections_opened": 0,
+            "connections_recycled": 0,
+            "health_check_failures": 0,
+        }
+
+    def _expired(self, created_at, now):
+        return self._max_lifetime and now - created_at > self._max_lifetime
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _healthy(self, conn, last_used, now):
+        if conn.closed:
+            return False
+        if now - last_used < self._health_check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"DB pool health check failed: {e}")
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self._timeout
+        waited = False
+        while True:
+            entry = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self._maxconn:
+                        self._size += 1
+                        break
+                    if not waited:
+                        waited = True
+                        self._stats["exhausted"] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise psycopg2.pool.PoolError(
+                            f"DB pool exhausted: no connection available within {self._timeout}s"
+                        )
+                    self._cond.wait(remaining)
+
+            now = time.monotonic()
+            if entry is None:
+                try:
+                    conn = psycopg2.connect(**self._config)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                created_at = now
+                with self._cond:
+                    self._stats["connections_opened"] += 1
+            else:
+                conn, created_at, last_used = entry
+                if self._expired(created_at, now):
+                    with self._cond:
+                        self._stats["connections_recycled"] += 1
+                    self._discard(conn)
+                    continue
+                if not self._healthy(conn, last_used, now):
+                    with self._cond:
+                        self._stats["health_check_failures"] += 1
+                    self._discard(conn)
+                    continue
+
+            wait_ms = (time.monotonic() - start) * 1000
+            with self._cond:
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                    self._stats["wait_time_total_ms"] += wait_ms
+                    self._stats["wait_time_max_ms"] = max(self._stats["wait_time_max_ms"], wait_ms)
+            return PooledConnection(self, conn, created_at)
+
+    def _release(self, conn, created_at):
+        now = time.monotonic()
+        if conn.closed:
+            self._discard(conn)
+            return
+        if self._expired(created_at, now):
+            with self._cond:
+                self._stats["connections_recycled"] += 1
+            self._discard(conn)
+            return
+        try:
+            # Never hand out a connection with a half-finished transaction
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, created_at, now))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            stats["max_size"] = self._maxconn
+        stats["wait_time_avg_ms"] = (stats["wait_time_total_ms"] / stats["waits"]) if stats["waits"] else 0.0
+        return stats
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+db_pool = PostgresConnectionPool(
+    DB_CONFIG,
+    maxconn=DB_POOL_MAX,
+    timeout=DB_POOL_TIMEOUT,
+    max_lifetime=DB_POOL_MAX_LIFETIME,
+    health_check_idle=DB_POOL_HEALTHCHECK_IDLE,
+)
+
 def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    """Check out a pooled connection; conn.close() returns it to the pool"""
+    return db_pool.getconn()
+
+def db_connection():
+    """Context manager: `with db_connection() as conn:`"""
+    return db_pool.connection()
 
 def hash_password(password, salt=None):
     salt = salt or str(py_uuid.uuid4())
@@ -124,24 +370,500 @@ def get_user_image_dir(user_id):
     os.makedirs(user_dir, exist_ok=True)
     return user_dir
 
-def get_user_caption_dir(user_id):
-    """Get user-specific caption directory"""
-    user_dir = os.path.join(BASE_CAPTION_DIR, str(user_id))
-    os.makedirs(user_dir, exist_ok=True)
-    return user_dir
+# --------------------------------------------------
+# Blob store (content-addressed image storage)
+# --------------------------------------------------
+IMAGE_STORE = os.getenv("IMAGE_STORE", "local")  # local | s3
+BLOB_ROOT = os.getenv("BLOB_ROOT", "static/blobs")
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", "static/blob_cache")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. a MinIO server; unset for AWS
+S3_PREFIX = os.getenv("S3_PREFIX", "images/")
+
+# New images are named <sha256>.<ext>; anything else is a legacy per-user file
+BLOB_FILENAME_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+
+def _blob_shard(key):
+    """ab/cd/<key>: two levels of 256-way fan-out keeps directories small"""
+    return key[:2], key[2:4], key
+
+class LocalBlobStore:
+    """Blobs on the local filesystem, written with write-then-rename"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path_for(self, key):
+        return os.path.join(self.root, *_blob_shard(key))
+
+    def local_dir(self, key):
+        return os.path.dirname(self.path_for(key))
+
+    def exists(self, key):
+        return os.path.exists(self.path_for(key))
+
+    def put(self, key, data):
+        """Store data under key; returns False when identical bytes were already stored"""
+        path = self.path_for(key)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{py_uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return True
+
+    def local_path(self, key):
+        path = self.path_for(key)
+        return path if os.path.exists(path) else None
+
+class S3BlobStore:
+    """
+    Blobs in an S3-compatible bucket (AWS, MinIO, ...). Reads go through a
+    local disk cache, since PIL, send_file and instagrapi all want a path.
+    """
 
-def verify_user_owns_file(user_id, filename):
-    """Verify that a file belongs to the user"""
-    conn = get_db_connection()
+    def __init__(self, bucket, endpoint_url=None, prefix="", cache_dir=BLOB_CACHE_DIR):
+        if boto3 is None:
+            raise RuntimeError("IMAGE_STORE=s3 requires boto3")
+        if not bucket:
+            raise RuntimeError("IMAGE_STORE=s3 requires S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix
+        self._s3 = boto3.client("s3", endpoint_url=endpoint_url)
+        self._cache = LocalBlobStore(cache_dir)
+
+    def _object_key(self, key):
+        return self.prefix + "/".join(_blob_shard(key))
+
+    def local_dir(self, key):
+        return self._cache.local_dir(key)
+
+    def exists(self, key):
+        try:
+            self._s3.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def put(self, key, data):
+        stored = not self.exists(key)
+        if stored:
+            self._s3.put_object(
+                Bucket=self.bucket, Key=self._object_key(key), Body=data,
+                ContentType=mimetypes.guess_type(key)[0] or "application/octet-stream",
+            )
+        self._cache.put(key, data)
+        return stored
+
+    def local_path(self, key):
+        path = self._cache.local_path(key)
+        if path:
+            return path
+        path = self._cache.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{py_uuid.uuid4().hex}.tmp"
+        try:
+            self._s3.download_file(self.bucket, self._object_key(key), tmp_path)
+        except ClientError as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        os.replace(tmp_path, path)
+        return path
+
+if IMAGE_STORE == "s3":
+    blob_store = S3BlobStore(S3_BUCKET, S3_ENDPOINT_URL, S3_PREFIX)
+else:
+    blob_store = LocalBlobStore(BLOB_ROOT)
+
+def store_image(data, ext=".png"):
+    """Save image bytes under their content hash and return the filename"""
+    filename = hashlib.sha256(data).hexdigest() + ext
+    if not blob_store.put(filename, data):
+        logger.info(f"Deduplicated image {filename}")
+    return filename
+
+def image_dir_for(user_id, filename):
+    """Local directory holding an image and its derived files"""
+    if BLOB_FILENAME_RE.match(filename):
+        return blob_store.local_dir(filename)
+    return get_user_image_dir(user_id)
+
+def resolve_image_path(user_id, filename):
+    """Local path of a user's image, or None if it doesn't exist"""
+    if BLOB_FILENAME_RE.match(filename):
+        return blob_store.local_path(filename)
+    path = os.path.join(get_user_image_dir(user_id), filename)
+    return path if os.path.exists(path) else None
+
+# --------------------------------------------------
+# Image variants (precomputed after generation)
+# --------------------------------------------------
+IG_IMAGE_WIDTH = 1080
+IG_MIN_ASPECT = 4 / 5   # tallest portrait Instagram accepts
+IG_MAX_ASPECT = 1.91    # widest landscape Instagram accepts
+IG_JPEG_QUALITY = 90
+THUMB_SIZE = 320
+THUMB_WEBP_QUALITY = 75
+
+# variant -> (filename suffix, content type)
+IMAGE_VARIANTS = {
+    "ig": ("_ig.jpg", "image/jpeg"),
+    "thumb": ("_thumb.webp", "image/webp"),
+    "png": ("_opt.png", "image/png"),
+}
+
+image_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-variants")
+
+def variant_filename(filename, variant):
+    base_name, _ = os.path.splitext(filename)
+    return base_name + IMAGE_VARIANTS[variant][0]
+
+def _save_atomic(img, path, fmt, **options):
+    # Unique tmp name: concurrent workers rendering the same variant mustn't share a file
+    tmp_path = f"{path}.{py_uuid.uuid4().hex}.tmp"
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT 1 FROM activities 
-            WHERE user_id=%s AND image_filename=%s
-            """, (user_id, filename))
-        return bool(cur.fetchone())
-    finally:
-        conn.close()
+        img.save(tmp_path, fmt, **options)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _ig_crop_box(width, height):
+    """Center-crop box that brings the image inside Instagram's aspect range"""
+    aspect = width / height
+    if aspect < IG_MIN_ASPECT:
+        new_height = round(width / IG_MIN_ASPECT)
+        top = (height - new_height) // 2
+        return (0, top, width, top + new_height)
+    if aspect > IG_MAX_ASPECT:
+        new_width = round(height * IG_MAX_ASPECT)
+        left = (width - new_width) // 2
+        return (left, 0, left + new_width, height)
+    return (0, 0, width, height)
+
+def build_image_variants(user_id, filename):
+    """
+    Write the Instagram JPEG (1080px wide, IG aspect range), a WebP
+    thumbnail and an optimized PNG next to the original image.
+    """
+    source = resolve_image_path(user_id, filename)
+    if not source:
+        raise FileNotFoundError(filename)
+    image_dir = os.path.dirname(source)
+    with Image.open(source) as img:
+        img.load()
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            rgb = Image.new("RGB", rgba.size, (255, 255, 255))
+            rgb.paste(rgba, mask=rgba.getchannel("A"))
+        else:
+            rgb = img.convert("RGB")
+
+        ig = rgb.crop(_ig_crop_box(*rgb.size))
+        ig = ig.resize((IG_IMAGE_WIDTH, round(IG_IMAGE_WIDTH * ig.height / ig.width)), Image.LANCZOS)
+        _save_atomic(ig, os.path.join(image_dir, variant_filename(filename, "ig")), "JPEG",
+                     quality=IG_JPEG_QUALITY, optimize=True, progressive=True)
+
+        thumb = rgb.copy()
+        thumb.thumbnail((THUMB_SIZE, THUMB_SIZE), Image.LANCZOS)
+        _save_atomic(thumb, os.path.join(image_dir, variant_filename(filename, "thumb")), "WEBP",
+                     quality=THUMB_WEBP_QUALITY, method=6)
+
+        _save_atomic(img, os.path.join(image_dir, variant_filename(filename, "png")), "PNG", optimize=True)
+
+def schedule_image_variants(user_id, filename):
+    """Build variants in the background, off the request path"""
+    def run():
+        try:
+            build_image_variants(user_id, filename)
+        except Exception as e:
+            logger.error(f"Image variants failed for {user_id}/{filename}: {e}")
+    image_executor.submit(run)
+
+def variant_path(user_id, filename, variant):
+    """Path of a precomputed variant, or None if it hasn't been built"""
+    path = os.path.join(image_dir_for(user_id, filename), variant_filename(filename, variant))
+    return path if os.path.exists(path) else None
+
+def publish_image_path(user_id, filename):
+    """
+    Instagram-ready JPEG for uploads. Images generated before variants
+    existed get theirs built once here; falls back to the original.
+    """
+    path = variant_path(user_id, filename, "ig")
+    if path:
+        return path
+    try:
+        build_image_variants(user_id, filename)
+        return variant_path(user_id, filename, "ig") or resolve_image_path(user_id, filename)
+    except Exception as e:
+        logger.warning(f"Could not build IG variant for {user_id}/{filename}: {e}")
+        return resolve_image_path(user_id, filename)
+
+# --------------------------------------------------
+# Media serving (lazy thumbnails + HTTP caching)
+# --------------------------------------------------
+THUMB_SIZES = (160, 320, 640, 1080)
+THUMB_DIR = "thumbs"
+MEDIA_MAX_AGE = 365 * 24 * 3600  # filenames are never reused, so responses can be cached for good
+MEDIA_FALLBACK_MAX_AGE = 60      # a stand-in served until the requested variant exists
+ETAG_CACHE_SIZE = 4096
+
+_etag_cache = OrderedDict()  # path -> (mtime_ns, size, etag)
+_etag_lock = threading.Lock()
+_thumb_locks = [threading.Lock() for _ in range(32)]
+
+def file_etag(path):
+    """Content hash of a file, memoised until its mtime or size changes"""
+    base_name = os.path.basename(path)
+    if BLOB_FILENAME_RE.match(base_name):
+        return base_name.split(".", 1)[0]  # blobs are named by their hash already
+    st = os.stat(path)
+    with _etag_lock:
+        hit = _etag_cache.get(path)
+        if hit and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+            _etag_cache.move_to_end(path)
+            return hit[2]
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    etag = digest.hexdigest()
+
+    with _etag_lock:
+        _etag_cache[path] = (st.st_mtime_ns, st.st_size, etag)
+        _etag_cache.move_to_end(path)
+        while len(_etag_cache) > ETAG_CACHE_SIZE:
+            _etag_cache.popitem(last=False)
+    return etag
+
+def thumbnail_size_for(requested):
+    """Snap a requested edge length up to the nearest cached size"""
+    for size in THUMB_SIZES:
+        if requested <= size:
+            return size
+    return THUMB_SIZES[-1]
+
+def thumbnail_path(user_id, filename, size):
+    """
+    WebP thumbnail at most `size` px on its longest edge, generated on
+    first request and kept on disk until the source image changes.
+    None if the source image doesn't exist.
+    """
+    source = resolve_image_path(user_id, filename)
+    if not source:
+        return None
+    base_name, _ = os.path.splitext(filename)
+    path = os.path.join(os.path.dirname(source), THUMB_DIR, f"{base_name}_{size}.webp")
+
+    def fresh():
+        return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+
+    if fresh():
+        return path
+    with _thumb_locks[hash(path) % len(_thumb_locks)]:
+        if fresh():
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with Image.open(source) as img:
+            img.load()
+            thumb = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+            thumb.thumbnail((size, size), Image.LANCZOS)
+            _save_atomic(thumb, path, "WEBP", quality=THUMB_WEBP_QUALITY, method=6)
+    return path
+
+def send_media(path, mimetype, fallback=False):
+    """
+    Stream a file with a content-hash ETag. send_file answers
+    If-None-Match with 304 and handles Range requests itself.
+    fallback=True marks a stand-in for content that doesn't exist yet:
+    cached briefly and revalidated, never immutable.
+    """
+    rv = send_file(path, mimetype=mimetype, conditional=True,
+                   etag=file_etag(path), max_age=MEDIA_FALLBACK_MAX_AGE if fallback else MEDIA_MAX_AGE)
+    # Images sit behind the session cookie: browsers may cache, shared caches may not
+    rv.cache_control.public = False
+    rv.cache_control.private = True
+    rv.cache_control.immutable = not fallback
+    return rv
+
+# --------------------------------------------------
+# Generated image payloads (URL + placeholder instead of base64)
+# --------------------------------------------------
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_CACHE_SIZE = 1024
+
+_placeholders = OrderedDict()  # (user_id, filename) -> data URI
+_placeholder_lock = threading.Lock()
+
+def make_placeholder(img):
+    """~200 byte blurred WebP data URI the client can show while the real image loads"""
+    scale = PLACEHOLDER_SIZE / max(img.size)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    tiny = img.resize(size, Image.BILINEAR, reducing_gap=2.0).convert("RGB")
+    buf = BytesIO()
+    tiny.save(buf, "WEBP", quality=40)
+    return "data:image/webp;base64," + base64.b64encode(buf.getvalue()).decode()
+
+def remember_placeholder(user_id, filename, placeholder):
+    with _placeholder_lock:
+        _placeholders[(user_id, filename)] = placeholder
+        _placeholders.move_to_end((user_id, filename))
+        while len(_placeholders) > PLACEHOLDER_CACHE_SIZE:
+            _placeholders.popitem(last=False)
+
+def image_placeholder(user_id, filename):
+    with _placeholder_lock:
+        placeholder = _placeholders.get((user_id, filename))
+    if placeholder:
+        return placeholder
+    # Decode the small thumbnail when it exists rather than the full PNG
+    path = variant_path(user_id, filename, "thumb") or resolve_image_path(user_id, filename)
+    with Image.open(path) as img:
+        placeholder = make_placeholder(img)
+    remember_placeholder(user_id, filename, placeholder)
+    return placeholder
+
+def wants_inline_image(data=None):
+    """Legacy clients opt back into the base64 image with inline_image=1"""
+    return bool((data or {}).get("inline_image")) or request.args.get("inline_image") in ("1", "true")
+
+def image_payload(user_id, filename, inline=False):
+    """
+    Response fields for a generated image. URLs carry the content hash,
+    so get-image's immutable cache headers stay correct.
+    """
+    path = resolve_image_path(user_id, filename)
+    url = f"/api/get-image?filename={quote(filename)}&v={file_etag(path)}"
+    payload = {
+        "image_url": url,
+        "thumbnail_url": f"{url}&size={THUMB_SIZE}",
+        "placeholder": image_placeholder(user_id, filename),
+    }
+    if inline:
+        with open(path, "rb") as f:
+            payload["image"] = base64.b64encode(f.read()).decode()
+    return payload
+
+# --------------------------------------------------
+# File ownership cache
+# --------------------------------------------------
+OWNERSHIP_CACHE_SIZE = int(os.getenv("OWNERSHIP_CACHE_SIZE", "100000"))
+OWNERSHIP_SHARED_CACHE = os.getenv("OWNERSHIP_SHARED_CACHE")  # sqlite path shared by workers on one host
+
+class OwnershipCache:
+    """
+    (user_id, filename) pairs known to be owned. Only positive answers are
+    cached: an activity row is never re-assigned, so a cached "owned" stays
+    true until the row is deleted and invalidate() is called.
+    - bounded in-process LRU
+    - optional sqlite file shared by the workers on one host
+    """
+    def __init__(self, max_entries=OWNERSHIP_CACHE_SIZE, shared_path=OWNERSHIP_SHARED_CACHE):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._owned = OrderedDict()
+        self._stats = {"hits": 0, "shared_hits": 0, "misses": 0, "fills": 0, "invalidations": 0}
+        self._shared = None
+        if shared_path:
+            self._shared = sqlite3.connect(shared_path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._shared.execute("PRAGMA journal_mode=WAL")
+            self._shared.execute(
+                "CREATE TABLE IF NOT EXISTS owned (user_id INTEGER, filename TEXT, PRIMARY KEY (user_id, filename))"
+            )
+
+    def _remember(self, key):
+        self._owned[key] = True
+        self._owned.move_to_end(key)
+        while len(self._owned) > self._max_entries:
+            self._owned.popitem(last=False)
+
+    def owns(self, user_id, filename):
+        """True if known to be owned, None if the database has to be asked"""
+        key = (user_id, filename)
+        with self._lock:
+            if key in self._owned:
+                self._owned.move_to_end(key)
+                self._stats["hits"] += 1
+                return True
+            if self._shared is not None:
+                row = self._shared.execute(
+                    "SELECT 1 FROM owned WHERE user_id=? AND filename=?", key
+                ).fetchone()
+                if row:
+                    self._remember(key)
+                    self._stats["shared_hits"] += 1
+                    return True
+            self._stats["misses"] += 1
+            return None
+
+    def add_many(self, user_id, filenames):
+        keys = [(user_id, f) for f in filenames if f]
+        if not keys:
+            return
+        with self._lock:
+            fresh = [key for key in keys if key not in self._owned]
+            for key in keys:
+                self._remember(key)
+            if fresh and self._shared is not None:
+                self._shared.executemany("INSERT OR IGNORE INTO owned VALUES (?, ?)", fresh)
+            self._stats["fills"] += len(fresh)
+
+    def invalidate(self, user_id, filename=None):
+        """Forget one file, or every file of the user"""
+        with self._lock:
+            if filename is None:
+                for key in [k for k in self._owned if k[0] == user_id]:
+                    del self._owned[key]
+                if self._shared is not None:
+                    self._shared.execute("DELETE FROM owned WHERE user_id=?", (user_id,))
+            else:
+                self._owned.pop((user_id, filename), None)
+                if self._shared is not None:
+                    self._shared.execute("DELETE FROM owned WHERE user_id=? AND filename=?", (user_id, filename))
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["shared_hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "entries": len(self._owned),
+                "shared": self._shared is not None,
+                "hit_rate": round((self._stats["hits"] + self._stats["shared_hits"]) / lookups, 4) if lookups else None,
+            }
+
+ownership_cache = OwnershipCache()
+
+OWNS_FILE_SQL = "SELECT 1 FROM activities WHERE user_id=%s AND image_filename=%s LIMIT 1"
+
+def verify_user_owns_file(user_id, filename, cur=None):
+    """Verify that a file belongs to the user (cache first, then the caller's cursor or a pooled one)"""
+    if ownership_cache.owns(user_id, filename):
+        return True
+    if cur is None:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                return verify_user_owns_file(user_id, filename, cur)
+            finally:
+                cur.close()
+    cur.execute(OWNS_FILE_SQL, (user_id, filename))
+    owned = bool(cur.fetchone())
+    if owned:
+        ownership_cache.add_many(user_id, [filename])
+    return owned
 
 # --------------------------------------------------
 # Scheduler
@@ -153,89 +875,431 @@ scheduler.start()
 # App bootstrap
 # --------------------------------------------------
 #@app.before_serving
+# --------------------------------------------------
+# Schema migrations
+# --------------------------------------------------
+# (version, name, statements). Append new versions; never edit applied ones.
+# Early versions use IF NOT EXISTS so databases created by the old ad-hoc
+# init_db() adopt the version table without changes.
+MIGRATIONS = [
+    (1, "baseline tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(100) UNIQUE NOT NULL,
+            password_hash VARCHAR(128) NOT NULL,
+            salt VARCHAR(64) NOT NULL,
+            points_used INTEGER DEFAULT 0,
+            total_points INTEGER DEFAULT 15,
+            is_premium BOOLEAN DEFAULT FALSE,
+            referral_code VARCHAR(10) UNIQUE,
+            referred_by INTEGER REFERENCES users(id),
+            referrals_count INTEGER DEFAULT 0,
+            insta_username VARCHAR(100),
+            insta_password TEXT,
+            ig_device_id TEXT,
+            ig_guid TEXT,
+            ig_challenge_context TEXT,
+            ig_session_settings TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS logins (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            login_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS activities (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            prompt TEXT NOT NULL,
+            image_filename VARCHAR(255),
+            generated_caption TEXT,
+            modified_caption TEXT,
+            caption_filename VARCHAR(255),
+            points_used INTEGER DEFAULT 0,
+            was_downloaded BOOLEAN DEFAULT FALSE,
+            was_posted BOOLEAN DEFAULT FALSE,
+            download_time TIMESTAMP,
+            post_time TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        ALTER TABLE activities ADD COLUMN IF NOT EXISTS caption_filename VARCHAR(255)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS referrals (
+            id SERIAL PRIMARY KEY,
+            referrer_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            referee_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE UNIQUE,
+            points_awarded INTEGER NOT NULL DEFAULT 5,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS scheduled_posts (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            caption TEXT NOT NULL,
+            image_filename VARCHAR(255),
+            scheduled_time TIMESTAMP NOT NULL,
+            platform VARCHAR(20) NOT NULL DEFAULT 'instagram',
+            status VARCHAR(20) DEFAULT 'scheduled',
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        );
+        """,
+    ]),
+    (2, "scheduled post leases", [
+        """
+        ALTER TABLE scheduled_posts
+            ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(100),
+            ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS claim_attempts INTEGER DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS publish_duration_ms INTEGER,
+            ADD COLUMN IF NOT EXISTS publish_latency_ms INTEGER
+        """,
+    ]),
+    (3, "generation jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS generation_jobs (
+            id VARCHAR(36) PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            prompt TEXT NOT NULL,
+            tone VARCHAR(100),
+            content_type VARCHAR(100),
+            status VARCHAR(20) DEFAULT 'queued',
+            points_reserved INTEGER DEFAULT 0,
+            caption TEXT,
+            image_filename VARCHAR(255),
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            completed_at TIMESTAMP
+        );
+        """,
+    ]),
+    (4, "instagram media store", [
+        """
+        CREATE TABLE IF NOT EXISTS ig_media (
+            id VARCHAR(64) PRIMARY KEY,
+            account_id VARCHAR(64) NOT NULL,
+            caption TEXT,
+            media_type VARCHAR(32),
+            media_url TEXT,
+            posted_at TIMESTAMPTZ,
+            like_count INTEGER DEFAULT 0,
+            comments_count INTEGER DEFAULT 0,
+            metrics_updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_ig_media_account_posted ON ig_media (account_id, posted_at DESC)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ig_media_sync (
+            account_id VARCHAR(64) PRIMARY KEY,
+            last_seen_timestamp TIMESTAMPTZ,
+            full_sync_completed_at TIMESTAMP,
+            last_sync_at TIMESTAMP
+        );
+        """,
+    ]),
+    (5, "caption revisions", [
+        """
+        ALTER TABLE activities ADD COLUMN IF NOT EXISTS caption_revision INTEGER DEFAULT 1
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS caption_revisions (
+            id BIGSERIAL PRIMARY KEY,
+            activity_id INTEGER NOT NULL REFERENCES activities(id) ON DELETE CASCADE,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            revision INTEGER NOT NULL,
+            caption TEXT NOT NULL,
+            source VARCHAR(20) NOT NULL DEFAULT 'edit',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (activity_id, revision)
+        );
+        """,
+    ]),
+    # Partial indexes on status keep only the rows the scheduler scans
+    (6, "hot query indexes", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_activities_user_image ON activities (user_id, image_filename)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_activities_user_created ON activities (user_id, created_at DESC)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_scheduled_posts_due ON scheduled_posts (scheduled_time)
+        WHERE status='scheduled'
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_scheduled_posts_leases ON scheduled_posts (lease_expires_at)
+        WHERE status='processing'
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_scheduled_posts_user_time ON scheduled_posts (user_id, scheduled_time)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_generation_jobs_pending ON generation_jobs (created_at)
+        WHERE status IN ('queued', 'running')
+        """,
+    ]),
+    # Keyset pagination on (created_at, id) and full-text search for /api/history
+    (7, "history pagination and search", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_activities_user_created_id ON activities (user_id, created_at DESC, id DESC)
+        """,
+        """
+        DROP INDEX IF EXISTS idx_activities_user_created
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_activities_search ON activities USING GIN (
+            to_tsvector('simple', COALESCE(prompt, '') || ' ' || COALESCE(modified_caption, generated_caption, ''))
+        )
+        """,
+    ]),
+    (8, "export jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id VARCHAR(36) PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            dataset VARCHAR(20) NOT NULL,
+            format VARCHAR(20) NOT NULL,
+            since TIMESTAMPTZ,
+            until TIMESTAMPTZ,
+            status VARCHAR(20) DEFAULT 'queued',
+            row_count INTEGER,
+            byte_size BIGINT,
+            artifact VARCHAR(255),
+            error_message TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_export_jobs_user_created ON export_jobs (user_id, created_at DESC)
+        """,
+    ]),
+    # Raw snapshots partitioned by month (partitions are created by the collector)
+    (9, "metrics time series", [
+        """
+        CREATE TABLE IF NOT EXISTS metric_points (
+            account_id VARCHAR(64) NOT NULL,
+            metric VARCHAR(64) NOT NULL,
+            subject VARCHAR(64) NOT NULL DEFAULT '',
+            ts TIMESTAMPTZ NOT NULL,
+            value BIGINT NOT NULL,
+            PRIMARY KEY (account_id, metric, subject, ts)
+        ) PARTITION BY RANGE (ts);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_metric_points_account_ts ON metric_points (account_id, ts)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS metric_rollups (
+            account_id VARCHAR(64) NOT NULL,
+            metric VARCHAR(64) NOT NULL,
+            subject VARCHAR(64) NOT NULL DEFAULT '',
+            resolution VARCHAR(8) NOT NULL,
+            bucket TIMESTAMPTZ NOT NULL,
+            value_last BIGINT,
+            value_min BIGINT,
+            value_max BIGINT,
+            value_sum BIGINT,
+            samples INTEGER,
+            PRIMARY KEY (account_id, metric, resolution, subject, bucket)
+        );
+        """,
+    ]),
+    # Fired alerts (dedup_key makes re-evaluation idempotent) and per-rule running state
+    (10, "alert engine", [
+        """
+        CREATE TABLE IF NOT EXISTS alerts (
+            id BIGSERIAL PRIMARY KEY,
+            account_id VARCHAR(64) NOT NULL,
+            rule VARCHAR(32) NOT NULL,
+            subject TEXT NOT NULL DEFAULT '',
+            dedup_key TEXT NOT NULL UNIQUE,
+            metric VARCHAR(64),
+            change DOUBLE PRECISION,
+            message TEXT NOT NULL,
+            priority VARCHAR(10) NOT NULL DEFAULT 'low',
+            fired_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_alerts_account_id ON alerts (account_id, id DESC)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS alert_state (
+            account_id VARCHAR(64) NOT NULL,
+            rule VARCHAR(32) NOT NULL,
+            subject TEXT NOT NULL DEFAULT '',
+            state JSONB NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (account_id, rule, subject)
+        );
+        """,
+    ]),
+    # Per-user Graph credentials (token Fernet-encrypted like insta_password) and the account sync schedule
+    (11, "per-user graph credentials", [
+        """
+        ALTER TABLE users
+            ADD COLUMN IF NOT EXISTS graph_account_id VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS graph_access_token TEXT,
+            ADD COLUMN IF NOT EXISTS graph_token_expires_at TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS graph_updated_at TIMESTAMP
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_graph_account ON users (graph_account_id)
+        WHERE graph_access_token IS NOT NULL
+        """,
+        """
+        ALTER TABLE export_jobs ADD COLUMN IF NOT EXISTS account_id VARCHAR(64)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS graph_sync_schedule (
+            account_id VARCHAR(64) PRIMARY KEY,
+            next_sync_at TIMESTAMPTZ NOT NULL,
+            lease_owner VARCHAR(100),
+            lease_expires_at TIMESTAMPTZ,
+            failures INTEGER DEFAULT 0,
+            last_synced_at TIMESTAMPTZ,
+            last_error TEXT
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_graph_sync_due ON graph_sync_schedule (next_sync_at)
+        """,
+    ]),
+    # Generation jobs are stamped with the instance running them, which heartbeats them while alive
+    (12, "generation job owners", [
+        """
+        ALTER TABLE generation_jobs
+            ADD COLUMN IF NOT EXISTS owner VARCHAR(100),
+            ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP
+        """,
+    ]),
+]
+
+def migrate(conn):
+    """
+    Apply pending migrations in order, one transaction each. An advisory
+    lock keeps concurrently starting instances from racing. Returns the
+    versions applied.
+    """
+    cur = conn.cursor()
+    applied = []
+    try:
+        cur.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(200) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in cur.fetchall()}
+        conn.commit()
+
+        for version, name, statements in MIGRATIONS:
+            if version in done:
+                continue
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+            logger.info(f"Applied migration {version}: {name}")
+            applied.append(version)
+        return applied
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+        conn.commit()
+        cur.close()
+
+# Must match the idx_activities_search expression exactly
+HISTORY_SEARCH_SQL = (
+    "to_tsvector('simple', COALESCE(prompt, '') || ' ' || COALESCE(modified_caption, generated_caption, ''))"
+)
+
+def _plan_indexes(plan):
+    found = set()
+    if isinstance(plan, dict):
+        if "Index Name" in plan:
+            found.add(plan["Index Name"])
+        for value in plan.values():
+            found |= _plan_indexes(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            found |= _plan_indexes(value)
+    return found
+
+def explain_audit(conn):
+    """
+    EXPLAIN every hot query (HOT_QUERIES, at the end of the module) and
+    report the ones whose index is no longer usable. Sequential scans are
+    disabled for the check, so small dev tables still show whether an index
+    *can* serve the query. Statements are only planned, never run.
+    Returns [(name, expected_index, indexes_used)] for failures.
+    """
+    cur = conn.cursor()
+    failures = []
+    try:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for name, sql, params, index in HOT_QUERIES:
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            used = _plan_indexes(plan)
+            expected = (index,) if isinstance(index, str) else index
+            if not used & set(expected):
+                failures.append((name, " or ".join(expected), sorted(used)))
+        return failures
+    finally:
+        conn.rollback()
+        cur.close()
+
+@app.cli.command("db-migrate")
+def db_migrate_command():
+    """flask --app app1 db-migrate"""
+    with db_connection() as conn:
+        applied = migrate(conn)
+    print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+
+@app.cli.command("explain-audit")
+def explain_audit_command():
+    """flask --app app1 explain-audit (exits 1 if a hot query lost its index)"""
+    with db_connection() as conn:
+        failures = explain_audit(conn)
+    for name, index, used in failures:
+        print(f"FAIL {name}: expected {index}, plan uses {used or 'no index'}")
+    print(f"{len(HOT_QUERIES) - len(failures)}/{len(HOT_QUERIES)} hot queries use their index")
+    if failures:
+        raise SystemExit(1)
+
 def init_db():
     conn = None
     try:
         conn = get_db_connection()
+        migrate(conn)
         cur = conn.cursor()
-        # users
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(100) UNIQUE NOT NULL,
-                password_hash VARCHAR(128) NOT NULL,
-                salt VARCHAR(64) NOT NULL,
-                points_used INTEGER DEFAULT 0,
-                total_points INTEGER DEFAULT 15,
-                is_premium BOOLEAN DEFAULT FALSE,
-                referral_code VARCHAR(10) UNIQUE,
-                referred_by INTEGER REFERENCES users(id),
-                referrals_count INTEGER DEFAULT 0,
-                insta_username VARCHAR(100),
-                insta_password TEXT,
-                ig_device_id TEXT,
-                ig_guid TEXT,
-                ig_challenge_context TEXT,
-                ig_session_settings TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        # logins
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS logins (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                login_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        # activities
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS activities (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                prompt TEXT NOT NULL,
-                image_filename VARCHAR(255),
-                generated_caption TEXT,
-                modified_caption TEXT,
-                caption_filename VARCHAR(255),
-                points_used INTEGER DEFAULT 0,
-                was_downloaded BOOLEAN DEFAULT FALSE,
-                was_posted BOOLEAN DEFAULT FALSE,
-                download_time TIMESTAMP,
-                post_time TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        # Add caption_filename column if not exists
-        cur.execute("""
-            ALTER TABLE activities ADD COLUMN IF NOT EXISTS caption_filename VARCHAR(255)
-        """)
-        # referrals
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS referrals (
-                id SERIAL PRIMARY KEY,
-                referrer_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
-                referee_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE UNIQUE,
-                points_awarded INTEGER NOT NULL DEFAULT 5,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        # scheduled_posts
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS scheduled_posts (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                caption TEXT NOT NULL,
-                image_filename VARCHAR(255),
-                scheduled_time TIMESTAMP NOT NULL,
-                platform VARCHAR(20) NOT NULL DEFAULT 'instagram',
-                status VARCHAR(20) DEFAULT 'scheduled',
-                error_message TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                completed_at TIMESTAMP
-            );
-        """)
+        recover_stale_generation_jobs(cur)
+        if default_graph_account_id():
+            register_account_sync(cur, IG_BUSINESS_ID)
         conn.commit()
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
@@ -243,11 +1307,22 @@ def init_db():
         if conn:
             conn.close()
 
-    # Start scheduler worker thread
-    scheduler_thread = threading.Thread(target=check_scheduled_posts)
-    scheduler_thread.daemon = True
-    scheduler_thread.start()
+    # Start scheduled post dispatcher
+    post_dispatcher.start()
     logger.info("Scheduler thread started")
+    graph_credentials_listener.start()
+
+    # Media sync + metrics snapshots for every connected account
+    scheduler.add_job(
+        account_sync.tick, "interval", seconds=ACCOUNT_SYNC_TICK_SECONDS,
+        id="account_sync_tick", replace_existing=True, max_instances=1, coalesce=True,
+        next_run_time=datetime.now(),
+    )
+    scheduler.add_job(
+        precreate_metric_partitions, "interval", hours=6,
+        id="metric_partitions", replace_existing=True, max_instances=1, coalesce=True,
+        next_run_time=datetime.now(),
+    )
 
 # --------------------------------------------------
 # IG Session Helpers
@@ -279,90 +1354,614 @@ def load_ig_settings(cur, user_id: int):
             logger.error(f"Failed to decrypt/load IG settings: {e}")
     return None
 
+IG_CLIENT_POOL_MAX = int(os.getenv("IG_CLIENT_POOL_MAX", "200"))
+IG_CLIENT_IDLE_SECONDS = int(os.getenv("IG_CLIENT_IDLE_SECONDS", "1800"))
+IG_CLIENT_VALIDATE_SECONDS = int(os.getenv("IG_CLIENT_VALIDATE_SECONDS", "300"))
+
+def ig_session_alive(cl: Client) -> bool:
+    """Cheap authenticated call to check the client is still logged in"""
+    try:
+        cl.account_info()
+        return True
+    except Exception as e:
+        logger.info(f"Pooled IG session no longer valid: {e}")
+        return False
+
+class InstagramClientPool:
+    """
+    Process-level pool of logged-in instagrapi Clients keyed by user id.
+    - LRU capped at `max_clients`; clients idle for `idle_seconds` are dropped
+    - a client is re-validated at most every `validate_seconds`
+    - user_lock() serializes one user's Instagram actions (login + upload)
+    """
+    def __init__(self, max_clients=IG_CLIENT_POOL_MAX, idle_seconds=IG_CLIENT_IDLE_SECONDS,
+                 validate_seconds=IG_CLIENT_VALIDATE_SECONDS):
+        self._max_clients = max_clients
+        self._idle_seconds = idle_seconds
+        self._validate_seconds = validate_seconds
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()  # user_id -> [client, last_used, validated_at]
+        self._user_locks = {}
+        self._stats = {"hits": 0, "misses": 0, "invalidated": 0, "evictions": 0}
+
+    def user_lock(self, user_id):
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.RLock())
+
+    def get(self, user_id):
+        """Logged-in client for the user, or None (caller should log in and put())"""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(user_id)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._clients.move_to_end(user_id)
+            entry[1] = now
+            needs_check = now - entry[2] > self._validate_seconds
+        if needs_check:
+            if not ig_session_alive(entry[0]):
+                with self._lock:
+                    if self._clients.get(user_id) is entry:
+                        del self._clients[user_id]
+                    self._stats["invalidated"] += 1
+                return None
+            entry[2] = time.monotonic()
+        with self._lock:
+            self._stats["hits"] += 1
+        return entry[0]
+
+    def put(self, user_id, cl: Client):
+        # Never replay an OTP handler captured by the login that created this client
+        cl.challenge_code_handler = lambda username, choice: None
+        now = time.monotonic()
+        with self._lock:
+            self._clients[user_id] = [cl, now, now]
+            self._clients.move_to_end(user_id)
+            while len(self._clients) > self._max_clients:
+                self._clients.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def evict(self, user_id):
+        with self._lock:
+            self._clients.pop(user_id, None)
+
+    def _evict_idle(self, now):
+        while self._clients:
+            user_id, entry = next(iter(self._clients.items()))
+            if now - entry[1] <= self._idle_seconds:
+                break
+            del self._clients[user_id]
+            self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._clients)
+        return stats
+
+ig_clients = InstagramClientPool()
+
 # --------------------------------------------------
-# Caption File Helpers
+# Caption revisions
 # --------------------------------------------------
 
-def save_caption_file(user_id, image_filename, prompt, caption):
+def insert_activity(cur, user_id, prompt, image_filename, caption, points_used):
+    """Insert a generation activity and its first caption revision in one statement"""
+    cur.execute(
+        """
+        WITH a AS (
+            INSERT INTO activities (user_id, prompt, image_filename, generated_caption, points_used)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id, user_id, generated_caption
+        )
+        INSERT INTO caption_revisions (activity_id, user_id, revision, caption, source)
+        SELECT id, user_id, 1, generated_caption, 'generated' FROM a
+        RETURNING activity_id
+        """,
+        (user_id, prompt, image_filename, caption, points_used),
+    )
+    return cur.fetchone()[0]
+
+def save_caption_revision(cur, user_id, image_filename, caption):
     """
-    Save caption in JSON file with same base name as image
+    Set the current caption and append it to the history in one statement.
+    The row lock taken by the UPDATE serializes concurrent edits, so
+    revision numbers stay gapless. Returns the new revision, or None if
+    the user has no such image.
     """
-    user_caption_dir = get_user_caption_dir(user_id)
-    base_name, _ = os.path.splitext(image_filename)
-    caption_filename = f"{base_name}_caption.json"
-    caption_path = os.path.join(user_caption_dir, caption_filename)
-    
-    data = {
-        "prompt": prompt,
-        "caption": caption,
-        "image_filename": image_filename,
-        "created_at": datetime.now().isoformat(),
-        "updated_at": None
-    }
-    
-    with open(caption_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    
-    return caption_filename
-
-def update_caption_file(user_id, caption_filename, new_caption):
-    """
-    Update existing caption file with new caption
-    """
-    user_caption_dir = get_user_caption_dir(user_id)
-    caption_path = os.path.join(user_caption_dir, caption_filename)
-    
-    # Load existing data if file exists
-    if os.path.exists(caption_path):
-        with open(caption_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    else:
-        data = {}
-    
-    # Update caption and timestamp
-    data["caption"] = new_caption
-    data["updated_at"] = datetime.now().isoformat()
-    
-    # Save updated data
-    with open(caption_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    
-    return data
+    cur.execute(
+        """
+        WITH a AS (
+            UPDATE activities
+            SET modified_caption=%s, caption_revision=COALESCE(caption_revision, 1) + 1,
+                updated_at=CURRENT_TIMESTAMP
+            WHERE user_id=%s AND image_filename=%s
+            RETURNING id, user_id, caption_revision
+        )
+        INSERT INTO caption_revisions (activity_id, user_id, revision, caption, source)
+        SELECT id, user_id, caption_revision, %s, 'edit' FROM a
+        RETURNING revision
+        """,
+        (caption, user_id, image_filename, caption),
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def import_caption_files(conn, caption_dir=BASE_CAPTION_DIR):
+    """
+    One-shot import of the legacy static/captions/<user>/*_caption.json
+    files. Every activity gets its generated caption as revision 1; a file
+    whose caption differs (an edit) becomes revision 2. Safe to re-run.
+    Returns (files_read, revisions_imported).
+    """
+    rows = []
+    if os.path.isdir(caption_dir):
+        for user_dir in os.scandir(caption_dir):
+            if not (user_dir.is_dir() and user_dir.name.isdigit()):
+                continue
+            for entry in os.scandir(user_dir.path):
+                if not entry.name.endswith("_caption.json"):
+                    continue
+                try:
+                    with open(entry.path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Skipping unreadable caption file {entry.path}: {e}")
+                    continue
+                if data.get("image_filename") and data.get("caption"):
+                    edited_at = data.get("updated_at") or data.get("created_at")
+                    rows.append((int(user_dir.name), data["image_filename"], data["caption"], edited_at))
+
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            INSERT INTO caption_revisions (activity_id, user_id, revision, caption, source, created_at)
+            SELECT id, user_id, 1, generated_caption, 'generated', created_at
+            FROM activities WHERE generated_caption IS NOT NULL
+            ON CONFLICT (activity_id, revision) DO NOTHING
+            """
+        )
+        imported = cur.rowcount
+
+        cur.execute("CREATE TEMP TABLE caption_import (user_id INTEGER, image_filename VARCHAR(255), caption TEXT, edited_at TIMESTAMP) ON COMMIT DROP")
+        psycopg2.extras.execute_values(cur, "INSERT INTO caption_import VALUES %s", rows, page_size=1000)
+        cur.execute(
+            """
+            WITH edited AS (
+                UPDATE activities a
+                SET modified_caption=COALESCE(a.modified_caption, i.caption), caption_revision=2
+                FROM caption_import i
+                WHERE a.user_id=i.user_id AND a.image_filename=i.image_filename
+                  AND i.caption IS DISTINCT FROM a.generated_caption
+                  AND COALESCE(a.caption_revision, 1) < 2
+                RETURNING a.id, a.user_id, i.caption, i.edited_at
+            )
+            INSERT INTO caption_revisions (activity_id, user_id, revision, caption, source, created_at)
+            SELECT id, user_id, 2, caption, 'import', COALESCE(edited_at, CURRENT_TIMESTAMP) FROM edited
+            ON CONFLICT (activity_id, revision) DO NOTHING
+            """
+        )
+        imported += cur.rowcount
+        conn.commit()
+        return len(rows), imported
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+@app.cli.command("import-captions")
+def import_captions_command():
+    """flask --app app1 import-captions"""
+    with db_connection() as conn:
+        files, imported = import_caption_files(conn)
+    print(f"Read {files} caption files, imported {imported} caption revisions")
 
 # --------------------------------------------------
 # Scheduled posts worker
 # --------------------------------------------------
 
-def check_scheduled_posts():
-    while True:
+SCHEDULER_PUBLISH_WORKERS = int(os.getenv("SCHEDULER_PUBLISH_WORKERS", "4"))  # accounts published in parallel
+SCHEDULER_ACCOUNT_POSTS_PER_MINUTE = float(os.getenv("SCHEDULER_ACCOUNT_POSTS_PER_MINUTE", "2"))
+SCHEDULER_ACCOUNT_BURST = int(os.getenv("SCHEDULER_ACCOUNT_BURST", "3"))
+if SCHEDULER_ACCOUNT_POSTS_PER_MINUTE <= 0 or SCHEDULER_ACCOUNT_BURST < 1:
+    raise ValueError("SCHEDULER_ACCOUNT_POSTS_PER_MINUTE must be > 0 and SCHEDULER_ACCOUNT_BURST >= 1")
+SCHEDULER_RESYNC_SECONDS = int(os.getenv("SCHEDULER_RESYNC_SECONDS", "60"))
+SCHEDULE_CHANNEL = "scheduled_posts"
+SCHEDULER_LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", "600"))
+SCHEDULER_MAX_ATTEMPTS = int(os.getenv("SCHEDULER_MAX_ATTEMPTS", "3"))
+# Identifies this process as a lease owner
+SCHEDULER_INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{py_uuid.uuid4().hex[:8]}"
+
+CLAIM_SCHEDULED_POST_SQL = """
+    UPDATE scheduled_posts sp
+    SET status='processing', lease_owner=%s,
+        lease_expires_at=%s + %s * INTERVAL '1 second',
+        claim_attempts=COALESCE(sp.claim_attempts, 0) + 1
+    FROM (
+        SELECT id FROM scheduled_posts
+        WHERE id=%s AND status='scheduled' AND scheduled_time <= %s
+        FOR UPDATE SKIP LOCKED
+    ) due
+    WHERE sp.id = due.id
+    RETURNING sp.user_id, sp.caption, sp.image_filename
+"""
+
+def claim_scheduled_post(cur, post_id):
+    """
+    Lease a due post to this instance: 'scheduled' -> 'processing'.
+    SKIP LOCKED makes concurrent claimers on other processes/hosts pass over
+    the row instead of waiting, so exactly one of them wins.
+    Returns (user_id, caption, image_filename) or None.
+    """
+    cur.execute(
+        CLAIM_SCHEDULED_POST_SQL,
+        (SCHEDULER_INSTANCE_ID, datetime.now(), SCHEDULER_LEASE_SECONDS, post_id, datetime.now()),
+    )
+    return cur.fetchone()
+
+def renew_scheduled_lease(cur, post_id):
+    """Push this instance's lease on a post forward; False if the lease was lost"""
+    cur.execute(
+        """
+        UPDATE scheduled_posts SET lease_expires_at=%s + %s * INTERVAL '1 second'
+        WHERE id=%s AND status='processing' AND lease_owner=%s
+        """,
+        (datetime.now(), SCHEDULER_LEASE_SECONDS, post_id, SCHEDULER_INSTANCE_ID),
+    )
+    return cur.rowcount == 1
+
+REAP_EXPIRED_LEASES_SQL = """
+    UPDATE scheduled_posts
+    SET status = CASE WHEN COALESCE(claim_attempts, 0) >= %s THEN 'failed' ELSE 'scheduled' END,
+        error_message = CASE WHEN COALESCE(claim_attempts, 0) >= %s
+                             THEN 'Publishing did not complete (lease expired)' ELSE error_message END,
+        lease_owner=NULL, lease_expires_at=NULL
+    WHERE status='processing' AND lease_expires_at < %s
+    RETURNING id, status
+"""
+
+def reap_expired_leases(cur):
+    """
+    Re-queue posts whose lease expired (owner crashed mid-publish), or fail
+    them after SCHEDULER_MAX_ATTEMPTS claims. Returns re-queued ids.
+    """
+    cur.execute(REAP_EXPIRED_LEASES_SQL, (SCHEDULER_MAX_ATTEMPTS, SCHEDULER_MAX_ATTEMPTS, datetime.now()))
+    requeued = [post_id for post_id, status in cur.fetchall() if status == "scheduled"]
+    for post_id in requeued:
+        logger.warning(f"[Scheduler] Lease expired, re-queued post {post_id}")
+        notify_scheduler(cur, "upsert", post_id)
+    return requeued
+
+def notify_scheduler(cur, op, post_id):
+    """Wake the dispatcher (delivered when the caller's transaction commits)"""
+    cur.execute("SELECT pg_notify(%s, %s)", (SCHEDULE_CHANNEL, f"{op}:{post_id}"))
+
+class TokenBucket:
+    """Token bucket: `rate` tokens per second, bursts up to `capacity`"""
+    def __init__(self, rate, capacity):
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f"TokenBucket needs rate > 0 and capacity >= 1, got {rate}, {capacity}")
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take one token if available and return 0, else return seconds until one will be"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self._rate
+
+DISPATCHER_RESYNC_SQL = "SELECT id, user_id, scheduled_time FROM scheduled_posts WHERE status='scheduled'"
+
+class ScheduledPostDispatcher:
+    """
+    Fires scheduled posts on time.
+    A min-heap holds (fire_at, post_id, user_id) for every 'scheduled' row; the
+    dispatcher thread sleeps until the earliest one is due or a LISTEN
+    notification arrives. Due posts are queued per account and each account
+    is drained by one publish worker, in scheduled order, paced by a
+    per-account token bucket. Workers never sleep for a token: an account
+    whose bucket is empty is parked on a resume heap and re-dispatched
+    when its next token is due, so a bulk account can't hold a publish
+    worker (or its user's IG lock) while other accounts' posts are due.
+    A periodic full resync covers notifications lost while disconnected.
+    """
+    def __init__(self, workers=SCHEDULER_PUBLISH_WORKERS, resync_seconds=SCHEDULER_RESYNC_SECONDS):
+        self._resync_seconds = resync_seconds
+        self._heap = []       # (fire_at epoch, post_id, user_id) — dispatcher thread only
+        self._fire_at = {}    # post_id -> current fire_at; heap entries that disagree are stale
+        self._queues = {}     # user_id -> deque of due post ids, oldest first
+        self._buckets = {}    # user_id -> TokenBucket
+        self._resume = []     # (resume_at epoch, user_id) for accounts waiting on a token; under _lock
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()  # lets workers interrupt the dispatcher's select
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="publish")
+        self._prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="publish-prefetch")
+        self._thread = None
+        self._stats = {
+            "dispatched": 0, "published": 0, "failed": 0, "notifications": 0, "resyncs": 0,
+            "max_lateness_s": 0.0, "rate_limited_deferrals": 0,
+            "publish_time_total_s": 0.0, "publish_time_max_s": 0.0,
+        }
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="post-dispatcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**DB_CONFIG)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {SCHEDULE_CHANNEL}")
+                self._resync(cur)
+                next_resync = time.monotonic() + self._resync_seconds
+                while True:
+                    self._dispatch_due()
+                    self._resume_due()
+                    timeout = min(self._seconds_until_next(), next_resync - time.monotonic())
+                    readable, _, _ = select.select([conn, self._wake_r], [], [], max(timeout, 0))
+                    if self._wake_r in readable:
+                        self._drain_wakeups()
+                    if conn in readable:
+                        conn.poll()
+                        while conn.notifies:
+                            self._on_notify(cur, conn.notifies.pop(0).payload)
+                    if time.monotonic() >= next_resync:
+                        self._resync(cur)
+                        next_resync = time.monotonic() + self._resync_seconds
+            except Exception as e:
+                logger.error(f"Scheduler error: {e}")
+                time.sleep(5)
+            finally:
+                if conn:
+                    conn.close()
+
+    def _push(self, post_id, user_id, scheduled_time):
+        fire_at = scheduled_time.timestamp()
+        self._fire_at[post_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, post_id, user_id))
+
+    def _resync(self, cur):
+        reap_expired_leases(cur)
+        recover_stale_generation_jobs(cur)
+        cur.execute(DISPATCHER_RESYNC_SQL)
+        self._heap, self._fire_at = [], {}
+        for post_id, user_id, scheduled_time in cur.fetchall():
+            self._push(post_id, user_id, scheduled_time)
+        with self._lock:
+            self._stats["resyncs"] += 1
+
+    def _on_notify(self, cur, payload):
+        with self._lock:
+            self._stats["notifications"] += 1
+        op, _, post_id = payload.partition(":")
         try:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            now = datetime.now()
+            post_id = int(post_id)
+        except ValueError:
+            return
+        self._fire_at.pop(post_id, None)
+        if op == "delete":
+            return
+        cur.execute("SELECT user_id, scheduled_time FROM scheduled_posts WHERE id=%s AND status='scheduled'", (post_id,))
+        row = cur.fetchone()
+        if row:
+            self._push(post_id, row[0], row[1])
+
+    def _pop_stale(self):
+        while self._heap and self._fire_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _seconds_until_next(self):
+        self._pop_stale()
+        candidates = [self._resync_seconds]
+        if self._heap:
+            candidates.append(self._heap[0][0] - time.time())
+        with self._lock:
+            if self._resume:
+                candidates.append(self._resume[0][0] - time.time())
+        return min(candidates)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass  # a wakeup is already pending
 
-            cur.execute(
-                """
-                SELECT id, user_id, caption, image_filename, platform, status
-                FROM scheduled_posts
-                WHERE status IN ('scheduled') AND scheduled_time <= %s
-                """,
-                (now + timedelta(seconds=10),),
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _dispatch_due(self):
+        now = time.time()
+        self._pop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, post_id, user_id = heapq.heappop(self._heap)
+            del self._fire_at[post_id]
+            with self._lock:
+                if post_id in self._inflight:
+                    self._pop_stale()
+                    continue
+                self._inflight.add(post_id)
+                self._stats["dispatched"] += 1
+                self._stats["max_lateness_s"] = max(self._stats["max_lateness_s"], now - fire_at)
+                queue = self._queues.get(user_id)
+                start_drain = queue is None
+                if start_drain:
+                    queue = self._queues[user_id] = deque()
+                queue.append(post_id)
+            if start_drain:
+                self._kick(user_id)
+            self._pop_stale()
+
+    def _bucket(self, user_id):
+        with self._lock:
+            return self._buckets.setdefault(
+                user_id, TokenBucket(SCHEDULER_ACCOUNT_POSTS_PER_MINUTE / 60.0, SCHEDULER_ACCOUNT_BURST),
             )
-            rows = cur.fetchall()
-            for post in rows:
-                post_id, user_id, caption, filename, platform, status = post
-                logger.info(f"[Scheduler] Processing scheduled post: {post_id}")
 
+    def _kick(self, user_id):
+        """Start a worker for an account with queued posts, or park it until its next token"""
+        wait = self._bucket(user_id).try_acquire()
+        if wait:
+            with self._lock:
+                heapq.heappush(self._resume, (time.time() + wait, user_id))
+                self._stats["rate_limited_deferrals"] += 1
+            self._wake()
+        else:
+            self._executor.submit(self._drain, user_id)
+
+    def _resume_due(self):
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._resume or self._resume[0][0] > now:
+                    return
+                _, user_id = heapq.heappop(self._resume)
+            self._kick(user_id)
+
+    def _drain(self, user_id):
+        """
+        Publish one account's due posts in order while its bucket has tokens.
+        Entered holding one token, with at least one post queued.
+        """
+        bucket = self._bucket(user_id)
+        while True:
+            with self._lock:
+                posts = self._queues[user_id]
+                post_id = posts.popleft()
+                next_id = posts[0] if posts else None
+            if next_id is not None:
+                self._prefetcher.submit(self._prefetch, user_id, next_id)
+            with ig_clients.user_lock(user_id):
+                self._publish(post_id)
+            with self._lock:
+                if not posts:
+                    del self._queues[user_id]
+                    return
+            if bucket.try_acquire():
+                self._kick(user_id)  # parks the account; frees this worker for others
+                return
+
+    def _prefetch(self, user_id, post_id):
+        """Ready the next upload's IG variant and page it in while the current one uploads"""
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT image_filename FROM scheduled_posts WHERE id=%s", (post_id,))
+                row = cur.fetchone()
+                cur.close()
+            if row and row[0]:
+                with open(publish_image_path(user_id, row[0]), "rb") as f:
+                    while f.read(1 << 20):
+                        pass
+        except Exception as e:
+            logger.debug(f"[Scheduler] Prefetch skipped for post {post_id}: {e}")
+
+    def _publish(self, post_id):
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                row = claim_scheduled_post(cur, post_id)
+                conn.commit()
+                cur.close()
+            if not row:
+                return  # deleted, or claimed by another instance
+            user_id, caption, filename = row
+            logger.info(f"[Scheduler] Processing scheduled post: {post_id}")
+            started = time.monotonic()
+            stop_heartbeat = threading.Event()
+            threading.Thread(
+                target=self._heartbeat, args=(post_id, stop_heartbeat), name=f"lease-{post_id}", daemon=True,
+            ).start()
+            try:
                 success, result = _post_to_instagram_background(post_id, user_id, caption, filename, prefer_session=True)
+            finally:
+                stop_heartbeat.set()
+            duration = time.monotonic() - started
+            with db_connection() as conn:
+                cur = conn.cursor()
                 if success:
-                    logger.info(f"[Scheduler] Posted scheduled post {post_id}")
+                    logger.info(f"[Scheduler] Posted scheduled post {post_id} in {duration:.1f}s")
+                    cur.execute(
+                        """
+                        UPDATE scheduled_posts
+                        SET publish_duration_ms=%s,
+                            publish_latency_ms=(EXTRACT(EPOCH FROM (completed_at - scheduled_time)) * 1000)::INTEGER
+                        WHERE id=%s
+                        """,
+                        (int(duration * 1000), post_id),
+                    )
                 else:
                     logger.error(f"[Scheduler] Failed scheduled post {post_id}: {result}")
-            cur.close()
-            conn.close()
+                    # Early validation failures leave the row 'processing'; don't retry them forever
+                    cur.execute(
+                        """
+                        UPDATE scheduled_posts SET status='failed', error_message=%s, lease_owner=NULL, lease_expires_at=NULL
+                        WHERE id=%s AND status='processing' AND lease_owner=%s
+                        """,
+                        (result, post_id, SCHEDULER_INSTANCE_ID),
+                    )
+                conn.commit()
+                cur.close()
+            with self._lock:
+                self._stats["published" if success else "failed"] += 1
+                self._stats["publish_time_total_s"] += duration
+                self._stats["publish_time_max_s"] = max(self._stats["publish_time_max_s"], duration)
         except Exception as e:
-            logger.error(f"Scheduler error: {e}")
-        time.sleep(30)
+            logger.error(f"[Scheduler] Publish error for post {post_id}: {e}")
+        finally:
+            with self._lock:
+                self._inflight.discard(post_id)
+
+    def _heartbeat(self, post_id, stop):
+        """Extend the lease while an upload runs, so the reaper can't hand a live publish to another instance"""
+        while not stop.wait(SCHEDULER_LEASE_SECONDS / 3):
+            try:
+                with db_connection() as conn:
+                    cur = conn.cursor()
+                    renewed = renew_scheduled_lease(cur, post_id)
+                    conn.commit()
+                    cur.close()
+            except Exception as e:
+                logger.warning(f"[Scheduler] Lease renewal for post {post_id} failed: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"[Scheduler] Lost the lease on post {post_id} while publishing")
+                return
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["inflight"] = len(self._inflight)
+            stats["accounts_active"] = len(self._queues)
+        finished = stats["published"] + stats["failed"]
+        stats["publish_time_avg_s"] = stats["publish_time_total_s"] / finished if finished else 0.0
+        stats["pending"] = len(self._fire_at)
+        return stats
+
+post_dispatcher = ScheduledPostDispatcher()
 
 def _post_to_instagram_background(post_id: int, user_id: int, caption: str, filename: str, prefer_session: bool = True):
     conn = None
@@ -385,63 +1984,78 @@ def _post_to_instagram_background(post_id: int, user_id: int, caption: str, file
             return False, "No image filename"
             
         # Verify user owns the file
-        cur.execute("SELECT 1 FROM activities WHERE user_id=%s AND image_filename=%s", (user_id, filename))
-        if not cur.fetchone():
+        if not verify_user_owns_file(user_id, filename, cur):
             return False, "Image not found or access denied"
             
-        image_path = os.path.join(get_user_image_dir(user_id), filename)
-        if not os.path.exists(image_path):
+        if not resolve_image_path(user_id, filename):
             return False, "Image not found"
 
-        cl = Client()
-        cl.delay_range = [1, 3]
-
-        # If we have saved settings, restore them first
-        used_session = False
-        if prefer_session and ig_session_enc:
-            try:
-                settings_str = decrypt_data(ig_session_enc)
-                if settings_str:
-                    cl.set_settings(json.loads(settings_str))
-                    # Keep same device/uuid if stored
-                    if device_id:
-                        cl.device_id = device_id
-                    if guid:
-                        cl.uuid = guid
-                    cl.login(insta_username, insta_password)
-                    used_session = True
-                    logger.info(f"Reused saved IG session for user {user_id}")
-            except Exception as e:
-                logger.warning(f"Saved session login failed, will try fresh login. Reason: {e}")
+        # Serialize this user's Instagram actions; reuse a warm client when we have one
+        with ig_clients.user_lock(user_id):
+            cl = ig_clients.get(user_id)
+            if cl is None:
+                cl = Client()
+                cl.delay_range = [1, 3]
+
+                # If we have saved settings, restore them first
+                used_session = False
+                if prefer_session and ig_session_enc:
+                    try:
+                        settings_str = decrypt_data(ig_session_enc)
+                        if settings_str:
+                            cl.set_settings(json.loads(settings_str))
+                            # Keep same device/uuid if stored
+                            if device_id:
+                                cl.device_id = device_id
+                            if guid:
+                                cl.uuid = guid
+                            cl.login(insta_username, insta_password)
+                            used_session = True
+                            logger.info(f"Reused saved IG session for user {user_id}")
+                    except Exception as e:
+                        logger.warning(f"Saved session login failed, will try fresh login. Reason: {e}")
+
+                if not used_session:
+                    # Fresh login (may trigger OTP)
+                    try:
+                        cl.login(insta_username, insta_password)
+                        # Save new session for future runs
+                        save_ig_settings(cur, user_id, cl)
+                    except Exception as e:
+                        # If challenge, mark otp_required and persist challenge context
+                        if any(k in str(e).lower() for k in ["challenge", "otp", "verification", "2fa"]):
+                            device_id = getattr(cl, "device_id", None) or generate_device_id()
+                            guid = getattr(cl, "uuid", None) or str(py_uuid.uuid4())
+                            challenge_ctx = getattr(cl, "challenge_context", None) or getattr(cl, "last_json", None)
+
+                            cur.execute(
+                                "UPDATE users SET ig_device_id=%s, ig_guid=%s, ig_challenge_context=%s WHERE id=%s",
+                                (device_id, guid, json_dumps_safe(challenge_ctx), user_id),
+                            )
+                            cur.execute(
+                                """
+                                UPDATE scheduled_posts
+                                SET status='otp_required', error_message='OTP challenge required', lease_owner=NULL, lease_expires_at=NULL
+                                WHERE id=%s AND lease_owner=%s
+                                """,
+                                (post_id, SCHEDULER_INSTANCE_ID),
+                            )
+                            conn.commit()
+                            return False, "OTP challenge required"
+                        else:
+                            return False, str(e)
+
+                ig_clients.put(user_id, cl)
+            else:
+                logger.info(f"Reused pooled IG client for user {user_id}")
 
-        if not used_session:
-            # Fresh login (may trigger OTP)
+            # Upload photo
             try:
-                cl.login(insta_username, insta_password)
-                # Save new session for future runs
-                save_ig_settings(cur, user_id, cl)
-            except Exception as e:
-                # If challenge, mark otp_required and persist challenge context
-                if any(k in str(e).lower() for k in ["challenge", "otp", "verification", "2fa"]):
-                    device_id = getattr(cl, "device_id", None) or generate_device_id()
-                    guid = getattr(cl, "uuid", None) or str(py_uuid.uuid4())
-                    challenge_ctx = getattr(cl, "challenge_context", None) or getattr(cl, "last_json", None)
-
-                    cur.execute(
-                        "UPDATE users SET ig_device_id=%s, ig_guid=%s, ig_challenge_context=%s WHERE id=%s",
-                        (device_id, guid, json_dumps_safe(challenge_ctx), user_id),
-                    )
-                    cur.execute(
-                        "UPDATE scheduled_posts SET status='otp_required', error_message='OTP challenge required' WHERE id=%s",
-                        (post_id,),
-                    )
-                    conn.commit()
-                    return False, "OTP challenge required"
-                else:
-                    return False, str(e)
+                res = cl.photo_upload(path=publish_image_path(user_id, filename), caption=caption)
+            except Exception:
+                ig_clients.evict(user_id)
+                raise
 
-        # Upload photo
-        res = cl.photo_upload(path=image_path, caption=caption)
         shortcode = None
         if hasattr(res, "model_dump"):
             shortcode = res.model_dump().get("shortcode")
@@ -458,26 +2072,35 @@ def _post_to_instagram_background(post_id: int, user_id: int, caption: str, file
             (caption, user_id, filename),
         )
 
-        # Mark scheduled post as complete
+        # Mark scheduled post as complete (only while we still hold its lease)
         cur.execute(
             """
             UPDATE scheduled_posts
-            SET status='completed', error_message=NULL, completed_at=CURRENT_TIMESTAMP
-            WHERE id=%s
+            SET status='completed', error_message=NULL, completed_at=CURRENT_TIMESTAMP,
+                lease_owner=NULL, lease_expires_at=NULL
+            WHERE id=%s AND lease_owner=%s
             """,
-            (post_id,),
+            (post_id, SCHEDULER_INSTANCE_ID),
         )
+        if cur.rowcount != 1:
+            logger.warning(f"[Scheduler] Post {post_id} was uploaded after its lease passed to another owner")
         conn.commit()
 
         return True, f"https://www.instagram.com/p/{shortcode}/" if shortcode else ""
 
     except Exception as e:
         if conn:
+            conn.rollback()
             cur = conn.cursor()
             cur.execute(
-                "UPDATE scheduled_posts SET status='failed', error_message=%s WHERE id=%s",
-                (str(e), post_id),
+                """
+                UPDATE scheduled_posts SET status='failed', error_message=%s, lease_owner=NULL, lease_expires_at=NULL
+                WHERE id=%s AND lease_owner=%s
+                """,
+                (str(e), post_id, SCHEDULER_INSTANCE_ID),
             )
+            if cur.rowcount != 1:
+                logger.warning(f"[Scheduler] Not marking post {post_id} failed: its lease belongs to another owner")
             conn.commit()
         return False, str(e)
 
@@ -502,6 +2125,10 @@ def ig_session_prepare():
         insta_username, insta_password_enc = row
         insta_password = decrypt_data(insta_password_enc)
 
+        # Already have a live session in the pool: nothing to do
+        if ig_clients.get(session["user_id"]) is not None:
+            return jsonify({"success": True, "session_ready": True})
+
         cl = Client()
         cl.delay_range = [1, 3]
         # Do not block for code
@@ -514,6 +2141,7 @@ def ig_session_prepare():
                         (getattr(cl, "device_id", None), getattr(cl, "uuid", None), session["user_id"]))
             save_ig_settings(cur, session["user_id"], cl)
             conn.commit()
+            ig_clients.put(session["user_id"], cl)
             return jsonify({"success": True, "session_ready": True})
         except Exception as e:
             if any(k in str(e).lower() for k in ["challenge", "otp", "verification", "2fa"]):
@@ -578,6 +2206,7 @@ def ig_session_verify():
         # Clear challenge context
         cur.execute("UPDATE users SET ig_challenge_context=NULL WHERE id=%s", (session["user_id"],))
         conn.commit()
+        ig_clients.put(session["user_id"], cl)
         return jsonify({"success": True, "session_ready": True, "message": "OTP verified. Session saved."})
     except Exception as e:
         logger.error(f"ig_session_verify error: {e}")
@@ -638,9 +2267,18 @@ def verify_scheduled_otp():
         # Save session now
         save_ig_settings(cur, session["user_id"], cl)
         cur.execute("UPDATE users SET ig_challenge_context=NULL WHERE id=%s", (session["user_id"],))
+        ig_clients.put(session["user_id"], cl)
 
         # After verifying OTP for this post, set it back to scheduled (now)
-        cur.execute("UPDATE scheduled_posts SET status='scheduled', scheduled_time=NOW() WHERE id=%s", (post_id,))
+        cur.execute(
+            """
+            UPDATE scheduled_posts
+            SET status='scheduled', scheduled_time=%s, lease_owner=NULL, lease_expires_at=NULL, claim_attempts=0
+            WHERE id=%s
+            """,
+            (datetime.now(), post_id),
+        )
+        notify_scheduler(cur, "upsert", post_id)
         conn.commit()
 
         return jsonify({"success": True, "message": "OTP verified. Post will be published shortly."})
@@ -755,6 +2393,59 @@ def login():
     finally:
         cur.close(); conn.close()
 
+def generate_content(user_id, prompt, tone, content_type):
+    """
+    Call Gemini for caption + image, save the image and caption file.
+    Returns (caption, filename, image_path).
+    """
+    # Prepare prompt
+    full_prompt = (
+        f"Generate a {tone} {content_type} for: {prompt}. "
+        f"Provide an Instagram caption with 3 hashtags."
+    )
+    logger.info(f"Sending prompt to Gemini: {full_prompt}")
+
+    # Use latest Gemini model
+    model_name = "gemini-2.0-flash-preview-image-generation"
+    response = client.models.generate_content(
+        model=model_name,
+        contents=full_prompt,
+        config=types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"]),
+    )
+    logger.info("Gemini response received")
+
+    # Extract text + image
+    text_parts = []
+    image_data = None
+    for part in response.candidates[0].content.parts:
+        if getattr(part, "text", None):
+            text_parts.append(part.text.strip())
+        elif getattr(part, "inline_data", None) and not image_data:
+            image_data = part.inline_data.data
+
+    caption = "\n".join(text_parts) if text_parts else None
+
+    # Fallback caption
+    if not caption:
+        logger.warning(f"No caption generated for prompt: {full_prompt}")
+        caption = f"✨ {prompt} ✨\n#GeneratedImage #AIArt #CreativeAI"
+
+    if not image_data:
+        raise RuntimeError("Image generation failed")
+
+    # Save image to the blob store; Gemini's PNG bytes are stored as-is
+    img = Image.open(BytesIO(image_data))
+    if img.format != "PNG":
+        buf = BytesIO()
+        img.save(buf, "PNG")
+        image_data = buf.getvalue()
+    filename = store_image(image_data)
+    path = resolve_image_path(user_id, filename)
+    remember_placeholder(user_id, filename, make_placeholder(img))
+    schedule_image_variants(user_id, filename)
+
+    return caption, filename, path
+
 @app.route("/api/generate", methods=["POST"])
 def generate():
     if "user_id" not in session:
@@ -769,6 +2460,10 @@ def generate():
     if not prompt:
         return jsonify({"error": "Prompt required"}), 400
 
+    # Job-queue mode: enqueue and return a job id right away
+    if data.get("async") or request.args.get("async") in ("1", "true"):
+        return enqueue_generation_job(session["user_id"], prompt, tone, content_type, is_regeneration)
+
     conn = get_db_connection()
     cur = conn.cursor()
     try:
@@ -786,56 +2481,10 @@ def generate():
                     "code": "INSUFFICIENT_POINTS"
                 }), 402
 
-        # Prepare prompt
-        full_prompt = (
-            f"Generate a {tone} {content_type} for: {prompt}. "
-            f"Provide an Instagram caption with 3 hashtags."
-        )
-        logger.info(f"Sending prompt to Gemini: {full_prompt}")
-
-        # Use latest Gemini model
-        model_name = "gemini-2.0-flash-preview-image-generation"
-        response = client.models.generate_content(
-            model=model_name,
-            contents=full_prompt,
-            config=types.GenerateContentConfig(response_modalities=["TEXT", "IMAGE"]),
-        )
-        logger.info("Gemini response received")
-
-        # Extract text + image
-        text_parts = []
-        image_data = None
-        for part in response.candidates[0].content.parts:
-            if getattr(part, "text", None):
-                text_parts.append(part.text.strip())
-            elif getattr(part, "inline_data", None) and not image_data:
-                image_data = part.inline_data.data
-
-        caption = "\n".join(text_parts) if text_parts else None
-
-        # Fallback caption
-        if not caption:
-            logger.warning(f"No caption generated for prompt: {full_prompt}")
-            caption = f"✨ {prompt} ✨\n#GeneratedImage #AIArt #CreativeAI"
-
-        if not image_data:
-            return jsonify({"error": "Image generation failed"}), 500
-
-        # Save image to user folder
-        user_image_dir = get_user_image_dir(session["user_id"])
-        filename = f"img_{datetime.now():%Y%m%d%H%M%S}.png"
-        path = os.path.join(user_image_dir, filename)
-
-        img = Image.open(BytesIO(image_data))
-        img.save(path)
-
-        with open(path, "rb") as f:
-            b64 = base64.b64encode(f.read()).decode()
-
-        # Save caption file
-        caption_filename = save_caption_file(
-            session["user_id"], filename, prompt, caption
-        )
+        try:
+            caption, filename, path = generate_content(session["user_id"], prompt, tone, content_type)
+        except RuntimeError as e:
+            return jsonify({"error": str(e)}), 500
 
         # Update points
         used_now = 0
@@ -848,21 +2497,14 @@ def generate():
             total_points, points_used = cur.fetchone()
 
         # Save activity
-        cur.execute(
-            """
-            INSERT INTO activities (user_id, prompt, image_filename, generated_caption, caption_filename, points_used)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-            """,
-            (session["user_id"], prompt, filename, caption, caption_filename, used_now),
-        )
+        insert_activity(cur, session["user_id"], prompt, filename, caption, used_now)
         conn.commit()
 
         return jsonify({
             "success": True,
             "caption": caption,
             "filename": filename,
-            "image": b64,
+            **image_payload(session["user_id"], filename, wants_inline_image(data)),
             "points": {
                 "total": total_points,
                 "used": points_used,
@@ -878,30 +2520,328 @@ def generate():
         cur.close()
         conn.close()
 
-# ----------------- Direct post -----------------
-@app.route("/api/post", methods=["POST"])
-def post_to_instagram_frontend():
-    if "user_id" not in session:
-        return jsonify({"error": "Unauthorized"}), 401
-
+# --------------------------------------------------
+# Async generation jobs
+# --------------------------------------------------
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "4"))
+GENERATION_QUEUE_MAX = int(os.getenv("GENERATION_QUEUE_MAX", "50"))
+GENERATION_MAX_PER_USER = int(os.getenv("GENERATION_MAX_PER_USER", "2"))
+GENERATION_POINTS = 5
+# Each instance heartbeats its unfinished jobs; silent for GENERATION_HEARTBEAT_TIMEOUT means the owner is gone
+GENERATION_HEARTBEAT_SECONDS = int(os.getenv("GENERATION_HEARTBEAT_SECONDS", "30"))
+GENERATION_HEARTBEAT_TIMEOUT = int(os.getenv("GENERATION_HEARTBEAT_TIMEOUT", str(4 * GENERATION_HEARTBEAT_SECONDS)))
+
+generation_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="generate")
+_generation_lock = threading.Lock()
+_generation_active = defaultdict(int)  # user_id -> queued + running jobs in this process
+_generation_events = {}                # job_id -> threading.Event, set when the job finishes
+
+def _points_payload(total_points, points_used):
+    return {"total": total_points, "used": points_used, "available": total_points - points_used}
+
+def heartbeat_generation_jobs(cur):
+    """Mark this instance's unfinished jobs as still alive"""
+    cur.execute(
+        "UPDATE generation_jobs SET heartbeat_at=NOW() WHERE owner=%s AND status IN ('queued', 'running')",
+        (SCHEDULER_INSTANCE_ID,),
+    )
+
+RECOVER_GENERATION_JOBS_SQL = """
+    WITH stale AS (
+        UPDATE generation_jobs j
+        SET status='failed', error_message='Job interrupted', points_reserved=0, completed_at=CURRENT_TIMESTAMP
+        FROM (
+            SELECT id, points_reserved FROM generation_jobs
+            WHERE status IN ('queued', 'running')
+              AND COALESCE(heartbeat_at, created_at) < NOW() - %s * INTERVAL '1 second'
+              AND owner IS DISTINCT FROM %s
+            FOR UPDATE SKIP LOCKED
+        ) old
+        WHERE j.id = old.id
+        RETURNING j.user_id, old.points_reserved
+    ), refunds AS (
+        UPDATE users u SET points_used = u.points_used - r.points
+        FROM (SELECT user_id, SUM(points_reserved) AS points FROM stale GROUP BY user_id) r
+        WHERE u.id = r.user_id AND r.points > 0
+    )
+    SELECT COUNT(*) FROM stale
+"""
+
+def recover_stale_generation_jobs(cur):
+    """
+    Fail and refund jobs whose owner stopped heartbeating them (crashed or
+    restarted), however recently they were created. Runs at startup, on every
+    scheduler resync and on every GenerationHeartbeat tick; one statement, so
+    it's safe under autocommit and on several instances at once. Returns the
+    number of jobs failed.
+    """
+    cur.execute(RECOVER_GENERATION_JOBS_SQL, (GENERATION_HEARTBEAT_TIMEOUT, SCHEDULER_INSTANCE_ID))
+    failed = cur.fetchone()[0]
+    if failed:
+        logger.warning(f"[Generate] Failed and refunded {failed} interrupted job(s)")
+    return failed
+
+class GenerationHeartbeat:
+    """
+    Keeps heartbeat_at fresh on this instance's unfinished jobs so sweeps on
+    other instances leave them alone, and runs the sweep itself. Started
+    with the first job this process takes, independent of the post
+    dispatcher (which may not run here at all, e.g. under gunicorn).
+    """
+    def __init__(self, interval=GENERATION_HEARTBEAT_SECONDS):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="generation-heartbeat", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            with _generation_lock:
+                busy = bool(_generation_active)
+            try:
+                with db_connection() as conn:
+                    cur = conn.cursor()
+                    try:
+                        if busy:
+                            heartbeat_generation_jobs(cur)
+                        recover_stale_generation_jobs(cur)
+                        conn.commit()
+                    finally:
+                        cur.close()
+            except Exception as e:
+                logger.error(f"[Generate] Heartbeat error: {e}")
+
+generation_heartbeat = GenerationHeartbeat()
+
+def enqueue_generation_job(user_id, prompt, tone, content_type, is_regeneration):
+    with _generation_lock:
+        if _generation_active[user_id] >= GENERATION_MAX_PER_USER:
+            return jsonify({
+                "success": False,
+                "message": "Too many generations in progress",
+                "code": "TOO_MANY_JOBS"
+            }), 429
+        if sum(_generation_active.values()) >= GENERATION_QUEUE_MAX:
+            return jsonify({"success": False, "message": "Generation queue is full, try again shortly"}), 503
+        _generation_active[user_id] += 1
+
+    job_id = str(py_uuid.uuid4())
+    conn = get_db_connection(); cur = conn.cursor()
+    try:
+        # Reserve points up front (atomically), refunded if the job fails
+        reserved = 0 if is_regeneration else GENERATION_POINTS
+        cur.execute(
+            """
+            UPDATE users SET points_used=points_used+%s
+            WHERE id=%s AND total_points-points_used>=%s
+            RETURNING total_points, points_used
+            """,
+            (reserved, user_id, reserved),
+        )
+        row = cur.fetchone()
+        if not row:
+            conn.rollback()
+            _release_generation_slot(user_id)
+            return jsonify({
+                "success": False,
+                "message": "Not enough points",
+                "code": "INSUFFICIENT_POINTS"
+            }), 402
+        total_points, points_used = row
+
+        cur.execute(
+            """
+            INSERT INTO generation_jobs (id, user_id, prompt, tone, content_type, status, points_reserved,
+                                         owner, heartbeat_at)
+            VALUES (%s, %s, %s, %s, %s, 'queued', %s, %s, NOW())
+            """,
+            (job_id, user_id, prompt, tone, content_type, reserved, SCHEDULER_INSTANCE_ID),
+        )
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        _release_generation_slot(user_id)
+        logger.error(f"Enqueue generation error: {e}")
+        return jsonify({"error": f"Generate route error: {e}"}), 500
+    finally:
+        cur.close(); conn.close()
+
+    with _generation_lock:
+        _generation_events[job_id] = threading.Event()
+    generation_heartbeat.start()
+    generation_executor.submit(_run_generation_job, job_id, user_id, prompt, tone, content_type, reserved)
+
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "points": _points_payload(total_points, points_used),
+    }), 202
+
+def _release_generation_slot(user_id):
+    with _generation_lock:
+        _generation_active[user_id] -= 1
+        if _generation_active[user_id] <= 0:
+            del _generation_active[user_id]
+
+def _run_generation_job(job_id, user_id, prompt, tone, content_type, reserved):
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE generation_jobs SET status='running', started_at=CURRENT_TIMESTAMP, owner=%s, heartbeat_at=NOW()
+                WHERE id=%s AND status='queued'
+                """,
+                (SCHEDULER_INSTANCE_ID, job_id),
+            )
+            started = cur.rowcount == 1
+            conn.commit()
+        if not started:
+            logger.warning(f"[Generate] Job {job_id} was failed by the stale-job sweep before it started")
+            return
+
+        try:
+            caption, filename, _ = generate_content(user_id, prompt, tone, content_type)
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    """
+                    UPDATE generation_jobs
+                    SET status='completed', caption=%s, image_filename=%s, completed_at=CURRENT_TIMESTAMP
+                    WHERE id=%s AND status='running'
+                    """,
+                    (caption, filename, job_id),
+                )
+                # The sweep already failed and refunded it: don't hand out the image as well
+                completed = cur.rowcount == 1
+                if completed:
+                    insert_activity(cur, user_id, prompt, filename, caption, reserved)
+                conn.commit()
+            if completed:
+                logger.info(f"[Generate] Job {job_id} completed")
+            else:
+                logger.warning(f"[Generate] Job {job_id} finished after the stale-job sweep failed it; result dropped")
+        except Exception as e:
+            logger.error(f"[Generate] Job {job_id} failed: {e}")
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    """
+                    UPDATE generation_jobs
+                    SET status='failed', error_message=%s, points_reserved=0, completed_at=CURRENT_TIMESTAMP
+                    WHERE id=%s AND status='running'
+                    """,
+                    (str(e), job_id),
+                )
+                # Not ours to refund if the stale-job sweep already failed it
+                if reserved and cur.rowcount == 1:
+                    cur.execute("UPDATE users SET points_used=points_used-%s WHERE id=%s", (reserved, user_id))
+                conn.commit()
+    except Exception as e:
+        logger.error(f"[Generate] Job {job_id} bookkeeping error: {e}")
+    finally:
+        _release_generation_slot(user_id)
+        with _generation_lock:
+            event = _generation_events.pop(job_id, None)
+        if event:
+            event.set()
+
+def _load_generation_job(cur, job_id, user_id):
+    cur.execute(
+        """
+        SELECT j.status, j.caption, j.image_filename, j.error_message, j.created_at, j.completed_at,
+               u.total_points, u.points_used
+        FROM generation_jobs j JOIN users u ON u.id = j.user_id
+        WHERE j.id=%s AND j.user_id=%s
+        """,
+        (job_id, user_id),
+    )
+    return cur.fetchone()
+
+@app.route("/api/generate/<job_id>", methods=["GET"])
+def get_generation_job(job_id):
+    """
+    Job status/result. `?wait=<seconds>` long-polls (max 30s) until the job finishes.
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    user_id = session["user_id"]
+    try:
+        wait = min(max(float(request.args.get("wait", 0)), 0), 30)
+    except ValueError:
+        wait = 0
+
+    deadline = time.monotonic() + wait
+    try:
+        while True:
+            # Don't hold a pooled connection while waiting
+            with db_connection() as conn:
+                cur = conn.cursor()
+                row = _load_generation_job(cur, job_id, user_id)
+                cur.close()
+            if not row:
+                return jsonify({"error": "Job not found"}), 404
+            remaining = deadline - time.monotonic()
+            if row[0] in ("completed", "failed") or remaining <= 0:
+                break
+            with _generation_lock:
+                event = _generation_events.get(job_id)
+            if event:
+                event.wait(remaining)
+            else:
+                # Job owned by another worker process: fall back to polling
+                time.sleep(min(1.0, remaining))
+
+        status, caption, filename, error, created_at, completed_at, total_points, points_used = row
+        payload = {
+            "success": status != "failed",
+            "job_id": job_id,
+            "status": status,
+            "created_at": created_at.isoformat() if created_at else None,
+            "completed_at": completed_at.isoformat() if completed_at else None,
+            "points": _points_payload(total_points, points_used),
+        }
+        if status == "completed":
+            payload["caption"] = caption
+            payload["filename"] = filename
+            if resolve_image_path(user_id, filename):
+                payload.update(image_payload(user_id, filename, wants_inline_image()))
+        elif status == "failed":
+            payload["error"] = error
+        return jsonify(payload)
+    except Exception as e:
+        logger.error(f"Get generation job error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# ----------------- Direct post -----------------
+@app.route("/api/post", methods=["POST"])
+def post_to_instagram_frontend():
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
     data = request.get_json()
     filename = data.get("filename")
     caption = data.get("caption", "").strip()
     if not filename or not caption:
         return jsonify({"error": "Filename and caption are required"}), 400
 
-    # Verify user owns the file
-    if not verify_user_owns_file(session["user_id"], filename):
-        return jsonify({"error": "Access denied"}), 403
-
-    # Get user-specific image path
-    user_image_dir = get_user_image_dir(session["user_id"])
-    image_path = os.path.join(user_image_dir, filename)
-    if not os.path.exists(image_path):
-        return jsonify({"error": "Image not found"}), 404
-
     conn = get_db_connection(); cur = conn.cursor()
     try:
+        # Verify user owns the file
+        if not verify_user_owns_file(session["user_id"], filename, cur):
+            return jsonify({"error": "Access denied"}), 403
+
+        if not resolve_image_path(session["user_id"], filename):
+            return jsonify({"error": "Image not found"}), 404
+
         cur.execute("SELECT insta_username, insta_password FROM users WHERE id=%s", (session["user_id"],))
         row = cur.fetchone()
         if not row:
@@ -911,29 +2851,39 @@ def post_to_instagram_frontend():
         if not insta_username or not insta_password:
             return jsonify({"error": "Instagram credentials missing"}), 400
 
-        cl = Client()
-        cl.delay_range = [1, 3]
-        cl.challenge_code_handler = lambda username, choice: None
+        with ig_clients.user_lock(session["user_id"]):
+            cl = ig_clients.get(session["user_id"])
+            if cl is None:
+                cl = Client()
+                cl.delay_range = [1, 3]
+                cl.challenge_code_handler = lambda username, choice: None
 
-        try:
-            cl.login(insta_username, insta_password)
-            save_ig_settings(cur, session["user_id"], cl)  # cache session
-        except Exception as login_error:
-            if any(k in str(login_error).lower() for k in ["challenge", "otp", "verification", "2fa"]):
-                device_id = getattr(cl, "device_id", None) or generate_device_id()
-                guid = getattr(cl, "uuid", None) or str(py_uuid.uuid4())
-                challenge_ctx = getattr(cl, "challenge_context", None) or getattr(cl, "last_json", None)
+                try:
+                    cl.login(insta_username, insta_password)
+                    save_ig_settings(cur, session["user_id"], cl)  # cache session
+                except Exception as login_error:
+                    if any(k in str(login_error).lower() for k in ["challenge", "otp", "verification", "2fa"]):
+                        device_id = getattr(cl, "device_id", None) or generate_device_id()
+                        guid = getattr(cl, "uuid", None) or str(py_uuid.uuid4())
+                        challenge_ctx = getattr(cl, "challenge_context", None) or getattr(cl, "last_json", None)
+
+                        cur.execute(
+                            "UPDATE users SET ig_device_id=%s, ig_guid=%s, ig_challenge_context=%s WHERE id=%s",
+                            (device_id, guid, json_dumps_safe(challenge_ctx), session["user_id"]),
+                        )
+                        conn.commit()
+                        return jsonify({"success": False, "require_otp": True, "message": "OTP verification required"}), 401
+                    else:
+                        return jsonify({"success": False, "error": str(login_error)}), 500
+
+                ig_clients.put(session["user_id"], cl)
 
-                cur.execute(
-                    "UPDATE users SET ig_device_id=%s, ig_guid=%s, ig_challenge_context=%s WHERE id=%s",
-                    (device_id, guid, json_dumps_safe(challenge_ctx), session["user_id"]),
-                )
-                conn.commit()
-                return jsonify({"success": False, "require_otp": True, "message": "OTP verification required"}), 401
-            else:
-                return jsonify({"success": False, "error": str(login_error)}), 500
+            try:
+                res = cl.photo_upload(path=publish_image_path(session["user_id"], filename), caption=caption)
+            except Exception:
+                ig_clients.evict(session["user_id"])
+                raise
 
-        res = cl.photo_upload(path=image_path, caption=caption)
         shortcode = None
         if hasattr(res, "model_dump"):
             shortcode = res.model_dump().get("shortcode")
@@ -999,21 +2949,20 @@ def verify_otp():
 
         # Cache session for future (scheduled posts)
         save_ig_settings(cur, session["user_id"], cl)
+        ig_clients.put(session["user_id"], cl)
 
         if not filename:
             return jsonify({"success": True, "message": "OTP verified. Session saved."})
 
         # Verify user owns the file
-        if not verify_user_owns_file(session["user_id"], filename):
+        if not verify_user_owns_file(session["user_id"], filename, cur):
             return jsonify({"error": "Access denied"}), 403
 
-        # Get user-specific image path
-        user_image_dir = get_user_image_dir(session["user_id"])
-        image_path = os.path.join(user_image_dir, filename)
-        if not os.path.exists(image_path):
+        if not resolve_image_path(session["user_id"], filename):
             return jsonify({"error": "Image not found"}), 404
 
-        res = cl.photo_upload(path=image_path, caption=caption)
+        with ig_clients.user_lock(session["user_id"]):
+            res = cl.photo_upload(path=publish_image_path(session["user_id"], filename), caption=caption)
         shortcode = None
         if hasattr(res, "model_dump"):
             shortcode = res.model_dump().get("shortcode")
@@ -1100,14 +3049,34 @@ def get_image():
         return jsonify({"error": "Access denied"}), 403
         
     try:
-        # Get user-specific image directory
-        user_image_dir = get_user_image_dir(session["user_id"])
-        image_path = os.path.join(user_image_dir, filename)
-        if not os.path.exists(image_path):
+        image_path = resolve_image_path(session["user_id"], filename)
+        if not image_path:
             return jsonify({"error": "Image not found"}), 404
-            
-        with open(image_path, "rb") as f:
-            return f.read(), 200, {'Content-Type': 'image/png'}
+
+        # ?size=N serves a lazily built WebP thumbnail
+        size = request.args.get("size")
+        if size:
+            try:
+                size = thumbnail_size_for(int(size))
+            except ValueError:
+                return jsonify({"error": "size must be an integer"}), 400
+            thumb = thumbnail_path(session["user_id"], filename, size)
+            if not thumb:
+                return jsonify({"error": "Image not found"}), 404
+            return send_media(thumb, "image/webp")
+
+        # ?variant=thumb|ig|png serves a precomputed variant when it exists
+        content_type = 'image/png'
+        variant = request.args.get("variant")
+        fallback = False
+        if variant in IMAGE_VARIANTS:
+            path = variant_path(session["user_id"], filename, variant)
+            if path:
+                image_path, content_type = path, IMAGE_VARIANTS[variant][1]
+            else:
+                fallback = True  # the full PNG until the variant is built; don't let browsers pin it
+
+        return send_media(image_path, content_type, fallback=fallback)
     except Exception as e:
         logger.error(f"Get image error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -1123,27 +3092,40 @@ def get_caption():
         
     conn = get_db_connection(); cur = conn.cursor()
     try:
-        # Verify user owns the file
+        # Ownership check and current caption in one query
         cur.execute("""
-            SELECT caption_filename 
+            SELECT id, prompt, COALESCE(modified_caption, generated_caption), created_at,
+                   CASE WHEN caption_revision > 1 THEN updated_at END, caption_revision
             FROM activities 
             WHERE user_id=%s AND image_filename=%s
+            ORDER BY created_at DESC LIMIT 1
             """, 
             (session["user_id"], filename))
         row = cur.fetchone()
-        if not row or not row[0]:
+        if not row or row[2] is None:
             return jsonify({"error": "Caption not found"}), 404
-            
-        caption_filename = row[0]
-        # Get user-specific caption directory
-        user_caption_dir = get_user_caption_dir(session["user_id"])
-        caption_path = os.path.join(user_caption_dir, caption_filename)
-        if not os.path.exists(caption_path):
-            return jsonify({"error": "Caption file missing"}), 404
-            
-        with open(caption_path, 'r') as f:
-            caption_data = json.load(f)
-            
+
+        activity_id, prompt, caption, created_at, updated_at, revision = row
+        caption_data = {
+            "prompt": prompt,
+            "caption": caption,
+            "image_filename": filename,
+            "created_at": created_at.isoformat() if created_at else None,
+            "updated_at": updated_at.isoformat() if updated_at else None,
+            "revision": revision,
+        }
+        # ?history=1 adds every revision, oldest first
+        if request.args.get("history") in ("1", "true"):
+            cur.execute("""
+                SELECT revision, caption, source, created_at
+                FROM caption_revisions WHERE activity_id=%s ORDER BY revision
+                """, (activity_id,))
+            caption_data["revisions"] = [
+                {"revision": r[0], "caption": r[1], "source": r[2],
+                 "created_at": r[3].isoformat() if r[3] else None}
+                for r in cur.fetchall()
+            ]
+
         return jsonify({"success": True, "caption": caption_data})
         
     except Exception as e:
@@ -1153,19 +3135,18 @@ def get_caption():
         cur.close()
         conn.close()
 
+SCHEDULED_POSTS_SQL = """
+    SELECT id, caption, image_filename, scheduled_time, status, error_message, platform
+    FROM scheduled_posts WHERE user_id=%s ORDER BY scheduled_time ASC
+"""
+
 @app.route("/api/scheduled-posts", methods=["GET"])
 def get_scheduled_posts():
     if "user_id" not in session:
         return jsonify({"success": False, "error": "Unauthorized"}), 401
     conn = get_db_connection(); cur = conn.cursor()
     try:
-        cur.execute(
-            """
-            SELECT id, caption, image_filename, scheduled_time, status, error_message, platform
-            FROM scheduled_posts WHERE user_id=%s ORDER BY scheduled_time ASC
-            """,
-            (session["user_id"],),
-        )
+        cur.execute(SCHEDULED_POSTS_SQL, (session["user_id"],))
         posts = []
         for row in cur.fetchall():
             posts.append({
@@ -1202,13 +3183,13 @@ def schedule_post():
     except ValueError:
         return jsonify({"success": False, "error": "Invalid datetime format"}), 400
 
-    # Verify user owns the file
-    if filename and not verify_user_owns_file(session["user_id"], filename):
-        return jsonify({"success": False, "error": "Access denied"}), 403
-
     # Ensure session is ready (front-end should call /api/ig-session/prepare first)
     conn = get_db_connection(); cur = conn.cursor()
     try:
+        # Verify user owns the file
+        if filename and not verify_user_owns_file(session["user_id"], filename, cur):
+            return jsonify({"success": False, "error": "Access denied"}), 403
+
         # sanity: do we have session cached?
         settings = load_ig_settings(cur, session["user_id"])
         if not settings:
@@ -1221,6 +3202,7 @@ def schedule_post():
             """,
             (session["user_id"], caption, filename, scheduled_dt, platform),
         )
+        notify_scheduler(cur, "upsert", cur.fetchone()[0])
         conn.commit()
         return jsonify({"success": True, "message": "Post scheduled successfully"})
     except Exception as e:
@@ -1238,6 +3220,7 @@ def delete_scheduled_post(post_id):
         cur.execute("DELETE FROM scheduled_posts WHERE id=%s AND user_id=%s RETURNING id", (post_id, session["user_id"]))
         if cur.rowcount == 0:
             return jsonify({"success": False, "error": "Post not found or access denied"}), 404
+        notify_scheduler(cur, "delete", post_id)
         conn.commit()
         return jsonify({"success": True, "message": "Scheduled post deleted"})
     except Exception as e:
@@ -1256,78 +3239,125 @@ def update_caption():
     if not filename:
         return jsonify({"error": "Filename required"}), 400
         
-    # Verify user owns the file
-    if not verify_user_owns_file(session["user_id"], filename):
-        return jsonify({"error": "Access denied"}), 403
-        
     conn = get_db_connection(); cur = conn.cursor()
     try:
-        # Get existing caption filename
-        cur.execute("SELECT caption_filename FROM activities WHERE user_id=%s AND image_filename=%s", 
-                   (session["user_id"], filename))
-        row = cur.fetchone()
-        caption_filename = row[0] if row else None
-        
-        # Create new caption file if doesn't exist
-        if not caption_filename:
-            # Get prompt for new caption file
-            cur.execute("SELECT prompt FROM activities WHERE user_id=%s AND image_filename=%s", 
-                       (session["user_id"], filename))
-            prompt_row = cur.fetchone()
-            prompt_text = prompt_row[0] if prompt_row else ""
-            
-            # Create new caption file
-            caption_filename = save_caption_file(session["user_id"], filename, prompt_text, new_caption)
-        else:
-            # Update existing caption file
-            update_caption_file(session["user_id"], caption_filename, new_caption)
-        
-        # Update database
-        cur.execute("""
-            UPDATE activities 
-            SET modified_caption=%s, caption_filename=%s 
-            WHERE user_id=%s AND image_filename=%s
-            """, 
-            (new_caption, caption_filename, session["user_id"], filename))
-        
+        # Only matches the user's own image, so this is the ownership check too
+        revision = save_caption_revision(cur, session["user_id"], filename, new_caption)
+        if revision is None:
+            return jsonify({"error": "Access denied"}), 403
+
         conn.commit()
-        return jsonify({"success": True})
+        return jsonify({"success": True, "revision": revision})
     except Exception as e:
         logger.error(f"Update caption error: {e}")
         return jsonify({"error": str(e)}), 500
     finally:
         cur.close(); conn.close()
 
+HISTORY_DEFAULT_LIMIT = 5
+HISTORY_MAX_LIMIT = 500
+
+def encode_history_cursor(created_at, activity_id):
+    raw = f"{created_at.isoformat()}|{activity_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor):
+    """Raises ValueError on a malformed cursor"""
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, _, activity_id = raw.partition("|")
+    return datetime.fromisoformat(created_at), int(activity_id)
+
+def _bool_arg(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    raise ValueError(f"{name} must be true or false")
+
+HISTORY_SQL = """
+    SELECT id, prompt, image_filename, COALESCE(modified_caption, generated_caption),
+           created_at, was_posted, was_downloaded
+    FROM activities WHERE {where}
+    ORDER BY created_at DESC, id DESC LIMIT %s
+"""
+
+def history_query(user_id, args):
+    """
+    Build the /api/history query from limit, cursor, since, until, posted,
+    downloaded and q in `args` (a mapping like request.args).
+    Returns (sql, params, limit); raises ValueError on bad input.
+    """
+    limit = min(max(int(args.get("limit", HISTORY_DEFAULT_LIMIT)), 1), HISTORY_MAX_LIMIT)
+    clauses, params = ["user_id=%s"], [user_id]
+
+    if args.get("cursor"):
+        clauses.append("(created_at, id) < (%s, %s)")
+        params.extend(decode_history_cursor(args["cursor"]))
+    if args.get("since"):
+        clauses.append("created_at >= %s")
+        params.append(datetime.fromisoformat(args["since"]))
+    if args.get("until"):
+        clauses.append("created_at < %s")
+        params.append(datetime.fromisoformat(args["until"]))
+    for name, column in (("posted", "was_posted"), ("downloaded", "was_downloaded")):
+        flag = _bool_arg(args, name)
+        if flag is not None:
+            clauses.append(f"COALESCE({column}, FALSE)=%s")
+            params.append(flag)
+    if args.get("q", "").strip():
+        clauses.append(HISTORY_SEARCH_SQL + " @@ websearch_to_tsquery('simple', %s)")
+        params.append(args["q"].strip())
+
+    params.append(limit + 1)  # one extra row tells us whether there's a next page
+    return HISTORY_SQL.format(where=" AND ".join(clauses)), params, limit
+
 @app.route("/api/history", methods=["GET"])
 def get_history():
     if "user_id" not in session:
         return jsonify({"error": "Unauthorized"}), 401
+    try:
+        sql, params, limit = history_query(session["user_id"], request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid history query: {e}"}), 400
+
+    # The page is keyset-limited, so read it whole: errors still get a proper
+    # status, and the pooled connection is back before the client reads a byte
     conn = get_db_connection(); cur = conn.cursor()
     try:
-        cur.execute(
-            """
-            SELECT id, prompt, image_filename, generated_caption, caption_filename, created_at
-            FROM activities WHERE user_id=%s ORDER BY created_at DESC LIMIT 5
-            """,
-            (session["user_id"],),
-        )
-        history = []
-        for row in cur.fetchall():
-            history.append({
-                "id": row[0],
-                "prompt": row[1],
-                "filename": row[2],
-                "caption": row[3],
-                "caption_filename": row[4],
-                "created_at": row[5].isoformat(),
-            })
-        return jsonify({"success": True, "history": history})
+        cur.execute(sql, params)
+        rows = cur.fetchall()
     except Exception as e:
         logger.error(f"Get history error: {e}")
         return jsonify({"error": str(e)}), 500
     finally:
         cur.close(); conn.close()
 
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_history_cursor(rows[-1][4], rows[-1][0]) if has_more else None
+    # The carousel fetches these images next; spare it the ownership queries
+    ownership_cache.add_many(session["user_id"], [row[2] for row in rows])
+
+    def generate_json():
+        # Rows are serialized one at a time instead of building the whole document for jsonify
+        yield '{"success": true, "history": ['
+        for i, row in enumerate(rows):
+            yield ("," if i else "") + json.dumps({
+                "id": row[0],
+                "prompt": row[1],
+                "filename": row[2],
+                "caption": row[3],
+                "created_at": row[4].isoformat(),
+                "was_posted": bool(row[5]),
+                "was_downloaded": bool(row[6]),
+            })
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+    return Response(generate_json(), mimetype="application/json")
+
 @app.route("/api/record-download", methods=["POST"])
 def record_download():
     if "user_id" not in session:
@@ -1336,12 +3366,12 @@ def record_download():
     if not filename:
         return jsonify({"error": "Filename required"}), 400
         
-    # Verify user owns the file
-    if not verify_user_owns_file(session["user_id"], filename):
-        return jsonify({"error": "Access denied"}), 403
-        
     conn = get_db_connection(); cur = conn.cursor()
     try:
+        # Verify user owns the file
+        if not verify_user_owns_file(session["user_id"], filename, cur):
+            return jsonify({"error": "Access denied"}), 403
+
         cur.execute("UPDATE activities SET was_downloaded=TRUE, download_time=CURRENT_TIMESTAMP WHERE user_id=%s AND image_filename=%s", (session["user_id"], filename))
         conn.commit()
         return jsonify({"success": True})
@@ -1351,124 +3381,1901 @@ def record_download():
     finally:
         cur.close(); conn.close()
 
+# Operator-only: Authorization: Bearer $METRICS_TOKEN, or from the host itself when no token is set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def metrics_access_allowed():
+    if METRICS_TOKEN:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    if not metrics_access_allowed():
+        return jsonify({"error": "Forbidden"}), 403
+    with _generation_lock:
+        generation = {
+            "workers": GENERATION_WORKERS,
+            "active_jobs": sum(_generation_active.values()),
+            "active_users": len(_generation_active),
+        }
+    return jsonify({
+        "db_pool": db_pool.stats(),
+        "generation": generation,
+        "graph_cache": graph_cache.stats(),
+        "graph_client": graph_client.stats(),
+        "scheduler": post_dispatcher.stats(),
+        "ig_clients": ig_clients.stats(),
+        "ownership_cache": ownership_cache.stats(),
+        "alert_stream": alert_broadcaster.stats(),
+        "account_sync": account_sync.stats(),
+        "graph_credentials": graph_credentials.stats(),
+    })
+
 @app.route("/api/logout", methods=["POST"])
 def logout():
     session.clear()
     return jsonify({"success": True, "message": "Logged out"}), 200
 
 
-# --- 1. Followers & Media Count ---
-@app.route("/api/analytics")
-def get_analytics():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}?fields=followers_count,media_count&access_token={ACCESS_TOKEN}"
-    response = requests.get(url)
-    return jsonify(response.json())
+# --------------------------------------------------
+# Graph API client
+# --------------------------------------------------
+GRAPH_API_BASE = "https://graph.facebook.com/v23.0"
+GRAPH_TIMEOUT = (3.05, 20)  # (connect, read) seconds per call
+GRAPH_POOL_SIZE = int(os.getenv("GRAPH_POOL_SIZE", "16"))
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "4"))
+GRAPH_BACKOFF_BASE = 0.5    # seconds, doubled per attempt
+GRAPH_BACKOFF_MAX = 30.0
+GRAPH_THROTTLE_SOFT = 75    # % of quota where we start spacing out calls
+GRAPH_THROTTLE_HARD = 95    # % of quota where we pause until it recovers
+GRAPH_THROTTLE_MAX_DELAY = 5.0
+GRAPH_RETRY_AFTER_MAX = 60.0    # cap on a server-sent Retry-After
+GRAPH_CALL_DEADLINE = float(os.getenv("GRAPH_CALL_DEADLINE", "20"))                  # request-path calls
+GRAPH_PATIENT_CALL_DEADLINE = float(os.getenv("GRAPH_PATIENT_CALL_DEADLINE", "300"))  # background jobs
+
+# Graph error codes that mean "rate limited" or "transient, try again"
+GRAPH_RATE_LIMIT_CODES = {4, 17, 32, 613} | set(range(80000, 80015))
+GRAPH_TRANSIENT_CODES = {1, 2}
+
+GRAPH_TRACKED_ACCOUNTS = 10000   # per-account quota states kept (LRU)
+GRAPH_NO_CREDENTIALS = "no_credentials"
+GRAPH_RATE_LIMITED = "rate_limited"   # we're blocked locally; the call wasn't sent
+
+class _QuotaState:
+    """Last usage % Meta reported for one quota: the app's, or one account's business use case"""
+    __slots__ = ("usage", "usage_at", "blocked_until")
+
+    def __init__(self):
+        self.usage = 0.0
+        self.usage_at = 0.0
+        self.blocked_until = 0.0    # set from estimated_time_to_regain_access
+
+    def delay(self, now):
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if now - self.usage_at > 300 or self.usage < GRAPH_THROTTLE_SOFT:
+            return 0
+        if self.usage >= GRAPH_THROTTLE_HARD:
+            return GRAPH_THROTTLE_MAX_DELAY
+        return GRAPH_THROTTLE_MAX_DELAY * (self.usage - GRAPH_THROTTLE_SOFT) / (GRAPH_THROTTLE_HARD - GRAPH_THROTTLE_SOFT)
+
+class GraphClient:
+    """
+    graph.facebook.com client: pooled keep-alive session, connect/read
+    timeouts, and exponential backoff with jitter. Every call names the
+    account it is for; `token_for(account_id)` supplies that account's
+    access token. x-app-usage feeds one app-wide quota and
+    x-business-use-case-usage a per-account one, and the client slows
+    itself down before Meta starts rejecting calls, so one busy account
+    only throttles itself.
+    """
+    def __init__(self, base_url, token_for, pool_size=GRAPH_POOL_SIZE, timeout=GRAPH_TIMEOUT,
+                 max_retries=GRAPH_MAX_RETRIES):
+        self.base_url = base_url
+        self.token_for = token_for
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        self._lock = threading.Lock()
+        self._app_quota = _QuotaState()
+        self._account_quotas = OrderedDict()  # account_id -> _QuotaState
+        self._stats = {"requests": 0, "retries": 0, "throttled": 0, "throttle_wait_s": 0.0, "rate_limited": 0,
+                       "failures": 0, "fast_failed": 0}
+
+    def get(self, account_id, path, access_token=None, patient=False, **params):
+        """
+        GET {base_url}/{path} on behalf of account_id and return the parsed
+        JSON (Graph error payloads included). access_token overrides the
+        stored one, e.g. to verify credentials before saving them.
+        Default (request-path) calls return rate-limit errors as they come
+        and fail fast while Meta has us blocked; patient=True (background
+        jobs) retries and waits those out. Either way a call gives up at
+        its deadline.
+        """
+        access_token = access_token or self.token_for(account_id)
+        if not access_token:
+            return {"error": {"message": f"No Graph API credentials for account {account_id}",
+                              "code": GRAPH_NO_CREDENTIALS}}
+        url = f"{self.base_url}/{path}"
+        params = {**params, "access_token": access_token}
+        deadline = time.monotonic() + (GRAPH_PATIENT_CALL_DEADLINE if patient else GRAPH_CALL_DEADLINE)
+        attempt = 0
+        while True:
+            blocked = self._throttle(account_id, deadline, patient)
+            if blocked:
+                with self._lock:
+                    self._stats["fast_failed"] += 1
+                return {"error": {"message": f"Graph API rate limit reached, retry in {int(blocked) + 1}s",
+                                  "code": GRAPH_RATE_LIMITED, "retry_after": int(blocked) + 1}}
+            with self._lock:
+                self._stats["requests"] += 1
+            failure, retry_after = None, None
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                self._record_usage(account_id, response.headers)
+                payload = response.json()
+            except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+                failure = e
+                logger.warning(f"Graph GET {path} failed ({e})")
+            else:
+                error = payload.get("error") if isinstance(payload, dict) else None
+                code = error.get("code") if isinstance(error, dict) else None
+                rate_limited = code in GRAPH_RATE_LIMIT_CODES or response.status_code == 429
+                transient = code in GRAPH_TRANSIENT_CODES or response.status_code >= 500
+                if not (rate_limited or transient):
+                    return payload
+                if rate_limited:
+                    with self._lock:
+                        self._stats["rate_limited"] += 1
+                    if not patient:
+                        return payload
+                retry_after = response.headers.get("Retry-After")
+                logger.warning(f"Graph GET {path} returned {response.status_code} (code {code})")
+
+            delay = min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF_BASE * (2 ** attempt)) * random.uniform(0.5, 1.0)
+            if retry_after:
+                try:
+                    delay = max(delay, min(float(retry_after), GRAPH_RETRY_AFTER_MAX))
+                except ValueError:
+                    pass
+            if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+                with self._lock:
+                    self._stats["failures"] += 1
+                if failure:
+                    raise failure
+                return payload
+            attempt += 1
+            with self._lock:
+                self._stats["retries"] += 1
+            time.sleep(delay)
+
+    def _quota(self, account_id):
+        """Caller holds self._lock"""
+        quota = self._account_quotas.get(account_id)
+        if quota is None:
+            quota = self._account_quotas[account_id] = _QuotaState()
+            if len(self._account_quotas) > GRAPH_TRACKED_ACCOUNTS:
+                self._account_quotas.popitem(last=False)
+        else:
+            self._account_quotas.move_to_end(account_id)
+        return quota
+
+    def _throttle(self, account_id, deadline, patient):
+        """
+        Space calls out as quotas fill up. Returns 0 when the call may go
+        ahead, or the seconds left on a block it must not wait out.
+        """
+        with self._lock:
+            now = time.monotonic()
+            quota = self._quota(account_id)
+            blocked_until = max(self._app_quota.blocked_until, quota.blocked_until)
+            if blocked_until > now and (not patient or blocked_until > deadline):
+                return blocked_until - now
+            delay = min(max(self._app_quota.delay(now), quota.delay(now)), max(deadline - now, 0))
+            if delay:
+                self._stats["throttled"] += 1
+                self._stats["throttle_wait_s"] += delay
+        if delay:
+            time.sleep(delay)
+        return 0
+
+    def _record_usage(self, account_id, headers):
+        app_usage = json_loads_safe(headers.get("x-app-usage"))
+        buc_usage = json_loads_safe(headers.get("x-business-use-case-usage"))
+        now = time.monotonic()
+        with self._lock:
+            if isinstance(app_usage, dict):
+                self._app_quota.usage = max([float(v) for v in app_usage.values() if isinstance(v, (int, float))] or [0.0])
+                self._app_quota.usage_at = now
+            if isinstance(buc_usage, dict):
+                usage, regain_minutes = 0.0, 0
+                for entries in buc_usage.values():
+                    for entry in entries or []:
+                        pcts = [float(entry.get(k) or 0) for k in ("call_count", "total_cputime", "total_time")]
+                        usage = max([usage] + pcts)
+                        regain_minutes = max(regain_minutes, entry.get("estimated_time_to_regain_access") or 0)
+                quota = self._quota(account_id)
+                quota.usage, quota.usage_at = usage, now
+                if regain_minutes:
+                    quota.blocked_until = max(quota.blocked_until, now + regain_minutes * 60)
+
+    def blocked_for(self, account_id):
+        """Seconds until Meta lets calls for this account (or the whole app) through again"""
+        with self._lock:
+            now = time.monotonic()
+            quota = self._account_quotas.get(account_id)
+            blocked_until = max(self._app_quota.blocked_until, quota.blocked_until if quota else 0.0)
+        return max(0.0, blocked_until - now)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            stats = dict(self._stats)
+            stats["usage_pct"] = self._app_quota.usage
+            stats["blocked_for_s"] = max(0.0, self._app_quota.blocked_until - now)
+            stats["accounts_tracked"] = len(self._account_quotas)
+            stats["accounts_blocked"] = sum(1 for q in self._account_quotas.values() if q.blocked_until > now)
+        return stats
+
+graph_client = GraphClient(GRAPH_API_BASE, lambda account_id: graph_token(account_id))
 
-# --- 2. Posts with likes & comments ---
-@app.route("/api/posts")
-def get_posts():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=id,caption,like_count,comments_count,media_type,media_url,timestamp&access_token={ACCESS_TOKEN}"
-    response = requests.get(url)
-    return jsonify(response.json())
+# --------------------------------------------------
+# Graph API response cache
+# --------------------------------------------------
+GRAPH_CACHE_MAX_BYTES = int(os.getenv("GRAPH_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+GRAPH_CACHE_STALE_SECONDS = int(os.getenv("GRAPH_CACHE_STALE_SECONDS", "600"))
+GRAPH_CACHE_DEFAULT_TTL = 300
+
+# Per-metric TTLs (seconds). Lifetime audience breakdowns barely move;
+# daily insights are only recomputed by Meta a few times a day.
+GRAPH_METRIC_TTLS = {
+    "follower_count": 900,
+    "reach": 900,
+    "impressions": 900,
+    "profile_views": 900,
+    "website_clicks": 900,
+    "audience_age_gender": 86400,
+    "audience_gender_age": 86400,
+    "audience_gender": 86400,
+    "audience_city": 86400,
+    "audience_country": 86400,
+}
+GRAPH_FIELD_TTLS = {
+    "username": 3600,
+    "profile_picture_url": 3600,
+    "followers_count": 300,
+    "media_count": 300,
+    "like_count": 120,
+    "comments_count": 120,
+}
 
-# --- 3. Profile Views (new implementation) ---
-@app.route("/api/profile-views")
-def get_profile_views():
-    profile_views_data = {"today": 0, "last_30_days": 0}
+class TTLCache:
+    """
+    Thread-safe TTL cache with LRU eviction under a byte budget.
+    Entries past their TTL but inside the stale window are served immediately
+    while a single background refresh reloads them (stale-while-revalidate).
+    """
+    def __init__(self, max_bytes, stale_seconds, refresh_workers=2):
+        self._max_bytes = max_bytes
+        self._stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, fresh_until, stale_until)
+        self._bytes = 0
+        self._loading = {}             # key -> threading.Event (single-flight loads)
+        self._refreshing = set()
+        self._refresher = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix="cache-refresh")
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0, "evictions": 0}
+
+    def get(self, key, loader, ttl, cacheable=lambda value: True):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and now < entry[3]:
+                    self._entries.move_to_end(key)
+                    if now < entry[2]:
+                        self._stats["hits"] += 1
+                        return entry[0]
+                    self._stats["stale_hits"] += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        self._refresher.submit(self._refresh, key, loader, ttl, cacheable)
+                    return entry[0]
+                pending = self._loading.get(key)
+                if pending is None:
+                    self._stats["misses"] += 1
+                    pending = self._loading[key] = threading.Event()
+                    break
+            # Another thread is loading the same key; wait for it and re-check
+            pending.wait(30)
 
-    try:
-        base_url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights"
-        until_date = datetime.datetime.now()
-        since_date = until_date - timedelta(days=30)
+        try:
+            value = loader()
+            if cacheable(value):
+                self._store(key, value, ttl)
+            return value
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            pending.set()
 
-        # Convert to UNIX timestamp
-        since_ts = int(since_date.timestamp())
-        until_ts = int(until_date.timestamp())
+    def _refresh(self, key, loader, ttl, cacheable):
+        try:
+            value = loader()
+            if cacheable(value):
+                self._store(key, value, ttl)
+            with self._lock:
+                self._stats["refreshes"] += 1
+        except Exception as e:
+            logger.warning(f"Cache refresh failed for {key}: {e}")
+            with self._lock:
+                self._stats["refresh_errors"] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key, value, ttl):
+        size = value.nbytes if hasattr(value, "nbytes") else len(json.dumps(value, default=str))
+        if size > self._max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, now + ttl, now + ttl + self._stale_seconds)
+            self._bytes += size
+            while self._bytes > self._max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[1]
+                self._stats["evictions"] += 1
+
+    def peek(self, key):
+        """Cached value however old (None if absent); doesn't count as a lookup"""
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def invalidate(self, predicate=None):
+        with self._lock:
+            for key in [k for k in self._entries if predicate is None or predicate(k)]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["max_bytes"] = self._max_bytes
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["hit_rate"] = ((stats["hits"] + stats["stale_hits"]) / lookups) if lookups else 0.0
+        return stats
+
+graph_cache = TTLCache(GRAPH_CACHE_MAX_BYTES, GRAPH_CACHE_STALE_SECONDS)
+
+def graph_cache_ttl(params):
+    """Shortest TTL among the requested metrics/fields"""
+    if params.get("period") == "lifetime":
+        return 86400
+    names = []
+    for key in ("metric", "fields"):
+        if params.get(key):
+            names += [n.split(".")[0].strip() for n in params[key].split(",")]
+    ttls = [GRAPH_METRIC_TTLS.get(n) or GRAPH_FIELD_TTLS.get(n) for n in names]
+    ttls = [t for t in ttls if t]
+    return min(ttls) if ttls else GRAPH_CACHE_DEFAULT_TTL
+
+def graph_get(account_id, path, **params):
+    """
+    GET {GRAPH_API_BASE}/{path} for account_id and return the parsed JSON,
+    through graph_cache. Keyed on (account_id, path, params), so accounts
+    never see each other's entries and can be invalidated as a whole.
+    """
+    key = (account_id, path, tuple(sorted((k, str(v)) for k, v in params.items())))
+    value = graph_cache.get(
+        key, lambda: graph_fetch(account_id, path, **params), graph_cache_ttl(params),
+        cacheable=lambda value: not (isinstance(value, dict) and "error" in value),
+    )
+    if is_rate_limit_error(value):
+        # Rather an old answer than none while Meta has us throttled
+        stale = graph_cache.peek(key)
+        if stale is not None:
+            return stale
+    return value
+
+def is_rate_limit_error(payload):
+    error = payload.get("error") if isinstance(payload, dict) else None
+    return isinstance(error, dict) and (error.get("code") in GRAPH_RATE_LIMIT_CODES or error.get("code") == GRAPH_RATE_LIMITED)
+
+def graph_fetch(account_id, path, patient=False, **params):
+    """Uncached GET {GRAPH_API_BASE}/{path} with account_id's token; patient=True for background jobs"""
+    return graph_client.get(account_id, path, patient=patient, **params)
+
+def forget_graph_account(account_id):
+    """Drop every cached Graph response for an account"""
+    graph_cache.invalidate(lambda key: key[0] == account_id)
 
-        profile_views_url = (
-            f"{base_url}?metric=profile_views&period=day"
-            f"&metric_type=total_value"  # <-- REQUIRED!
-            f"&since={since_ts}&until={until_ts}&access_token={ACCESS_TOKEN}"
-        )
-        res = requests.get(profile_views_url).json()
-        print("Profile views API response:", res)
+# --------------------------------------------------
+# Graph credentials (per user)
+# --------------------------------------------------
+# Users connect their own Instagram business account; the token is stored
+# Fernet-encrypted on users next to the instagrapi fields. Requests act on
+# the logged-in user's account and Graph calls look the token up by
+# account id. ACCESS_TOKEN / IG_USER_ID are the default account, offered to
+# users who haven't connected one only if GRAPH_DEFAULT_ACCOUNT_FOR_ALL is set.
+# Connect/disconnect NOTIFY every instance to drop its cached credentials;
+# the TTL only bounds staleness while a listener is reconnecting.
+GRAPH_CREDENTIALS_TTL = 60
+GRAPH_CREDENTIALS_CHANNEL = "graph_credentials"
+
+graph_credentials = TTLCache(1024 * 1024, 0)  # ("user", id) -> account id, ("token", account id) -> token
+
+GRAPH_TOKEN_SQL = """
+    SELECT graph_access_token FROM users
+    WHERE graph_account_id=%s AND graph_access_token IS NOT NULL
+      AND (graph_token_expires_at IS NULL OR graph_token_expires_at > NOW())
+    ORDER BY graph_updated_at DESC NULLS LAST LIMIT 1
+"""
+
+def _load_graph_token(account_id):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(GRAPH_TOKEN_SQL, (account_id,))
+        row = cur.fetchone()
+        cur.close()
+    return decrypt_data(row[0]) if row else None
 
-        if "data" in res and res["data"]:
-            values = res["data"][0].get("values", [])
-            if values:
-                profile_views_data["last_30_days"] = sum(v.get("value", 0) for v in values)
-                profile_views_data["today"] = values[-1].get("value", 0)
+def graph_token(account_id):
+    """Access token for an account: the most recently connected user's, else the default account's"""
+    token = graph_credentials.get(("token", account_id), lambda: _load_graph_token(account_id), GRAPH_CREDENTIALS_TTL)
+    if not token and account_id == IG_BUSINESS_ID:
+        return ACCESS_TOKEN
+    return token
 
-    except Exception as e:
-        print(f"Error fetching profile views: {e}")
+def _load_user_graph_account(user_id):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT graph_account_id FROM users WHERE id=%s AND graph_access_token IS NOT NULL", (user_id,))
+        row = cur.fetchone()
+        cur.close()
+    return row[0] if row else None
+
+def default_graph_account_id():
+    """The env account if it's configured and opted in for everyone, else None"""
+    if GRAPH_DEFAULT_ACCOUNT_FOR_ALL and IG_BUSINESS_ID and ACCESS_TOKEN:
+        return IG_BUSINESS_ID
+    return None
 
-    return jsonify(profile_views_data)
+def current_graph_account_id():
+    """The logged-in user's connected account, else the opted-in default; None if neither exists"""
+    account_id = None
+    if "user_id" in session:
+        user_id = session["user_id"]
+        account_id = graph_credentials.get(("user", user_id), lambda: _load_user_graph_account(user_id),
+                                           GRAPH_CREDENTIALS_TTL)
+    return account_id or default_graph_account_id()
+
+def no_graph_account():
+    return jsonify({"error": "No Instagram business account connected"}), 409
+
+def _forget_graph_credentials(user_id, *account_ids):
+    keys = {("user", user_id)} | {("token", a) for a in account_ids if a}
+    graph_credentials.invalidate(lambda key: key in keys)
+
+def notify_graph_credentials(cur, user_id, *account_ids):
+    """Tell every instance to forget these credentials (delivered when the caller's transaction commits)"""
+    payload = f"{user_id}:{','.join(a for a in account_ids if a)}"
+    cur.execute("SELECT pg_notify(%s, %s)", (GRAPH_CREDENTIALS_CHANNEL, payload))
+
+class GraphCredentialsListener:
+    """LISTENs for credential changes made on any instance and drops them from this one's caches"""
+    def __init__(self):
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="graph-credentials-listener", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**DB_CONFIG)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {GRAPH_CREDENTIALS_CHANNEL}")
+                # Changes made while we weren't listening are unknown; start clean
+                graph_credentials.invalidate()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._on_notify(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f"Graph credentials listener error: {e}")
+                time.sleep(5)
+            finally:
+                if conn:
+                    conn.close()
+
+    def _on_notify(self, payload):
+        user_id, _, account_ids = payload.partition(":")
+        account_ids = [a for a in account_ids.split(",") if a]
+        _forget_graph_credentials(int(user_id), *account_ids)
+        for account_id in account_ids:
+            forget_graph_account(account_id)
+
+graph_credentials_listener = GraphCredentialsListener()
+
+@app.route("/api/graph-account", methods=["GET"])
+def get_graph_account():
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    conn = get_db_connection(); cur = conn.cursor()
+    try:
+        cur.execute(
+            "SELECT graph_account_id, graph_token_expires_at FROM users WHERE id=%s AND graph_access_token IS NOT NULL",
+            (session["user_id"],),
+        )
+        row = cur.fetchone()
+    finally:
+        cur.close(); conn.close()
+    if row:
+        return jsonify({"connected": True, "source": "user", "account_id": row[0],
+                        "expires_at": row[1].isoformat() if row[1] else None})
+    default = default_graph_account_id()
+    return jsonify({"connected": default is not None, "source": "default", "account_id": default})
+
+@app.route("/api/graph-account", methods=["PUT"])
+def connect_graph_account():
+    """{account_id, access_token, expires_at?}: checked against Graph, stored encrypted, synced right away"""
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    account_id = str(data.get("account_id") or "").strip()
+    access_token = (data.get("access_token") or "").strip()
+    if not account_id.isdigit() or not access_token:
+        return jsonify({"success": False, "error": "account_id and access_token are required"}), 400
+    expires_at = None
+    if data.get("expires_at"):
+        try:
+            expires_at = datetime.fromisoformat(data["expires_at"])
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "expires_at must be an ISO timestamp"}), 400
 
+    profile = graph_client.get(account_id, account_id, access_token=access_token, fields="id,username")
+    if "error" in profile:
+        return jsonify({"success": False, "error": profile["error"]}), 400
+    if str(profile.get("id")) != account_id:
+        return jsonify({"success": False, "error": "access_token does not belong to account_id"}), 400
 
-# --- 4. Insights: reach & impressions ---
-@app.route("/api/insights")
-def get_insights():
+    conn = get_db_connection(); cur = conn.cursor()
     try:
-        url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=reach,impressions&period=day&access_token={ACCESS_TOKEN}"
-        response = requests.get(url).json()
+        cur.execute("SELECT graph_account_id FROM users WHERE id=%s", (session["user_id"],))
+        row = cur.fetchone()
+        if not row:
+            return jsonify({"success": False, "error": "User not found"}), 404
+        cur.execute(
+            """
+            UPDATE users SET graph_account_id=%s, graph_access_token=%s, graph_token_expires_at=%s,
+                   graph_updated_at=CURRENT_TIMESTAMP
+            WHERE id=%s
+            """,
+            (account_id, encrypt_data(access_token), expires_at, session["user_id"]),
+        )
+        register_account_sync(cur, account_id, immediate=True)
+        notify_graph_credentials(cur, session["user_id"], row[0], account_id)
+        conn.commit()
     except Exception as e:
-        response = {"data": [], "error": str(e)}
-    return jsonify(response)
+        conn.rollback()
+        logger.error(f"Connect Graph account error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+    finally:
+        cur.close(); conn.close()
 
-# --- 5. User Profile Info ---
-@app.route("/api/profile")
-def get_profile():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}?fields=username,profile_picture_url&access_token={ACCESS_TOKEN}"
-    response = requests.get(url)
-    return jsonify(response.json())
+    _forget_graph_credentials(session["user_id"], row[0], account_id)
+    forget_graph_account(account_id)
+    return jsonify({"success": True, "account_id": account_id, "username": profile.get("username")})
 
-# --- 6. Followers Growth ---
-@app.route("/api/followers-growth")
-def get_followers_growth():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=follower_count&period=day&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    if "data" in response and response["data"]:
-        return jsonify(response)
-    return jsonify({"data": []})
+@app.route("/api/graph-account", methods=["DELETE"])
+def disconnect_graph_account():
+    if "user_id" not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 401
+    conn = get_db_connection(); cur = conn.cursor()
+    try:
+        cur.execute("SELECT graph_account_id FROM users WHERE id=%s", (session["user_id"],))
+        row = cur.fetchone()
+        cur.execute(
+            """
+            UPDATE users SET graph_account_id=NULL, graph_access_token=NULL, graph_token_expires_at=NULL,
+                   graph_updated_at=CURRENT_TIMESTAMP
+            WHERE id=%s
+            """,
+            (session["user_id"],),
+        )
+        notify_graph_credentials(cur, session["user_id"], row[0] if row else None)
+        conn.commit()
+    finally:
+        cur.close(); conn.close()
+    account_id = row[0] if row else None
+    _forget_graph_credentials(session["user_id"], account_id)
+    if account_id:
+        forget_graph_account(account_id)
+    return jsonify({"success": True})
 
-# --- 7. Engagement by Day ---
-@app.route("/api/engagement-by-day")
-def get_engagement_by_day():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=id,timestamp,like_count,comments_count&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
+# --------------------------------------------------
+# Concurrent Graph fan-out
+# --------------------------------------------------
+GRAPH_FANOUT_WORKERS = int(os.getenv("GRAPH_FANOUT_WORKERS", "8"))
+GRAPH_FANOUT_TIMEOUT = float(os.getenv("GRAPH_FANOUT_TIMEOUT", "25"))
+GRAPH_IDS_BATCH = 50        # max ids per ?ids= lookup
 
-    engagement_by_day = defaultdict(int)
-    for post in response.get("data", []):
-        day = datetime.datetime.fromisoformat(post["timestamp"].replace("Z", "+00:00")).strftime("%A")
-        engagement_by_day[day] += post.get("like_count", 0) + post.get("comments_count", 0)
+graph_executor = ThreadPoolExecutor(max_workers=GRAPH_FANOUT_WORKERS, thread_name_prefix="graph")
 
-    return jsonify(engagement_by_day)
+def graph_fanout(calls, timeout=GRAPH_FANOUT_TIMEOUT):
+    """
+    Run {name: callable} concurrently on graph_executor.
+    Returns (results, errors); a Graph error payload counts as a failure.
+    Don't call from inside a fan-out task — the executor is bounded.
+    """
+    futures = {name: graph_executor.submit(fn) for name, fn in calls.items()}
+    deadline = time.monotonic() + timeout
+    results, errors = {}, {}
+    for name, future in futures.items():
+        try:
+            value = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            future.cancel()
+            errors[name] = "timed out"
+            continue
+        except Exception as e:
+            errors[name] = str(e)
+            continue
+        if isinstance(value, dict) and "error" in value:
+            errors[name] = value["error"]
+        else:
+            results[name] = value
+    return results, errors
 
-@app.route("/api/audience-age")
-def get_audience_age():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=audience_age_gender&period=lifetime&access_token={ACCESS_TOKEN}"
-    response = requests.get(url)
-    return jsonify(response.json())
+class GraphAPIError(Exception):
+    def __init__(self, error):
+        self.error = error
+        super().__init__(error.get("message") if isinstance(error, dict) else str(error))
 
-@app.route("/api/reach-vs-impressions")
-def get_reach_vs_impressions():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=reach,impressions&period=day&access_token={ACCESS_TOKEN}"
-    response = requests.get(url)
-    return jsonify(response.json())
+class MediaSyncPending(Exception):
+    """The account's first full media sync hasn't finished; routes answer 202 {"syncing": true}"""
 
-# Add these new endpoints to your existing backend
+# --------------------------------------------------
+# Media snapshot (local ig_media store shared by all aggregations)
+# --------------------------------------------------
+MEDIA_FIELDS = "id,caption,like_count,comments_count,media_type,media_url,timestamp"
+MEDIA_PAGE_LIMIT = 100
+MEDIA_MAX_PAGES = int(os.getenv("MEDIA_MAX_PAGES", "200"))
+MEDIA_SNAPSHOT_TTL = 120
+IG_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+def parse_ig_timestamp(value):
+    """'2024-01-01T12:00:00+0000' -> epoch seconds (0 if missing/invalid)"""
+    try:
+        return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+    except (AttributeError, ValueError):
+        return 0
 
-@app.route("/api/top-posts")
-def get_top_posts():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=id,caption,like_count,comments_count,media_type,media_url,timestamp,insights.metric(reach,impressions)&limit=5&access_token={ACCESS_TOKEN}"
-    response = requests.get(url)
-    return jsonify(response.json())
+class MediaSnapshot:
+    """
+    Columnar copy of an account's media. Counts and timestamps are packed
+    into arrays; timestamps are parsed once, at build time.
+    """
+    __slots__ = ("ids", "captions", "media_types", "media_urls", "timestamps",
+                 "epochs", "like_counts", "comments_counts", "error", "syncing", "fetched_at", "_columns")
+
+    def __init__(self):
+        self.ids = []
+        self.captions = []
+        self.media_types = []
+        self.media_urls = []
+        self.timestamps = []
+        self.epochs = array("q")
+        self.like_counts = array("q")
+        self.comments_counts = array("q")
+        self.error = None
+        self.syncing = False  # first full sync still running: empty, and never cached
+        self.fetched_at = datetime.now()
+        self._columns = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, post, epoch=None):
+        self.ids.append(post.get("id"))
+        self.captions.append(post.get("caption") or "")
+        self.media_types.append(post.get("media_type") or "UNKNOWN")
+        self.media_urls.append(post.get("media_url"))
+        self.timestamps.append(post.get("timestamp"))
+        self.epochs.append(epoch if epoch is not None else parse_ig_timestamp(post.get("timestamp")))
+        self.like_counts.append(post.get("like_count") or 0)
+        self.comments_counts.append(post.get("comments_count") or 0)
+        self._columns = None
+
+    def columns(self):
+        """
+        NumPy view of the snapshot, built once and reused until the next append:
+        epochs/likes/comments (int64), media type codes and a flat
+        (post index, hashtag id) mapping.
+        """
+        if self._columns is None:
+            type_names, type_codes = np.unique(np.array(self.media_types, dtype=object).astype(str), return_inverse=True)
+            tag_ids = {}
+            tag_posts, tag_codes = [], []
+            for i, caption in enumerate(self.captions):
+                for word in caption.split():
+                    if word.startswith("#"):
+                        tag_posts.append(i)
+                        tag_codes.append(tag_ids.setdefault(word.strip("#"), len(tag_ids)))
+            self._columns = {
+                "epochs": np.frombuffer(self.epochs, dtype=np.int64),
+                "likes": np.frombuffer(self.like_counts, dtype=np.int64),
+                "comments": np.frombuffer(self.comments_counts, dtype=np.int64),
+                "type_names": type_names,
+                "type_codes": type_codes.astype(np.int64),
+                "tag_names": np.array(list(tag_ids), dtype=object),
+                "tag_posts": np.array(tag_posts, dtype=np.int64),
+                "tag_codes": np.array(tag_codes, dtype=np.int64),
+            }
+        return self._columns
+
+    @property
+    def nbytes(self):
+        strings = sum(len(c) for c in self.captions) + sum(len(u or "") for u in self.media_urls)
+        arrays = (self.epochs, self.like_counts, self.comments_counts)
+        return strings + sum(a.itemsize * len(a) for a in arrays) + 64 * len(self.ids)
+
+    def records(self, fields=MEDIA_FIELDS):
+        """Rebuild Graph-style dicts for the requested comma-separated fields"""
+        columns = {
+            "id": self.ids,
+            "caption": self.captions,
+            "like_count": self.like_counts,
+            "comments_count": self.comments_counts,
+            "media_type": self.media_types,
+            "media_url": self.media_urls,
+            "timestamp": self.timestamps,
+        }
+        names = [f for f in fields.split(",") if f in columns]
+        return [{name: columns[name][i] for name in names} for i in range(len(self.ids))]
+
+def ensure_media_synced(account_id):
+    """
+    True once the account's first full sync has finished. Until then it's
+    made due on the account sync scheduler (it can walk hundreds of Graph
+    pages, so never on the caller's thread) and this returns False.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT full_sync_completed_at FROM ig_media_sync WHERE account_id=%s", (account_id,))
+            state = cur.fetchone()
+            if state and state[0]:
+                return True
+            # Pull the account's slot forward, unless it's backing off after failed attempts
+            cur.execute(
+                """
+                INSERT INTO graph_sync_schedule (account_id, next_sync_at) VALUES (%s, NOW())
+                ON CONFLICT (account_id) DO UPDATE SET next_sync_at=LEAST(graph_sync_schedule.next_sync_at, NOW())
+                WHERE graph_sync_schedule.failures = 0
+                """,
+                (account_id,),
+            )
+            conn.commit()
+            return False
+        finally:
+            cur.close()
+
+def load_media_snapshot(account_id):
+    snapshot = MediaSnapshot()
+    if not ensure_media_synced(account_id):
+        snapshot.syncing = True
+        return snapshot
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, caption, like_count, comments_count, media_type, media_url, posted_at
+            FROM ig_media WHERE account_id=%s ORDER BY posted_at DESC
+            """,
+            (account_id,),
+        )
+        rows = cur.fetchall()
+        cur.close()
+    for media_id, caption, likes, comments, media_type, media_url, posted_at in rows:
+        snapshot.append({
+            "id": media_id,
+            "caption": caption,
+            "like_count": likes,
+            "comments_count": comments,
+            "media_type": media_type,
+            "media_url": media_url,
+            "timestamp": posted_at.strftime(IG_TIMESTAMP_FORMAT) if posted_at else None,
+        }, epoch=int(posted_at.timestamp()) if posted_at else 0)
+    return snapshot
+
+def get_media_snapshot(account_id):
+    return graph_cache.get(
+        (account_id, "media_snapshot"), lambda: load_media_snapshot(account_id), MEDIA_SNAPSHOT_TTL,
+        cacheable=lambda snapshot: snapshot.error is None and not snapshot.syncing,
+    )
+
+# --------------------------------------------------
+# Incremental media sync (Graph /media -> ig_media)
+# --------------------------------------------------
+MEDIA_METRICS_REFRESH_DAYS = int(os.getenv("MEDIA_METRICS_REFRESH_DAYS", "7"))
+MEDIA_METRICS_BATCH = 50  # ids per ?ids= lookup
+
+def iter_media_pages(account_id, patient=True):
+    """Yield pages of /media (newest first), following paging cursors"""
+    params = {"fields": MEDIA_FIELDS, "limit": MEDIA_PAGE_LIMIT}
+    for _ in range(MEDIA_MAX_PAGES):
+        page = graph_fetch(account_id, f"{account_id}/media", patient=patient, **params)
+        if "error" in page:
+            raise GraphAPIError(page["error"])
+        yield page.get("data", [])
+        paging = page.get("paging", {})
+        after = paging.get("cursors", {}).get("after")
+        if not after or not paging.get("next"):
+            return
+        params["after"] = after
+
+def _upsert_media(cur, account_id, posts):
+    if not posts:
+        return
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO ig_media (id, account_id, caption, media_type, media_url, posted_at, like_count, comments_count)
+        VALUES %s
+        ON CONFLICT (id) DO UPDATE SET
+            caption=EXCLUDED.caption, media_type=EXCLUDED.media_type, media_url=EXCLUDED.media_url,
+            like_count=EXCLUDED.like_count, comments_count=EXCLUDED.comments_count,
+            metrics_updated_at=CURRENT_TIMESTAMP, synced_at=CURRENT_TIMESTAMP
+        """,
+        [
+            (p["id"], account_id, p.get("caption"), p.get("media_type"), p.get("media_url"),
+             datetime.fromtimestamp(parse_ig_timestamp(p.get("timestamp")), timezone.utc),
+             p.get("like_count") or 0, p.get("comments_count") or 0)
+            for p in posts
+        ],
+    )
+
+def _refresh_recent_metrics(cur, account_id, skip_ids, patient=True):
+    """Batch-refresh like/comment counts for posts from the last few days"""
+    cur.execute(
+        "SELECT id FROM ig_media WHERE account_id=%s AND posted_at >= NOW() - %s * INTERVAL '1 day'",
+        (account_id, MEDIA_METRICS_REFRESH_DAYS),
+    )
+    ids = [r[0] for r in cur.fetchall() if r[0] not in skip_ids]
+    refreshed = 0
+    for i in range(0, len(ids), MEDIA_METRICS_BATCH):
+        batch = ids[i:i + MEDIA_METRICS_BATCH]
+        result = graph_fetch(account_id, "", patient=patient, ids=",".join(batch), fields="like_count,comments_count")
+        if "error" in result:
+            raise GraphAPIError(result["error"])
+        rows = [(mid, m.get("like_count") or 0, m.get("comments_count") or 0) for mid, m in result.items()]
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            UPDATE ig_media AS m SET like_count=v.likes, comments_count=v.comments, metrics_updated_at=CURRENT_TIMESTAMP
+            FROM (VALUES %s) AS v(id, likes, comments) WHERE m.id=v.id
+            """,
+            rows,
+        )
+        refreshed += len(rows)
+    return refreshed
+
+def sync_media(account_id, patient=True):
+    """
+    First run: page through the whole /media listing.
+    Later runs: fetch only media newer than the last-seen timestamp, then
+    batch-refresh metrics of recent posts. Guarded by a Postgres advisory
+    lock so only one process syncs an account at a time.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"ig_media_sync:{account_id}",))
+        if not cur.fetchone()[0]:
+            logger.info(f"[MediaSync] {account_id} already syncing elsewhere")
+            return None
+        try:
+            cur.execute(
+                "SELECT last_seen_timestamp, full_sync_completed_at FROM ig_media_sync WHERE account_id=%s",
+                (account_id,),
+            )
+            state = cur.fetchone()
+            last_seen = state[0] if state and state[1] else None
+            cutoff = int(last_seen.timestamp()) if last_seen else None
+
+            new_posts = []
+            newest = last_seen
+            for page in iter_media_pages(account_id, patient):
+                fresh = [p for p in page if cutoff is None or parse_ig_timestamp(p.get("timestamp")) > cutoff]
+                _upsert_media(cur, account_id, fresh)
+                new_posts += [p["id"] for p in fresh]
+                for p in fresh:
+                    ts = datetime.fromtimestamp(parse_ig_timestamp(p.get("timestamp")), timezone.utc)
+                    if newest is None or ts > newest:
+                        newest = ts
+                if cutoff is not None and len(fresh) < len(page):
+                    break  # reached media we already have
+
+            refreshed = 0
+            if cutoff is not None:
+                refreshed = _refresh_recent_metrics(cur, account_id, set(new_posts), patient)
+
+            cur.execute(
+                """
+                INSERT INTO ig_media_sync (account_id, last_seen_timestamp, full_sync_completed_at, last_sync_at)
+                VALUES (%s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                ON CONFLICT (account_id) DO UPDATE SET
+                    last_seen_timestamp=EXCLUDED.last_seen_timestamp,
+                    full_sync_completed_at=COALESCE(ig_media_sync.full_sync_completed_at, EXCLUDED.full_sync_completed_at),
+                    last_sync_at=EXCLUDED.last_sync_at
+                """,
+                (account_id, newest),
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (f"ig_media_sync:{account_id}",))
+            conn.commit()
+            cur.close()
+
+    graph_cache.invalidate(lambda key: key == (account_id, "media_snapshot"))
+    logger.info(f"[MediaSync] {account_id}: {len(new_posts)} new, {refreshed} refreshed")
+    return {"new": len(new_posts), "refreshed": refreshed}
+
+
+# --------------------------------------------------
+# Analytics aggregation engine (vectorized over snapshot columns)
+# --------------------------------------------------
+WEEKDAY_NAMES = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+class MediaAggregator:
+    """
+    Group-by engine over one or more MediaSnapshots.
+    Posts are filtered by [since, until) epoch seconds and bucketed by hour /
+    weekday in `tz` (UTC by default); all sums are np.bincount group-bys.
+    """
+    def __init__(self, snapshots, tz=None, since=None, until=None):
+        if isinstance(snapshots, MediaSnapshot):
+            snapshots = [snapshots]
+        parts = [snap.columns() for snap in snapshots]
+        self.epochs = np.concatenate([p["epochs"] for p in parts]) if parts else np.zeros(0, np.int64)
+        self.likes = np.concatenate([p["likes"] for p in parts]) if parts else np.zeros(0, np.int64)
+        self.comments = np.concatenate([p["comments"] for p in parts]) if parts else np.zeros(0, np.int64)
+
+        # Media type / hashtag codes are per-snapshot; remap onto shared vocabularies
+        self.type_names, self.type_codes = self._merge_codes(parts, "type_names", "type_codes")
+        offsets = np.cumsum([0] + [len(p["epochs"]) for p in parts[:-1]])
+        self.tag_posts = np.concatenate([p["tag_posts"] + off for p, off in zip(parts, offsets)]) if parts else np.zeros(0, np.int64)
+        self.tag_names, self.tag_codes = self._merge_codes(parts, "tag_names", "tag_codes")
+
+        mask = self.epochs > 0
+        if since is not None:
+            mask &= self.epochs >= since
+        if until is not None:
+            mask &= self.epochs < until
+        self.mask = mask
+        self.local_epochs = self.epochs + self._utc_offsets(self.epochs, tz)
+
+    @staticmethod
+    def _merge_codes(parts, names_key, codes_key):
+        if len(parts) == 1:
+            return parts[0][names_key], parts[0][codes_key]
+        if not parts:
+            return np.zeros(0, dtype=object), np.zeros(0, np.int64)
+        names = np.concatenate([p[names_key] for p in parts]).astype(str)
+        merged, inverse = np.unique(names, return_inverse=True)
+        bounds = np.cumsum([0] + [len(p[names_key]) for p in parts])
+        codes = [inverse[bounds[i]:bounds[i + 1]][p[codes_key]] for i, p in enumerate(parts)]
+        return merged, np.concatenate(codes).astype(np.int64)
+
+    @staticmethod
+    def _utc_offsets(epochs, tz):
+        """Per-post UTC offset in seconds, resolved once per distinct hour (DST-safe)"""
+        if tz is None or not len(epochs):
+            return np.zeros(len(epochs), np.int64)
+        hours, inverse = np.unique(epochs // 3600, return_inverse=True)
+        offsets = np.array(
+            [datetime.fromtimestamp(int(h) * 3600, tz).utcoffset().total_seconds() for h in hours],
+            dtype=np.int64,
+        )
+        return offsets[inverse]
+
+    def _grouped(self, codes, size):
+        m = self.mask
+        counts = np.bincount(codes[m], minlength=size)
+        likes = np.bincount(codes[m], weights=self.likes[m], minlength=size)
+        comments = np.bincount(codes[m], weights=self.comments[m], minlength=size)
+        return counts, likes.astype(np.int64), comments.astype(np.int64)
+
+    def by_hour(self):
+        counts, likes, comments = self._grouped((self.local_epochs // 3600) % 24, 24)
+        return {int(h): int(likes[h] + comments[h]) for h in np.flatnonzero(counts)}
+
+    def by_weekday(self):
+        # 1970-01-01 was a Thursday (weekday 3)
+        counts, likes, comments = self._grouped((self.local_epochs // 86400 + 3) % 7, 7)
+        return {WEEKDAY_NAMES[d]: int(likes[d] + comments[d]) for d in np.flatnonzero(counts)}
+
+    def by_type(self):
+        counts, likes, comments = self._grouped(self.type_codes, len(self.type_names))
+        return {str(self.type_names[t]): {"likes": int(likes[t]), "comments": int(comments[t])}
+                for t in np.flatnonzero(counts)}
+
+    def by_hashtag(self):
+        keep = self.mask[self.tag_posts]
+        posts, codes = self.tag_posts[keep], self.tag_codes[keep]
+        size = len(self.tag_names)
+        counts = np.bincount(codes, minlength=size)
+        likes = np.bincount(codes, weights=self.likes[posts], minlength=size).astype(np.int64)
+        comments = np.bincount(codes, weights=self.comments[posts], minlength=size).astype(np.int64)
+        return {str(self.tag_names[t]): {"likes": int(likes[t]), "comments": int(comments[t])}
+                for t in np.flatnonzero(counts)}
+
+def media_aggregator_from_request(snapshot):
+    """
+    Build a MediaAggregator from ?tz=<IANA name>&since=<ISO date>&until=<ISO date>.
+    Raises ValueError on bad input.
+    """
+    tz = None
+    if request.args.get("tz"):
+        try:
+            tz = ZoneInfo(request.args["tz"])
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"Unknown timezone: {request.args['tz']}")
+    bounds = {}
+    for name in ("since", "until"):
+        value = request.args.get(name)
+        if value:
+            dt = datetime.fromisoformat(value)
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=tz or timezone.utc)
+            bounds[name] = int(dt.timestamp())
+    return MediaAggregator(snapshot, tz=tz, **bounds)
+
+
+# --------------------------------------------------
+# Metrics time series (snapshots + rollups)
+# --------------------------------------------------
+METRICS_SNAPSHOT_MINUTES = int(os.getenv("METRICS_SNAPSHOT_MINUTES", "15"))
+METRIC_RESOLUTIONS = {"hour": timedelta(hours=1), "day": timedelta(days=1), "week": timedelta(days=7)}
+ACCOUNT_GAUGES = ("followers_count", "media_count")
+DAILY_INSIGHTS = "reach,impressions,profile_views"
+STORY_INSIGHTS = "exits,reach"  # stored as story_exits / story_reach, subject = story id
+POST_METRICS = ("like_count", "comments_count")
+# Daily counters add up over a bucket; everything else is a gauge and keeps its last sample
+COUNTER_METRICS = ["reach", "impressions", "profile_views"]
+
+def _month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def _next_month(month_start):
+    return (month_start + timedelta(days=32)).replace(day=1)
+
+def ensure_metric_partitions(cur, timestamps):
+    """
+    Create the monthly metric_points partitions these timestamps fall in.
+    Collectors for different accounts can all cross a month boundary at
+    once, so creation is serialized on a global advisory lock (held to the
+    end of the caller's transaction); the usual case, where every partition
+    exists, takes no lock.
+    """
+    missing = []
+    for month in sorted({_month_start(ts.astimezone(timezone.utc)) for ts in timestamps}):
+        cur.execute("SELECT to_regclass(%s)", (f"metric_points_p{month:%Y%m}",))
+        if cur.fetchone()[0] is None:
+            missing.append(month)
+    if not missing:
+        return
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('metric_partitions'))")
+    for month in missing:
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS metric_points_p{month:%Y%m} PARTITION OF metric_points "
+            f"FOR VALUES FROM (%s) TO (%s)",
+            (month, _next_month(month)),
+        )
+
+def precreate_metric_partitions():
+    """Scheduler job: create this month's and next month's partitions before collectors need them"""
+    this_month = _month_start(datetime.now(timezone.utc))
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            ensure_metric_partitions(cur, [this_month, _next_month(this_month)])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"[Metrics] Could not create partitions: {e}")
+        finally:
+            cur.close()
+
+def _refresh_rollups(cur, account_id, since):
+    """Recompute every rollup bucket that a point at or after `since` falls in"""
+    for resolution in METRIC_RESOLUTIONS:
+        cur.execute(
+            """
+            INSERT INTO metric_rollups
+                (account_id, metric, subject, resolution, bucket, value_last, value_min, value_max, value_sum, samples)
+            SELECT account_id, metric, subject, %(res)s, date_trunc(%(res)s, ts, 'UTC') AS bucket,
+                   (array_agg(value ORDER BY ts DESC))[1], MIN(value), MAX(value), SUM(value), COUNT(*)
+            FROM metric_points
+            WHERE account_id=%(account)s AND ts >= date_trunc(%(res)s, %(since)s::timestamptz, 'UTC')
+            GROUP BY account_id, metric, subject, bucket
+            ON CONFLICT (account_id, metric, resolution, subject, bucket) DO UPDATE SET
+                value_last=EXCLUDED.value_last, value_min=EXCLUDED.value_min, value_max=EXCLUDED.value_max,
+                value_sum=EXCLUDED.value_sum, samples=EXCLUDED.samples
+            """,
+            {"res": resolution, "account": account_id, "since": since},
+        )
+
+def collect_metrics(account_id):
+    """
+    Snapshot account gauges, daily insights, live stories
+    and recent posts' metrics into metric_points, refresh the rollups they
+    touch and run the alert rules over the new batch.
+    """
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    points = []
+    try:
+        account = graph_fetch(account_id, account_id, patient=True, fields=",".join(ACCOUNT_GAUGES))
+        if "error" in account:
+            raise GraphAPIError(account["error"])
+        points += [(account_id, m, "", now, int(account[m])) for m in ACCOUNT_GAUGES if m in account]
+
+        insights = graph_fetch(account_id, f"{account_id}/insights", patient=True, metric=DAILY_INSIGHTS, period="day")
+        if "error" in insights:
+            logger.warning(f"[Metrics] Insights unavailable for {account_id}: {insights['error']}")
+        for series in insights.get("data", []):
+            for v in series.get("values", []):
+                ts = datetime.strptime(v["end_time"], IG_TIMESTAMP_FORMAT).astimezone(timezone.utc)
+                points.append((account_id, series.get("name"), "", ts, int(v.get("value") or 0)))
+
+        stories = graph_fetch(account_id, f"{account_id}/stories", patient=True,
+                              fields=f"id,insights.metric({STORY_INSIGHTS})")
+        if "error" in stories:
+            logger.warning(f"[Metrics] Stories unavailable for {account_id}: {stories['error']}")
+        for story in stories.get("data", []):
+            for series in story.get("insights", {}).get("data", []):
+                values = series.get("values") or [series.get("total_value", {})]
+                points.append((account_id, f"story_{series['name']}", story["id"], now, int(values[0].get("value") or 0)))
+    except Exception as e:
+        logger.error(f"[Metrics] Snapshot of {account_id} failed: {e}")
+        return 0
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (f"metrics:{account_id}",))
+            if not cur.fetchone()[0]:
+                logger.info(f"[Metrics] {account_id} already being collected elsewhere")
+                return 0
+
+            # Per-post metrics come from ig_media, which sync_media keeps fresh
+            cur.execute(
+                f"""
+                SELECT id, posted_at, caption, {", ".join(POST_METRICS)} FROM ig_media
+                WHERE account_id=%s AND posted_at >= %s
+                ORDER BY posted_at
+                """,
+                (account_id, now - timedelta(days=MEDIA_METRICS_REFRESH_DAYS)),
+            )
+            posts = cur.fetchall()
+            for row in posts:
+                points += [(account_id, m, row[0], now, int(row[i + 3] or 0)) for i, m in enumerate(POST_METRICS)]
+
+            if not points:
+                return 0
+            ensure_metric_partitions(cur, [p[3] for p in points])
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO metric_points (account_id, metric, subject, ts, value) VALUES %s
+                ON CONFLICT (account_id, metric, subject, ts) DO UPDATE SET value=EXCLUDED.value
+                """,
+                points,
+                page_size=1000,
+            )
+            _refresh_rollups(cur, account_id, min(p[3] for p in points))
+            fired = evaluate_alerts(cur, account_id, points, posts, now)
+            conn.commit()
+        finally:
+            cur.close()
+    logger.info(f"[Metrics] Stored {len(points)} points for {account_id}, {fired} new alerts")
+    return len(points)
+
+METRIC_SERIES_SQL = """
+    SELECT metric, bucket, CASE WHEN metric = ANY(%s) THEN value_sum ELSE value_last END
+    FROM metric_rollups
+    WHERE account_id=%s AND resolution=%s AND subject=%s AND metric = ANY(%s)
+      AND bucket >= date_trunc(%s, %s::timestamptz, 'UTC') AND bucket < %s
+    ORDER BY metric, bucket
+"""
+
+def metric_series(account_id, metrics, resolution="day", since=None, until=None, subject=""):
+    """{metric: [(bucket, value)]} from metric_rollups, oldest first"""
+    until = until or datetime.now(timezone.utc)
+    since = since or until - timedelta(days=30)
+    series = {m: [] for m in metrics}
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            METRIC_SERIES_SQL,
+            (COUNTER_METRICS, account_id, resolution, subject, list(metrics), resolution, since, until),
+        )
+        for metric, bucket, value in cur.fetchall():
+            series[metric].append((bucket, value))
+        cur.close()
+    return series
+
+def series_window_from_request():
+    """?resolution=hour|day|week&since=&until= (default: daily, last 30 days); raises ValueError"""
+    resolution = request.args.get("resolution", "day")
+    if resolution not in METRIC_RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    bounds = {}
+    for name in ("since", "until"):
+        bounds[name] = None
+        if request.args.get(name):
+            dt = datetime.fromisoformat(request.args[name])
+            bounds[name] = dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    return resolution, bounds["since"], bounds["until"]
+
+def series_as_graph(series, resolution):
+    """Shape local series like a Graph insights response, so clients don't change"""
+    step = METRIC_RESOLUTIONS[resolution]
+    return {"data": [
+        {
+            "name": metric,
+            "period": resolution,
+            "values": [{"value": value, "end_time": (bucket + step).strftime(IG_TIMESTAMP_FORMAT)}
+                       for bucket, value in points],
+        }
+        for metric, points in series.items()
+    ], "source": "local"}
+
+def local_graph_series(account_id, metrics):
+    """Graph-shaped series from the local store, or None when it has no data yet"""
+    resolution, since, until = series_window_from_request()
+    series = metric_series(account_id, metrics, resolution, since, until)
+    if not any(series.values()):
+        return None
+    return series_as_graph(series, resolution)
+
+# --------------------------------------------------
+# Alert engine
+# --------------------------------------------------
+# Rules run inside collect_metrics over the batch it just stored. Each
+# (rule, subject) keeps a few numbers in alert_state (last value, running
+# mean, current day/week totals), so evaluating a snapshot never rereads
+# history. Alerts are written once per dedup_key and announced on the
+# alerts channel for /api/alerts/stream.
+ALERTS_CHANNEL = "alerts"
+ALERT_FOLLOWER_DELTA = int(os.getenv("ALERT_FOLLOWER_DELTA", "10"))            # followers gained/lost in a day
+ALERT_PROFILE_VIEWS_PCT = float(os.getenv("ALERT_PROFILE_VIEWS_PCT", "30"))    # day-over-day % change
+ALERT_REACH_FACTOR = 2.0        # daily reach/impressions vs its running mean
+ALERT_ENGAGEMENT_DROP = 0.5     # settled post's likes/comments vs the running mean
+ALERT_STORY_EXIT_PCT = 50.0     # story exits as % of story reach
+ALERT_HASHTAG_FACTOR = 3.0      # decayed hashtag engagement vs mean engagement per post
+ALERT_HASHTAG_HALF_LIFE_DAYS = 7
+ALERT_POST_SETTLE_HOURS = int(os.getenv("ALERT_POST_SETTLE_HOURS", "24"))
+ALERT_MEAN_WINDOW = 30          # running means weigh roughly the last N samples
+ALERT_MIN_SAMPLES = 3           # no "vs average" alerts until the mean has this many samples
+ALERT_STREAM_BACKLOG = 200
+ALERT_STREAM_HEARTBEAT = 15     # seconds between SSE keep-alive comments
+
+def _running_mean(state, value):
+    """Fold value into state's mean; after ALERT_MEAN_WINDOW samples it behaves like an EWMA"""
+    n = min(state.get("n", 0) + 1, ALERT_MEAN_WINDOW)
+    mean = state.get("mean", 0.0)
+    state["mean"], state["n"] = mean + (value - mean) / n, n
+
+def _caption_hashtags(caption):
+    return {word.strip("#") for word in (caption or "").split() if word.startswith("#") and word.strip("#")}
+
+class AlertEvaluator:
+    """
+    One evaluation pass over an account's new points. Rules read and
+    mutate their state dicts in place and append to `fired`.
+    """
+    def __init__(self, account_id, now, states):
+        self.account_id = account_id
+        self.now = now
+        self.fired = []
+        self._states = states   # (rule, subject) -> dict
+        self._touched = set()
+
+    def state(self, rule, subject=""):
+        self._touched.add((rule, subject))
+        return self._states.setdefault((rule, subject), {})
+
+    def changed(self):
+        return [(rule, subject, self._states[(rule, subject)]) for rule, subject in self._touched]
+
+    def fire(self, rule, dedup, metric, change, message, subject="", priority="low"):
+        self.fired.append((
+            self.account_id, rule, subject, f"{self.account_id}:{rule}:{dedup}",
+            metric, change, message, priority, self.now,
+        ))
+
+    def _is_new(self, state, ts):
+        """Daily insights are re-fetched every run; only a later end_time is new"""
+        if ts.timestamp() <= state.get("ts", 0):
+            return False
+        state["ts"] = ts.timestamp()
+        return True
+
+    def followers(self, ts, value):
+        """Change since the last sample of the previous day"""
+        s = self.state("followers")
+        day = ts.date().isoformat()
+        if s.get("day") != day:
+            s["day"], s["baseline"] = day, s.get("last", value)
+        s["last"] = value
+        change = value - s["baseline"]
+        if abs(change) >= ALERT_FOLLOWER_DELTA:
+            direction = "increased" if change > 0 else "decreased"
+            self.fire("followers", f"{day}:{direction}", "Followers", change,
+                      f"Followers {direction} by {abs(change)} today.",
+                      priority="high" if change < 0 else "low")
+
+    def profile_views(self, ts, value):
+        s = self.state("profile_views")
+        previous = s.get("last")
+        if not self._is_new(s, ts):
+            return
+        s["last"] = value
+        if previous:
+            percent_change = (value - previous) / previous * 100
+            if abs(percent_change) >= ALERT_PROFILE_VIEWS_PCT:
+                direction = "increased" if percent_change > 0 else "dropped"
+                self.fire("profile_views", ts.date().isoformat(), "Profile Views", percent_change,
+                          f"Profile views {direction} {abs(int(percent_change))}% compared to yesterday.",
+                          priority="medium" if percent_change < 0 else "low")
+
+    def daily_vs_average(self, metric, ts, value):
+        """reach / impressions: a day well above the running daily mean"""
+        s = self.state(metric)
+        if not self._is_new(s, ts):
+            return
+        mean = s.get("mean", 0.0)
+        if s.get("n", 0) >= ALERT_MIN_SAMPLES and mean and value > ALERT_REACH_FACTOR * mean:
+            self.fire(metric, ts.date().isoformat(), metric.capitalize(), value - mean,
+                      f"Daily {metric} was {value / mean:.1f}x the average.")
+        _running_mean(s, value)
+        if metric == "reach":
+            self._weekly_reach(ts - timedelta(days=1), value)  # end_time closes the day it measures
+
+    def _weekly_reach(self, day, value):
+        """
+        Running weekly total; the first day of a new week reports the one that
+        just closed. Only two back-to-back weeks we saw all 7 days of are
+        compared, so the first (partial) week or a gap never fires.
+        """
+        s = self.state("summary")
+        monday = day.date() - timedelta(days=day.weekday())
+        week = monday.isoformat()
+        if s.get("week") != week:
+            full = s.get("days") == 7
+            if s.get("week"):
+                week_before = (datetime.fromisoformat(s["week"]).date() - timedelta(days=7)).isoformat()
+                if full and s.get("previous_full") and s.get("previous_week") == week_before and s.get("previous"):
+                    change = (s["total"] - s["previous"]) / s["previous"] * 100
+                    self.fire("summary", s["week"], "Reach", change,
+                              f"Last week, total reach changed by {int(change)}% compared to the week before.")
+            s["previous"], s["previous_week"], s["previous_full"] = s.get("total"), s.get("week"), full
+            s["week"], s["total"], s["days"] = week, 0, 0
+        s["total"] += value
+        s["days"] = s.get("days", 0) + 1
+
+    def story(self, story_id, exits, reach):
+        if reach and exits / reach * 100 > ALERT_STORY_EXIT_PCT:
+            rate = exits / reach * 100
+            self.fire("story", story_id, "Story Exits", rate,
+                      f"Story exit rate is high ({rate:.0f}%).", subject=story_id, priority="medium")
+
+    def posts(self, posts):
+        """
+        Posts are judged once, when they are ALERT_POST_SETTLE_HOURS old,
+        oldest first; a watermark on posted_at records how far we got.
+        """
+        mark = self.state("posts")
+        settled_before = self.now - timedelta(hours=ALERT_POST_SETTLE_HOURS)
+        for media_id, posted_at, caption, likes, comments in posts:
+            if not posted_at or posted_at.timestamp() <= mark.get("ts", 0) or posted_at > settled_before:
+                continue
+            mark["ts"] = posted_at.timestamp()
+            self._settled_post(media_id, posted_at, caption, likes or 0, comments or 0)
+
+    def _settled_post(self, media_id, posted_at, caption, likes, comments):
+        for metric, value in (("likes", likes), ("comments", comments)):
+            s = self.state(metric)
+            mean = s.get("mean", 0.0)
+            if s.get("n", 0) >= ALERT_MIN_SAMPLES and mean and value < ALERT_ENGAGEMENT_DROP * mean:
+                self.fire(metric, media_id, metric.capitalize(), value - mean,
+                          f"Engagement dropped: a post got {value} {metric}, under half the average of {mean:.0f}.",
+                          subject=media_id, priority="medium")
+            _running_mean(s, value)
+
+        likes_state, comments_state = self.state("likes"), self.state("comments")
+        if likes_state["n"] < ALERT_MIN_SAMPLES:
+            return
+        threshold = ALERT_HASHTAG_FACTOR * (likes_state["mean"] + comments_state["mean"])
+        t = posted_at.timestamp()
+        for tag in _caption_hashtags(caption):
+            s = self.state("hashtag", tag)
+            decayed = s.get("score", 0.0) * 0.5 ** ((t - s.get("ts", t)) / (ALERT_HASHTAG_HALF_LIFE_DAYS * 86400))
+            s["score"], s["ts"] = decayed + likes + comments, t
+            if threshold and decayed < threshold <= s["score"]:
+                self.fire("hashtag", f"{tag}:{int(t)}", "Hashtag", s["score"], f"Hashtag #{tag} is trending!",
+                          subject=tag)
+
+def evaluate_alerts(cur, account_id, points, posts, now):
+    """
+    Run the rules over one collected batch. The caller holds the account's
+    collection lock and commits. Returns the number of newly fired alerts.
+    """
+    tags = set().union(*(_caption_hashtags(post[2]) for post in posts))
+    cur.execute(
+        "SELECT rule, subject, state FROM alert_state WHERE account_id=%s AND (rule <> 'hashtag' OR subject = ANY(%s))",
+        (account_id, list(tags)),
+    )
+    evaluator = AlertEvaluator(account_id, now, {(rule, subject): state for rule, subject, state in cur.fetchall()})
+
+    stories = defaultdict(dict)
+    for _, metric, subject, ts, value in sorted(points, key=lambda p: p[3]):
+        if metric == "followers_count":
+            evaluator.followers(ts, value)
+        elif metric == "profile_views":
+            evaluator.profile_views(ts, value)
+        elif metric in ("reach", "impressions") and not subject:
+            evaluator.daily_vs_average(metric, ts, value)
+        elif metric.startswith("story_"):
+            stories[subject][metric] = value
+    for story_id, values in stories.items():
+        evaluator.story(story_id, values.get("story_exits", 0), values.get("story_reach", 0))
+    evaluator.posts(posts)
+
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO alert_state (account_id, rule, subject, state) VALUES %s
+        ON CONFLICT (account_id, rule, subject) DO UPDATE SET state=EXCLUDED.state, updated_at=NOW()
+        """,
+        [(account_id, rule, subject, psycopg2.extras.Json(state)) for rule, subject, state in evaluator.changed()],
+    )
+    if not evaluator.fired:
+        return 0
+    inserted = psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO alerts (account_id, rule, subject, dedup_key, metric, change, message, priority, fired_at)
+        VALUES %s ON CONFLICT (dedup_key) DO NOTHING RETURNING id
+        """,
+        evaluator.fired,
+        fetch=True,
+    )
+    if inserted:
+        # Delivered on commit; the payload tells listeners where the new rows start
+        cur.execute("SELECT pg_notify(%s, %s)", (ALERTS_CHANNEL, f"{account_id}:{min(row[0] for row in inserted)}"))
+    return len(inserted)
+
+ALERT_COLUMNS = "id, rule, metric, change, message, priority, fired_at"
+RECENT_ALERTS_SQL = f"SELECT {ALERT_COLUMNS} FROM alerts WHERE account_id=%s AND id > %s ORDER BY id DESC LIMIT %s"
+
+def alert_json(row):
+    alert_id, rule, metric, change, message, priority, fired_at = row
+    return {
+        "id": alert_id,
+        "type": rule,
+        "metric": metric,
+        "change": change,
+        "message": message,
+        "priority": priority,
+        "date": fired_at.isoformat(),
+    }
+
+def recent_alerts(account_id, limit=50, after_id=0):
+    """Newest first, optionally only those newer than after_id"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(RECENT_ALERTS_SQL, (account_id, after_id, limit))
+        rows = cur.fetchall()
+        cur.close()
+    return [alert_json(row) for row in rows]
+
+class AlertBroadcaster:
+    """
+    Fans new alerts out to SSE clients. One LISTEN connection per process
+    (started with the first subscriber); each client gets a bounded queue.
+    """
+    def __init__(self):
+        self._subscribers = {}  # queue -> account_id
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {"notifications": 0, "delivered": 0, "dropped": 0}
+
+    def subscribe(self, account_id):
+        subscriber = queue.Queue(maxsize=ALERT_STREAM_BACKLOG)
+        with self._lock:
+            self._subscribers[subscriber] = account_id
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="alert-listener", daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": len(self._subscribers), **self._stats}
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**DB_CONFIG)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {ALERTS_CHANNEL}")
+                while True:
+                    if select.select([conn], [], [], ALERT_STREAM_HEARTBEAT) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._on_notify(cur, conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f"Alert listener error: {e}")
+                time.sleep(5)
+            finally:
+                if conn:
+                    conn.close()
+
+    def _on_notify(self, cur, payload):
+        account_id, _, first_id = payload.rpartition(":")
+        with self._lock:
+            self._stats["notifications"] += 1
+            targets = [q for q, account in self._subscribers.items() if account == account_id]
+        if not targets:
+            return
+        cur.execute(
+            f"SELECT {ALERT_COLUMNS} FROM alerts WHERE account_id=%s AND id >= %s ORDER BY id LIMIT %s",
+            (account_id, int(first_id), ALERT_STREAM_BACKLOG),
+        )
+        alerts = [alert_json(row) for row in cur.fetchall()]
+        for subscriber in targets:
+            for alert in alerts:
+                try:
+                    subscriber.put_nowait(alert)
+                    outcome = "delivered"
+                except queue.Full:
+                    outcome = "dropped"  # client stopped reading; it catches up via Last-Event-ID
+                with self._lock:
+                    self._stats[outcome] += 1
+
+alert_broadcaster = AlertBroadcaster()
+
+# --------------------------------------------------
+# Account sync scheduler
+# --------------------------------------------------
+# Each connected account gets a media sync + metrics snapshot once per
+# ACCOUNT_SYNC_MINUTES. graph_sync_schedule holds every account's next
+# slot. New accounts get a slot spread over the interval by a hash of their
+# id, and later slots keep that phase, so thousands of accounts never come
+# due on the same tick. Each tick claims the longest-overdue accounts —
+# only as many as there are idle workers — under SKIP LOCKED leases, so
+# instances share the work and no account waits behind a busy one.
+# Failures back off exponentially; accounts Meta has rate-limited wait
+# until their quota comes back.
+ACCOUNT_SYNC_MINUTES = int(os.getenv("ACCOUNT_SYNC_MINUTES", str(METRICS_SNAPSHOT_MINUTES)))
+ACCOUNT_SYNC_WORKERS = int(os.getenv("ACCOUNT_SYNC_WORKERS", "4"))
+ACCOUNT_SYNC_TICK_SECONDS = 30
+ACCOUNT_SYNC_LEASE_SECONDS = 15 * 60
+ACCOUNT_SYNC_MAX_BACKOFF_MINUTES = 24 * 60
+
+def register_account_sync(cur, account_id, immediate=False):
+    """Give an account a slot in the sync schedule; immediate=True makes it due now"""
+    if immediate:
+        cur.execute(
+            """
+            INSERT INTO graph_sync_schedule (account_id, next_sync_at) VALUES (%s, NOW())
+            ON CONFLICT (account_id) DO UPDATE SET next_sync_at=NOW(), failures=0, last_error=NULL
+            """,
+            (account_id,),
+        )
+        return
+    cur.execute(
+        """
+        INSERT INTO graph_sync_schedule (account_id, next_sync_at)
+        VALUES (%s, NOW() + mod(abs(hashtext(%s)::bigint), %s) * INTERVAL '1 second')
+        ON CONFLICT (account_id) DO NOTHING
+        """,
+        (account_id, account_id, ACCOUNT_SYNC_MINUTES * 60),
+    )
+
+ACCOUNT_SYNC_CLAIM_SQL = """
+    UPDATE graph_sync_schedule s
+    SET lease_owner=%s, lease_expires_at=NOW() + %s * INTERVAL '1 second'
+    FROM (
+        SELECT account_id FROM graph_sync_schedule
+        WHERE next_sync_at <= NOW() AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+        ORDER BY next_sync_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ) due
+    WHERE s.account_id = due.account_id
+    RETURNING s.account_id, EXTRACT(EPOCH FROM NOW() - s.next_sync_at)
+"""
+
+class AccountSyncScheduler:
+    def __init__(self, workers=ACCOUNT_SYNC_WORKERS):
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="account-sync")
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._stats = {"ticks": 0, "claimed": 0, "synced": 0, "failed": 0, "deferred": 0, "dropped": 0,
+                       "max_lag_s": 0.0}
+
+    def tick(self):
+        """Scheduler job: lease due accounts, up to the number of idle workers"""
+        with self._lock:
+            self._stats["ticks"] += 1
+            idle = self._workers - len(self._inflight)
+        if idle <= 0:
+            return
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(ACCOUNT_SYNC_CLAIM_SQL, (SCHEDULER_INSTANCE_ID, ACCOUNT_SYNC_LEASE_SECONDS, idle))
+                claimed = cur.fetchall()
+                conn.commit()
+            finally:
+                cur.close()
+        for account_id, lag in claimed:
+            with self._lock:
+                self._inflight.add(account_id)
+                self._stats["claimed"] += 1
+                self._stats["max_lag_s"] = max(self._stats["max_lag_s"], float(lag))
+            self._executor.submit(self._sync, account_id)
+
+    def _sync(self, account_id):
+        outcome, detail = "synced", None
+        try:
+            blocked = graph_client.blocked_for(account_id)
+            if not graph_token(account_id):
+                outcome = "dropped"
+            elif blocked:
+                outcome, detail = "deferred", blocked
+            else:
+                sync_media(account_id)
+                collect_metrics(account_id)
+        except Exception as e:
+            outcome, detail = "failed", str(e)
+            logger.error(f"[AccountSync] {account_id} failed: {e}")
+        try:
+            self._finish(account_id, outcome, detail)
+        except Exception as e:
+            logger.error(f"[AccountSync] Could not reschedule {account_id}: {e}")  # lease expiry retries it
+        finally:
+            with self._lock:
+                self._inflight.discard(account_id)
+                self._stats[outcome] += 1
+
+    def _finish(self, account_id, outcome, detail):
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                if outcome == "dropped":
+                    # Nobody holds credentials for it any more
+                    cur.execute("DELETE FROM graph_sync_schedule WHERE account_id=%s AND lease_owner=%s",
+                                (account_id, SCHEDULER_INSTANCE_ID))
+                elif outcome == "deferred":
+                    cur.execute(
+                        """
+                        UPDATE graph_sync_schedule SET next_sync_at=NOW() + %s * INTERVAL '1 second',
+                               lease_owner=NULL, lease_expires_at=NULL
+                        WHERE account_id=%s AND lease_owner=%s
+                        """,
+                        (detail, account_id, SCHEDULER_INSTANCE_ID),
+                    )
+                elif outcome == "failed":
+                    cur.execute(
+                        """
+                        UPDATE graph_sync_schedule SET failures=failures + 1, last_error=%s,
+                               next_sync_at=NOW() + LEAST(%s * power(2, failures), %s) * INTERVAL '1 minute',
+                               lease_owner=NULL, lease_expires_at=NULL
+                        WHERE account_id=%s AND lease_owner=%s
+                        """,
+                        (detail, ACCOUNT_SYNC_MINUTES, ACCOUNT_SYNC_MAX_BACKOFF_MINUTES, account_id,
+                         SCHEDULER_INSTANCE_ID),
+                    )
+                else:
+                    # Keep the account's phase; if we're far behind, don't pile every late account onto one slot
+                    cur.execute(
+                        """
+                        UPDATE graph_sync_schedule SET failures=0, last_error=NULL, last_synced_at=NOW(),
+                               next_sync_at=GREATEST(next_sync_at + %s * INTERVAL '1 minute',
+                                                     NOW() + %s * INTERVAL '30 seconds'),
+                               lease_owner=NULL, lease_expires_at=NULL
+                        WHERE account_id=%s AND lease_owner=%s
+                        """,
+                        (ACCOUNT_SYNC_MINUTES, ACCOUNT_SYNC_MINUTES, account_id, SCHEDULER_INSTANCE_ID),
+                    )
+                if cur.rowcount != 1:
+                    # Lease expired mid-sync and another instance re-claimed it; its outcome wins
+                    logger.warning(f"[AccountSync] Lost lease on {account_id}, not recording '{outcome}'")
+                conn.commit()
+            finally:
+                cur.close()
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self._workers, "inflight": len(self._inflight), **self._stats}
+
+account_sync = AccountSyncScheduler()
+
+# --------------------------------------------------
+# Dashboard panels
+# --------------------------------------------------
+# Each panel builds the JSON one dashboard card needs. The single-panel
+# routes below and /api/dashboard share these builders.
+DASHBOARD_WORKERS = int(os.getenv("DASHBOARD_WORKERS", "8"))
+DASHBOARD_TIMEOUT = 30  # seconds for the whole composite request
+
+dashboard_executor = ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix="dashboard")
+
+class PanelContext:
+    """
+    Per-request memo: panels that share an upstream fetch (the media
+    snapshot, an insights call) trigger it once; concurrent callers wait
+    on the same future.
+    """
+    def __init__(self, account_id):
+        self.account_id = account_id
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def _once(self, key, loader):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if owner:
+            try:
+                future.set_result(loader())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def graph_get(self, path, **params):
+        key = ("graph", path, tuple(sorted(params.items())))
+        return self._once(key, lambda: graph_get(self.account_id, path, **params))
+
+    def snapshot(self):
+        """Raises MediaSyncPending until the account's first sync is done"""
+        snapshot = self._once(("snapshot",), lambda: get_media_snapshot(self.account_id))
+        if snapshot.syncing:
+            raise MediaSyncPending()
+        return snapshot
+
+    def aggregator(self):
+        """Raises ValueError on bad ?tz/since/until"""
+        return self._once(("aggregator",), lambda: media_aggregator_from_request(self.snapshot()))
+
+# --- 1. Followers & Media Count ---
+def panel_analytics(ctx):
+    return ctx.graph_get(ctx.account_id, fields="followers_count,media_count")
+
+# --- 2. Posts with likes & comments ---
+def panel_posts(ctx):
+    snapshot = ctx.snapshot()
+    if snapshot.error:
+        return {"error": snapshot.error}
+    return {"data": snapshot.records()}
+
+# --- 3. Profile Views (new implementation) ---
+def panel_profile_views(ctx):
+    profile_views_data = {"today": 0, "last_30_days": 0}
+
+    views = metric_series(ctx.account_id, ["profile_views"])["profile_views"]
+    if views:
+        profile_views_data["last_30_days"] = sum(value for _, value in views)
+        profile_views_data["today"] = views[-1][1]
+        return profile_views_data
+
+    try:
+        # Hour-aligned window so repeated loads share a cache entry
+        until_date = datetime.now().replace(minute=0, second=0, microsecond=0)
+        since_date = until_date - timedelta(days=30)
+
+        # Convert to UNIX timestamp
+        since_ts = int(since_date.timestamp())
+        until_ts = int(until_date.timestamp())
+
+        res = ctx.graph_get(
+            f"{ctx.account_id}/insights",
+            metric="profile_views", period="day",
+            metric_type="total_value",  # <-- REQUIRED!
+            since=since_ts, until=until_ts,
+        )
+        print("Profile views API response:", res)
+
+        if "data" in res and res["data"]:
+            values = res["data"][0].get("values", [])
+            if values:
+                profile_views_data["last_30_days"] = sum(v.get("value", 0) for v in values)
+                profile_views_data["today"] = values[-1].get("value", 0)
+
+    except Exception as e:
+        print(f"Error fetching profile views: {e}")
+
+    return profile_views_data
+
+# --- 4. Insights: reach & impressions ---
+def panel_insights(ctx):
+    local = local_graph_series(ctx.account_id, ["reach", "impressions"])
+    if local:
+        return local
+    try:
+        return ctx.graph_get(f"{ctx.account_id}/insights", metric="reach,impressions", period="day")
+    except Exception as e:
+        return {"data": [], "error": str(e)}
+
+# --- 5. User Profile Info ---
+def panel_profile(ctx):
+    return ctx.graph_get(ctx.account_id, fields="username,profile_picture_url")
+
+# --- 6. Followers Growth ---
+def panel_followers_growth(ctx):
+    local = local_graph_series(ctx.account_id, ["followers_count"])
+    if local:
+        return local
+    response = ctx.graph_get(f"{ctx.account_id}/insights", metric="follower_count", period="day")
+    if "data" in response and response["data"]:
+        return response
+    return {"data": []}
+
+# --- 7. Engagement by Day ---
+def panel_engagement_by_day(ctx):
+    return ctx.aggregator().by_weekday()
+
+def panel_top_posts(ctx):
+    return ctx.graph_get(
+        f"{ctx.account_id}/media",
+        fields="id,caption,like_count,comments_count,media_type,media_url,timestamp,insights.metric(reach,impressions)",
+        limit=5,
+    )
+
+def panel_audience_demographics(ctx):
+    insights = f"{ctx.account_id}/insights"
+    responses, errors = graph_fanout({
+        "age_gender": lambda: ctx.graph_get(insights, metric="audience_gender_age", period="lifetime"),
+        "location": lambda: ctx.graph_get(insights, metric="audience_city,audience_country", period="lifetime"),
+        "gender": lambda: ctx.graph_get(insights, metric="audience_gender", period="lifetime"),
+    })
 
-@app.route("/api/audience-demographics")
-def get_audience_demographics():
     # Age & Gender
-    age_gender_url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=audience_gender_age&period=lifetime&access_token={ACCESS_TOKEN}"
-    age_gender_response = requests.get(age_gender_url).json()
+    age_gender_response = responses.get("age_gender", {})
     age_gender_data = {}
     if "data" in age_gender_response and age_gender_response["data"]:
         values = age_gender_response["data"][0].get("values", [])
@@ -1476,8 +5283,7 @@ def get_audience_demographics():
             age_gender_data = values[0]["value"]
 
     # Location
-    location_url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=audience_city,audience_country&period=lifetime&access_token={ACCESS_TOKEN}"
-    location_response = requests.get(location_url).json()
+    location_response = responses.get("location", {})
     location_data = {"cities": {}, "countries": {}}
     if "data" in location_response and location_response["data"]:
         for item in location_response["data"]:
@@ -1487,262 +5293,610 @@ def get_audience_demographics():
                 location_data["countries"] = item["values"][0].get("value", {})
 
     # Gender
-    gender_url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=audience_gender&period=lifetime&access_token={ACCESS_TOKEN}"
-    gender_response = requests.get(gender_url).json()
+    gender_response = responses.get("gender", {})
     gender_data = {}
     if "data" in gender_response and gender_response["data"]:
         values = gender_response["data"][0].get("values", [])
         if values and "value" in values[0]:
             gender_data = values[0]["value"]
 
-    return jsonify({
+    result = {
         "age_gender": age_gender_data,
         "location": location_data,
         "gender": gender_data
-    })
+    }
+    if errors:
+        result["errors"] = errors
+    return result
+
+# --- Post Engagement by Type ---
+def panel_engagement_by_type(ctx):
+    return ctx.aggregator().by_type()
+
+# --- Best Time/Day to Post ---
+def panel_best_time_post(ctx):
+    aggregator = ctx.aggregator()
+    return {
+        "by_hour": aggregator.by_hour(),
+        "by_day": aggregator.by_weekday()
+    }
+
+# --- Hashtag Performance ---
+def panel_hashtag_performance(ctx):
+    return ctx.aggregator().by_hashtag()
+
+# --- Followers Activity (new vs returning) ---
+# Instagram doesn't report this, so it's derived from the stored follower counts:
+# gains between buckets are new followers, followers at the start of the
+# window who didn't leave are returning.
+def panel_follower_activity(ctx):
+    resolution, since, until = series_window_from_request()
+    counts = metric_series(ctx.account_id, ["followers_count"], resolution, since, until)["followers_count"]
+    deltas = [b[1] - a[1] for a, b in zip(counts, counts[1:])]
+    gained = sum(d for d in deltas if d > 0)
+    lost = -sum(d for d in deltas if d < 0)
+    return {
+        "new_followers": gained,
+        "returning_followers": max(counts[0][1] - lost, 0) if counts else 0,
+        "lost_followers": lost,
+        "growth_data": [{"date": bucket.date().isoformat(), "followers": value} for bucket, value in counts],
+    }
+
+# --- Bio/Link Clicks ---
+def panel_link_clicks(ctx):
+    return ctx.graph_get(f"{ctx.account_id}/insights", metric="website_clicks", period="day")
+
+# --- Alerts for big changes ---
+# Alerts are fired by the engine as metrics are collected; this is just
+# the indexed read. ?limit= (default 50, max 200), ?after_id= for polling.
+def panel_alerts(ctx):
+    limit = min(max(int(request.args.get("limit", 50)), 1), 200)
+    return recent_alerts(ctx.account_id, limit, int(request.args.get("after_id", 0)))
+
+DASHBOARD_PANELS = {
+    "analytics": panel_analytics,
+    "posts": panel_posts,
+    "profile_views": panel_profile_views,
+    "insights": panel_insights,
+    "profile": panel_profile,
+    "followers_growth": panel_followers_growth,
+    "engagement_by_day": panel_engagement_by_day,
+    "top_posts": panel_top_posts,
+    "audience_demographics": panel_audience_demographics,
+    "engagement_by_type": panel_engagement_by_type,
+    "best_time_post": panel_best_time_post,
+    "hashtag_performance": panel_hashtag_performance,
+    "follower_activity": panel_follower_activity,
+    "link_clicks": panel_link_clicks,
+    "alerts": panel_alerts,
+}
+
+def render_panel(name):
+    """Single-panel route body for the user's account: bad ?tz/since/until is a 400"""
+    account_id = current_graph_account_id()
+    if not account_id:
+        return no_graph_account()
+    try:
+        return jsonify(DASHBOARD_PANELS[name](PanelContext(account_id)))
+    except MediaSyncPending:
+        return jsonify({"syncing": True}), 202
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route("/api/dashboard")
+def get_dashboard():
+    """
+    ?panels=a,b,c (default: all) resolved in one round-trip. Shared
+    upstream fetches run once per request, the rest concurrently.
+    ?stream=1 sends NDJSON lines {"panel", "data"|"error"} as panels finish.
+    """
+    requested = [p for p in request.args.get("panels", "").split(",") if p] or list(DASHBOARD_PANELS)
+    unknown = [p for p in requested if p not in DASHBOARD_PANELS]
+    if unknown:
+        return jsonify({"error": f"Unknown panels: {', '.join(unknown)}"}), 400
+    account_id = current_graph_account_id()
+    if not account_id:
+        return no_graph_account()
+
+    ctx = PanelContext(account_id)
+    futures = {
+        dashboard_executor.submit(copy_current_request_context(DASHBOARD_PANELS[name]), ctx): name
+        for name in dict.fromkeys(requested)
+    }
+
+    def finished():
+        try:
+            for future in as_completed(futures, timeout=DASHBOARD_TIMEOUT):
+                try:
+                    yield futures[future], future.result(), None
+                except MediaSyncPending:
+                    yield futures[future], {"syncing": True}, None
+                except Exception as e:
+                    logger.warning(f"Dashboard panel {futures[future]} failed: {e}")
+                    yield futures[future], None, str(e)
+        except FutureTimeout:
+            for future, name in futures.items():
+                if not future.done():
+                    future.cancel()
+                    yield name, None, "Timed out"
+
+    if request.args.get("stream") in ("1", "true"):
+        def generate_ndjson():
+            for name, data, error in finished():
+                line = {"panel": name, "error": error} if error else {"panel": name, "data": data}
+                yield json.dumps(line) + "\n"
+        return Response(stream_with_context(generate_ndjson()), mimetype="application/x-ndjson")
+
+    panels, errors = {}, {}
+    for name, data, error in finished():
+        if error:
+            errors[name] = error
+        else:
+            panels[name] = data
+    return jsonify({"panels": panels, "errors": errors})
+
+@app.route("/api/analytics")
+def get_analytics():
+    return render_panel("analytics")
+
+@app.route("/api/posts")
+def get_posts():
+    return render_panel("posts")
+
+@app.route("/api/profile-views")
+def get_profile_views():
+    return render_panel("profile_views")
+
+@app.route("/api/insights")
+def get_insights():
+    return render_panel("insights")
+
+@app.route("/api/profile")
+def get_profile():
+    return render_panel("profile")
+
+@app.route("/api/followers-growth")
+def get_followers_growth():
+    return render_panel("followers_growth")
+
+@app.route("/api/engagement-by-day")
+def get_engagement_by_day():
+    return render_panel("engagement_by_day")
+
+@app.route("/api/audience-age")
+def get_audience_age():
+    account_id = current_graph_account_id()
+    if not account_id:
+        return no_graph_account()
+    return jsonify(graph_get(account_id, f"{account_id}/insights", metric="audience_age_gender", period="lifetime"))
+
+@app.route("/api/reach-vs-impressions")
+def get_reach_vs_impressions():
+    return render_panel("insights")
+
+# Add these new endpoints to your existing backend
+
+@app.route("/api/top-posts")
+def get_top_posts():
+    return render_panel("top_posts")
+
+@app.route("/api/audience-demographics")
+def get_audience_demographics():
+    return render_panel("audience_demographics")
 
 @app.route("/api/followers-gender")
 def get_followers_gender():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=audience_gender&period=lifetime&access_token={ACCESS_TOKEN}"
-    response = requests.get(url)
-    return jsonify(response.json())
-
+    account_id = current_graph_account_id()
+    if not account_id:
+        return no_graph_account()
+    return jsonify(graph_get(account_id, f"{account_id}/insights", metric="audience_gender", period="lifetime"))
 
-# --- 1. Post Engagement by Type ---
 @app.route("/api/engagement-by-type")
 def engagement_by_type():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=id,media_type,like_count,comments_count&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    
-    result = defaultdict(lambda: {"likes": 0, "comments": 0})
-    for post in response.get("data", []):
-        mtype = post.get("media_type", "UNKNOWN")
-        result[mtype]["likes"] += post.get("like_count", 0)
-        result[mtype]["comments"] += post.get("comments_count", 0)
-    
-    return jsonify(result)
-
-# --- 2. Best Time/Day to Post ---
+    return render_panel("engagement_by_type")
+
 @app.route("/api/best-time-post")
 def best_time_post():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=id,timestamp,like_count,comments_count&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    
-    engagement_by_hour = defaultdict(int)
-    engagement_by_day = defaultdict(int)
-    
-    for post in response.get("data", []):
-        dt = datetime.datetime.fromisoformat(post["timestamp"].replace("Z", "+00:00"))
-        total_engagement = post.get("like_count", 0) + post.get("comments_count", 0)
-        engagement_by_hour[dt.hour] += total_engagement
-        engagement_by_day[dt.strftime("%A")] += total_engagement
-    
-    return jsonify({
-        "by_hour": dict(engagement_by_hour),
-        "by_day": dict(engagement_by_day)
-    })
-
+    return render_panel("best_time_post")
 
-# --- 3. Hashtag Performance ---
 @app.route("/api/hashtag-performance")
 def hashtag_performance():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=id,caption,like_count,comments_count&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    
-    hashtag_stats = defaultdict(lambda: {"likes": 0, "comments": 0})
-    
-    for post in response.get("data", []):
-        caption = post.get("caption", "")
-        hashtags = [tag.strip("#") for tag in caption.split() if tag.startswith("#")]
-        for tag in hashtags:
-            hashtag_stats[tag]["likes"] += post.get("like_count", 0)
-            hashtag_stats[tag]["comments"] += post.get("comments_count", 0)
-    
-    return jsonify(hashtag_stats)
-
-# --- 4. Followers Activity (new vs returning) ---
-# Note: Instagram API doesn't provide this directly; this is a placeholder
+    return render_panel("hashtag_performance")
+
 @app.route("/api/follower-activity")
 def follower_activity():
-    # You may need to maintain previous followers data to calculate new vs returning
-    return jsonify({"new_followers": 2, "returning_followers": 1})
+    return render_panel("follower_activity")
 
-# --- 5. Bio/Link Clicks ---
 @app.route("/api/link-clicks")
 def link_clicks():
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=website_clicks&period=day&access_token={ACCESS_TOKEN}"
-    response = requests.get(url)
-    return jsonify(response.json())
+    return render_panel("link_clicks")
+
+# --------------------------------------------------
+# Export engine
+# --------------------------------------------------
+# Rows come from generators and leave as encoded chunks, so memory stays
+# flat whatever the account size. The same writer feeds both the
+# streamed /api/export-data response and background export jobs.
+EXPORT_DIR = os.getenv("EXPORT_DIR", "static/exports")
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_INSIGHT_METRICS = "reach,impressions,follower_count"
+EXPORT_INSIGHT_WINDOW_DAYS = 30  # longest range Graph accepts for period=day
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+# dataset -> [(column, pyarrow type name)]
+EXPORT_COLUMNS = {
+    "media": [
+        ("id", "string"), ("caption", "string"), ("media_type", "string"), ("media_url", "string"),
+        ("posted_at", "timestamp"), ("like_count", "int64"), ("comments_count", "int64"),
+    ],
+    "insights": [("date", "timestamp"), ("metric", "string"), ("value", "int64")],
+}
+
+export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+
+def iter_media_rows(account_id, since=None, until=None):
+    """ig_media rows through a server-side cursor, EXPORT_CHUNK_ROWS at a time"""
+    if not ensure_media_synced(account_id):
+        raise MediaSyncPending()
+    with db_connection() as conn:
+        cur = conn.cursor(name=f"export_media_{py_uuid.uuid4().hex}")
+        cur.itersize = EXPORT_CHUNK_ROWS
+        try:
+            cur.execute(
+                """
+                SELECT id, caption, media_type, media_url, posted_at, like_count, comments_count
+                FROM ig_media
+                WHERE account_id=%s AND (%s::timestamptz IS NULL OR posted_at >= %s)
+                  AND (%s::timestamptz IS NULL OR posted_at < %s)
+                ORDER BY posted_at DESC
+                """,
+                (account_id, since, since, until, until),
+            )
+            for row in cur:
+                yield row
+        finally:
+            cur.close()
+
+def iter_insight_rows(account_id, since=None, until=None):
+    """Daily account insights, one Graph window at a time"""
+    until = until or datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    since = since or until - timedelta(days=EXPORT_INSIGHT_WINDOW_DAYS)
+    window_start = since
+    while window_start < until:
+        window_end = min(window_start + timedelta(days=EXPORT_INSIGHT_WINDOW_DAYS), until)
+        res = graph_get(
+            account_id, f"{account_id}/insights", metric=EXPORT_INSIGHT_METRICS, period="day",
+            since=int(window_start.timestamp()), until=int(window_end.timestamp()),
+        )
+        if "error" in res:
+            raise GraphAPIError(res["error"])
+        for metric in res.get("data", []):
+            for value in metric.get("values", []):
+                yield (datetime.strptime(value["end_time"], IG_TIMESTAMP_FORMAT), metric.get("name"), value.get("value") or 0)
+        window_start = window_end
+
+EXPORT_SOURCES = {"media": iter_media_rows, "insights": iter_insight_rows}
+
+def _chunked(rows, size=EXPORT_CHUNK_ROWS):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+class _DrainableSink(io.RawIOBase):
+    """Write-only stream that hands back what was written since the last drain()"""
+    def __init__(self):
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data, self._parts = b"".join(self._parts), []
+        return data
+
+def encode_export(dataset, fmt, rows):
+    """Yield encoded byte chunks of rows in the given format"""
+    columns = [name for name, _ in EXPORT_COLUMNS[dataset]]
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        for chunk in _chunked(rows):
+            writer.writerows([_export_value(v) for v in row] for row in chunk)
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+        if buf.tell():
+            yield buf.getvalue().encode("utf-8")
+    elif fmt == "ndjson":
+        for chunk in _chunked(rows):
+            yield "".join(
+                json.dumps(dict(zip(columns, map(_export_value, row))), ensure_ascii=False) + "\n" for row in chunk
+            ).encode("utf-8")
+    elif fmt == "parquet":
+        if pq is None:
+            raise ValueError("parquet unavailable: pyarrow is not installed on this server")
+        types = {"string": pa.string(), "int64": pa.int64(), "timestamp": pa.timestamp("us", tz="UTC")}
+        schema = pa.schema([(name, types[kind]) for name, kind in EXPORT_COLUMNS[dataset]])
+        sink = _DrainableSink()
+        writer = pq.ParquetWriter(sink, schema)
+        try:
+            # One row group per chunk, flushed out as soon as it's written
+            for chunk in _chunked(rows):
+                writer.write_table(pa.Table.from_pylist([dict(zip(columns, row)) for row in chunk], schema=schema))
+                yield sink.drain()
+        finally:
+            writer.close()
+        yield sink.drain()
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+
+def export_params_from(args):
+    """Validate dataset/format/since/until from a dict of strings; raises ValueError"""
+    dataset = args.get("dataset", "media")
+    fmt = args.get("format", "csv")
+    if dataset not in EXPORT_SOURCES:
+        raise ValueError(f"Unknown dataset: {dataset}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    if fmt == "parquet" and pq is None:
+        raise ValueError("parquet unavailable: pyarrow is not installed on this server")
+    bounds = {}
+    for name in ("since", "until"):
+        bounds[name] = None
+        if args.get(name):
+            dt = datetime.fromisoformat(args[name])
+            bounds[name] = dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    return dataset, fmt, bounds["since"], bounds["until"]
+
+def export_filename(dataset, fmt):
+    return f"instagram-{dataset}-{datetime.now():%Y-%m-%d}.{EXPORT_FORMATS[fmt][1]}"
 
 # --- 6. Export Data ---
 @app.route("/api/export-data")
 def export_data():
+    """
+    ?format=csv|ndjson|parquet&dataset=media|insights&since=&until= streams
+    the export with chunked transfer encoding. Without ?format the old
+    JSON summary is returned.
+    """
+    account_id = current_graph_account_id()
+    if not account_id:
+        return no_graph_account()
+    if request.args.get("format"):
+        try:
+            dataset, fmt, since, until = export_params_from(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if dataset == "media" and not ensure_media_synced(account_id):
+            return jsonify({"syncing": True}), 202
+        def chunks():
+            try:
+                yield from encode_export(dataset, fmt, EXPORT_SOURCES[dataset](account_id, since, until))
+            except Exception as e:
+                # Headers are already sent; all we can do is stop and log
+                logger.error(f"Export stream failed after partial output: {e}")
+
+        return Response(
+            stream_with_context(chunks()),
+            mimetype=EXPORT_FORMATS[fmt][0],
+            headers={"Content-Disposition": f'attachment; filename="{export_filename(dataset, fmt)}"'},
+        )
+
     # Example: combine followers, posts, engagement
-    analytics_url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}?fields=followers_count,media_count&access_token={ACCESS_TOKEN}"
-    posts_url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=id,caption,like_count,comments_count&access_token={ACCESS_TOKEN}"
-    analytics_data = requests.get(analytics_url).json()
-    posts_data = requests.get(posts_url).json()
+    results, errors = graph_fanout({
+        "analytics": lambda: graph_get(account_id, account_id, fields="followers_count,media_count"),
+        "snapshot": lambda: get_media_snapshot(account_id),
+    })
+    analytics_data = results.get("analytics") or {"error": errors.get("analytics")}
+    snapshot = results.get("snapshot")
+    if snapshot is not None and snapshot.syncing:
+        posts_data = {"syncing": True}
+    elif snapshot is None or snapshot.error:
+        posts_data = {"error": snapshot.error if snapshot else errors.get("snapshot")}
+    else:
+        posts_data = {"data": snapshot.records("id,caption,like_count,comments_count")}
     return jsonify({"analytics": analytics_data, "posts": posts_data})
 
-# --- 7. Alerts for big changes --
+def _run_export_job(job_id, account_id, dataset, fmt, since, until):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    artifact = f"{job_id}.{EXPORT_FORMATS[fmt][1]}"
+    path = os.path.join(EXPORT_DIR, artifact)
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("UPDATE export_jobs SET status='running' WHERE id=%s", (job_id,))
+            conn.commit()
 
-@app.route("/api/alerts")
-def alerts():
-    alerts_list = []
-    return jsonify(alerts_list)
+        row_count = [0]
+        def counted(rows):
+            for row in rows:
+                row_count[0] += 1
+                yield row
 
-'''
-@app.route("/api/alerts")
-def alerts():
-    alerts_list = []
-
-    # 1️⃣ Follower Changes
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=follower_count&period=day&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    follower_values = response.get("data", [])[0].get("values", []) if response.get("data") else []
-    if len(follower_values) >= 2:
-        today = follower_values[-1]["value"]
-        yesterday = follower_values[-2]["value"]
-        change = today - yesterday
-        if abs(change) >= 10:
-            msg = f"Followers {'increased' if change > 0 else 'decreased'} by {abs(change)} today."
-            alerts_list.append({
-                "type": "followers",
-                "metric": "Followers",
-                "change": change,
-                "message": msg,
-                "date": datetime.now().isoformat()
-            })
+        with open(f"{path}.tmp", "wb") as f:
+            for chunk in encode_export(dataset, fmt, counted(EXPORT_SOURCES[dataset](account_id, since, until))):
+                f.write(chunk)
+        os.replace(f"{path}.tmp", path)
 
-    # 2️⃣ Profile Views
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=profile_views&period=day&metric_type=total_value&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    pv_values = response.get("data", [])[0].get("values", []) if response.get("data") else []
-    if len(pv_values) >= 2:
-        today = pv_values[-1]["value"]
-        yesterday = pv_values[-2]["value"]
-        percent_change = ((today - yesterday) / yesterday * 100) if yesterday else 0
-        if abs(percent_change) >= 30:
-            msg = f"Profile views {'increased' if percent_change > 0 else 'dropped'} {abs(int(percent_change))}% compared to yesterday."
-            alerts_list.append({
-                "type": "profile_views",
-                "metric": "Profile Views",
-                "change": percent_change,
-                "message": msg,
-                "date": datetime.now().isoformat()
-            })
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                UPDATE export_jobs SET status='completed', artifact=%s, row_count=%s, byte_size=%s,
+                       completed_at=CURRENT_TIMESTAMP
+                WHERE id=%s
+                """,
+                (artifact, row_count[0], os.path.getsize(path), job_id),
+            )
+            conn.commit()
+        logger.info(f"[Export] Job {job_id} completed: {row_count[0]} rows")
+    except Exception as e:
+        logger.error(f"[Export] Job {job_id} failed: {e}")
+        if os.path.exists(f"{path}.tmp"):
+            os.remove(f"{path}.tmp")
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE export_jobs SET status='failed', error_message=%s, completed_at=CURRENT_TIMESTAMP WHERE id=%s",
+                (str(e), job_id),
+            )
+            conn.commit()
 
-    # 3️⃣ Post Reach / Impressions
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=reach,impressions&period=day&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    for metric in response.get("data", []):
-        values = metric.get("values", [])
-        if len(values) >= 2:
-            today = values[-1]["value"]
-            avg = sum(v["value"] for v in values[:-1]) / max(len(values)-1, 1)
-            if today > 2 * avg:
-                msg = f"Your last post {metric['name']} reached {int(today/avg)}x more people than average."
-                alerts_list.append({
-                    "type": metric["name"],
-                    "metric": metric["name"].capitalize(),
-                    "change": today-avg,
-                    "message": msg,
-                    "date": datetime.now().isoformat()
-                })
+def _export_job_payload(row):
+    job_id, dataset, fmt, status, row_count, byte_size, error, created_at, completed_at = row
+    payload = {
+        "job_id": job_id,
+        "dataset": dataset,
+        "format": fmt,
+        "status": status,
+        "row_count": row_count,
+        "byte_size": byte_size,
+        "created_at": created_at.isoformat() if created_at else None,
+        "completed_at": completed_at.isoformat() if completed_at else None,
+    }
+    if status == "completed":
+        payload["download_url"] = f"/api/exports/{job_id}/download"
+    elif status == "failed":
+        payload["error"] = error
+    return payload
+
+@app.route("/api/exports", methods=["POST"])
+def create_export_job():
+    """Run a large export in the background; poll GET /api/exports/<id> for the artifact"""
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    try:
+        dataset, fmt, since, until = export_params_from(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    account_id = current_graph_account_id()
+    if not account_id:
+        return no_graph_account()
+    if dataset == "media" and not ensure_media_synced(account_id):
+        return jsonify({"syncing": True}), 202
+
+    job_id = str(py_uuid.uuid4())
+    conn = get_db_connection(); cur = conn.cursor()
+    try:
+        cur.execute(
+            """
+            INSERT INTO export_jobs (id, user_id, account_id, dataset, format, since, until)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """,
+            (job_id, session["user_id"], account_id, dataset, fmt, since, until),
+        )
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Create export job error: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        cur.close(); conn.close()
 
-    # 4️⃣ Engagement Metrics (likes, comments)
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=like_count,comments_count&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    likes = [p.get("like_count", 0) for p in response.get("data", [])]
-    comments = [p.get("comments_count", 0) for p in response.get("data", [])]
-    if likes:
-        avg_likes = sum(likes) / len(likes)
-        last_likes = likes[-1]
-        if last_likes < 0.5 * avg_likes:
-            alerts_list.append({
-                "type": "likes",
-                "metric": "Likes",
-                "change": None,
-                "message": "Engagement rate dropped below 50% of average likes.",
-                "date": datetime.now().isoformat()
-            })
-    if comments:
-        avg_comments = sum(comments) / len(comments)
-        last_comments = comments[-1]
-        if last_comments < 0.5 * avg_comments:
-            alerts_list.append({
-                "type": "comments",
-                "metric": "Comments",
-                "change": None,
-                "message": "Engagement rate dropped below 50% of average comments.",
-                "date": datetime.now().isoformat()
-            })
+    export_executor.submit(_run_export_job, job_id, account_id, dataset, fmt, since, until)
+    return jsonify({"success": True, "job_id": job_id, "status": "queued"}), 202
+
+def _load_export_job(cur, job_id, user_id):
+    cur.execute(
+        """
+        SELECT id, dataset, format, status, row_count, byte_size, error_message, created_at, completed_at
+        FROM export_jobs WHERE id=%s AND user_id=%s
+        """,
+        (job_id, user_id),
+    )
+    return cur.fetchone()
+
+@app.route("/api/exports/<job_id>", methods=["GET"])
+def get_export_job(job_id):
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    conn = get_db_connection(); cur = conn.cursor()
+    try:
+        row = _load_export_job(cur, job_id, session["user_id"])
+        if not row:
+            return jsonify({"error": "Export not found"}), 404
+        return jsonify({"success": True, **_export_job_payload(row)})
+    finally:
+        cur.close(); conn.close()
 
-    # 5️⃣ Story Views / Completion
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/stories?fields=insights.metric(story_insights)&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    for story in response.get("data", []):
-        insights = story.get("insights", {}).get("data", [])
-        for metric in insights:
-            if metric["name"] == "exits":
-                value = metric["values"][0]["value"]
-                if value > 50:
-                    alerts_list.append({
-                        "type": "story",
-                        "metric": "Story Exits",
-                        "change": value,
-                        "message": f"Story exit rate is high ({value}%).",
-                        "date": datetime.now().isoformat()
-                    })
-
-    # 6️⃣ Hashtag Performance
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/media?fields=caption,like_count,comments_count&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    hashtag_counts = {}
-    for post in response.get("data", []):
-        caption = post.get("caption", "")
-        hashtags = [word for word in caption.split() if word.startswith("#")]
-        for tag in hashtags:
-            hashtag_counts[tag] = hashtag_counts.get(tag, 0) + post.get("like_count", 0) + post.get("comments_count", 0)
-    trending_hashtags = [tag for tag, score in hashtag_counts.items() if score > 10]
-    for tag in trending_hashtags:
-        alerts_list.append({
-            "type": "hashtag",
-            "metric": "Hashtag",
-            "change": None,
-            "message": f"Hashtag {tag} is trending!",
-            "date": datetime.now().isoformat()
-        })
+@app.route("/api/exports/<job_id>/download", methods=["GET"])
+def download_export(job_id):
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    conn = get_db_connection(); cur = conn.cursor()
+    try:
+        cur.execute("SELECT dataset, format, artifact FROM export_jobs WHERE id=%s AND user_id=%s AND status='completed'",
+                    (job_id, session["user_id"]))
+        row = cur.fetchone()
+    finally:
+        cur.close(); conn.close()
+    if not row or not os.path.exists(os.path.join(EXPORT_DIR, row[2])):
+        return jsonify({"error": "Export not found"}), 404
+    dataset, fmt, artifact = row
+    return send_file(os.path.join(EXPORT_DIR, artifact), mimetype=EXPORT_FORMATS[fmt][0],
+                     as_attachment=True, download_name=export_filename(dataset, fmt))
 
-    # 7️⃣ Custom Thresholds
-    if len(follower_values) >= 2:
-        if follower_values[-2]["value"] - follower_values[-1]["value"] > 10:
-            alerts_list.append({
-                "type": "custom",
-                "metric": "Followers",
-                "change": follower_values[-2]["value"] - follower_values[-1]["value"],
-                "message": "Daily followers dropped >10.",
-                "date": datetime.now().isoformat()
-            })
+# --- 7. Alerts for big changes --
 
-    # 8️⃣ Time-Sensitive Alerts (weekly summary)
-    url = f"https://graph.facebook.com/v23.0/{IG_BUSINESS_ID}/insights?metric=reach&period=week&access_token={ACCESS_TOKEN}"
-    response = requests.get(url).json()
-    values = response.get("data", [])[0].get("values", []) if response.get("data") else []
-    if len(values) >= 2:
-        last_week = values[-2]["value"]
-        this_week = values[-1]["value"]
-        if last_week:
-            change = ((this_week - last_week) / last_week) * 100
-            alerts_list.append({
-                "type": "summary",
-                "metric": "Reach",
-                "change": change,
-                "message": f"This week, total reach changed by {int(change)}% compared to last week.",
-                "date": datetime.now().isoformat()
-            })
+@app.route("/api/alerts")
+def alerts():
+    return render_panel("alerts")
 
-    return jsonify(alerts_list) '''
+@app.route("/api/alerts/stream")
+def stream_alerts():
+    """
+    Server-sent `alert` events as they fire. A reconnecting EventSource
+    sends Last-Event-ID and first receives the alerts it missed.
+    """
+    try:
+        last_id = int(request.headers.get("Last-Event-ID") or request.args.get("after_id") or 0)
+    except ValueError:
+        return jsonify({"error": "Invalid Last-Event-ID"}), 400
+    account_id = current_graph_account_id()
+    if not account_id:
+        return no_graph_account()
+    subscriber = alert_broadcaster.subscribe(account_id)  # before the backlog read, so nothing falls in between
+
+    def events():
+        sent = last_id
+        try:
+            pending = list(reversed(recent_alerts(account_id, ALERT_STREAM_BACKLOG, last_id))) if last_id else []
+            yield "retry: 5000\n\n"
+            while True:
+                for alert in pending:
+                    if alert["id"] > sent:
+                        sent = alert["id"]
+                        yield f"id: {alert['id']}\nevent: alert\ndata: {json.dumps(alert)}\n\n"
+                try:
+                    pending = [subscriber.get(timeout=ALERT_STREAM_HEARTBEAT)]
+                except queue.Empty:
+                    pending = []
+                    yield ": keep-alive\n\n"
+        finally:
+            alert_broadcaster.unsubscribe(subscriber)
+
+    return Response(
+        stream_with_context(events()), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # --- 8. Post Comparison ---
@@ -1751,12 +5905,30 @@ def compare_posts():
     post_ids = request.args.get("ids")  # comma-separated IDs
     if not post_ids:
         return jsonify({"error": "Provide post IDs as ?ids=id1,id2"}), 400
-    ids = post_ids.split(",")
+    account_id = current_graph_account_id()
+    if not account_id:
+        return no_graph_account()
+    ids = list(dict.fromkeys(pid.strip() for pid in post_ids.split(",") if pid.strip()))
+    fields = "id,like_count,comments_count,insights.metric(reach,impressions)"
+
+    # One ?ids= lookup per batch of ids, batches in parallel
+    batches = [ids[i:i + GRAPH_IDS_BATCH] for i in range(0, len(ids), GRAPH_IDS_BATCH)]
+    results, errors = graph_fanout({
+        i: (lambda batch=batch: graph_get(account_id, "", ids=",".join(batch), fields=fields))
+        for i, batch in enumerate(batches)
+    })
     comparison = {}
-    for pid in ids:
-        url = f"https://graph.facebook.com/v23.0/{pid}?fields=id,like_count,comments_count,insights.metric(reach,impressions)&access_token={ACCESS_TOKEN}"
-        comparison[pid] = requests.get(url).json()
-    return jsonify(comparison)
+    for batch_results in results.values():
+        comparison.update(batch_results)
+
+    # A single bad id fails the whole ?ids= lookup; retry those batches per id
+    retry_ids = [pid for i in errors for pid in batches[i]]
+    if retry_ids:
+        results, errors = graph_fanout({pid: (lambda pid=pid: graph_get(account_id, pid, fields=fields)) for pid in retry_ids})
+        comparison.update(results)
+        for pid, error in errors.items():
+            comparison[pid] = {"error": error}
+    return jsonify({pid: comparison.get(pid, {"error": "not returned"}) for pid in ids})
 
 @app.route('/create-order', methods=['POST'])
 def create_order():
@@ -1795,6 +5967,36 @@ def verify_payment():
         return jsonify({'status': 'Payment verification failed'}), 400
 
 
+# --------------------------------------------------
+# Hot queries (see explain_audit)
+# --------------------------------------------------
+# (name, sql, sample params, index or indexes any of which will do). The SQL
+# is the same constant the code runs, so the audit can't drift from it.
+_AUDIT_TIME = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+HOT_QUERIES = [
+    ("verify_user_owns_file", OWNS_FILE_SQL, (0, ""), "idx_activities_user_image"),
+    ("get_history",
+     *history_query(0, {"cursor": encode_history_cursor(_AUDIT_TIME, 0)})[:2], "idx_activities_user_created_id"),
+    # Per-user search may walk the user's rows instead of the full-text index
+    ("search_history",
+     *history_query(0, {"q": "x"})[:2], ("idx_activities_search", "idx_activities_user_created_id")),
+    ("get_scheduled_posts", SCHEDULED_POSTS_SQL, (0,), "idx_scheduled_posts_user_time"),
+    ("dispatcher_resync", DISPATCHER_RESYNC_SQL, (), "idx_scheduled_posts_due"),
+    ("claim_scheduled_post", CLAIM_SCHEDULED_POST_SQL,
+     ("", _AUDIT_TIME, SCHEDULER_LEASE_SECONDS, 0, _AUDIT_TIME), "scheduled_posts_pkey"),
+    ("reap_expired_leases", REAP_EXPIRED_LEASES_SQL,
+     (SCHEDULER_MAX_ATTEMPTS, SCHEDULER_MAX_ATTEMPTS, _AUDIT_TIME), "idx_scheduled_posts_leases"),
+    ("metric_series", METRIC_SERIES_SQL,
+     (COUNTER_METRICS, "", "day", "", ["reach"], "day", _AUDIT_TIME, _AUDIT_TIME), "metric_rollups_pkey"),
+    ("recent_alerts", RECENT_ALERTS_SQL, ("", 0, 50), "idx_alerts_account_id"),
+    ("graph_token", GRAPH_TOKEN_SQL, ("",), "idx_users_graph_account"),
+    ("account_sync_claim", ACCOUNT_SYNC_CLAIM_SQL, ("", ACCOUNT_SYNC_LEASE_SECONDS, 10), "idx_graph_sync_due"),
+    ("recover_stale_generation_jobs", RECOVER_GENERATION_JOBS_SQL,
+     (GENERATION_HEARTBEAT_TIMEOUT, ""), "idx_generation_jobs_pending"),
+]
+
+
 if __name__ == "__main__":
     # Initialize database
     init_db()
@@ -0,0 +1,53 @@
+"""
+Shared fixtures. app1 reads its configuration at import time, so the
+environment is filled in before the first test imports it.
+"""
+import os
+import sys
+import uuid
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("ENCRYPTION_KEY", "ZXhwbGFpbi1hdWRpdC10ZXN0LWtleS0wMDAwMDAwMDA=")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+
+@pytest.fixture
+def app1(tmp_path_factory):
+    # Function-scoped so a test's skip conditions are checked before the import;
+    # the module itself is only imported once. It creates static/ directories
+    # relative to the working directory.
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    try:
+        import app1 as module
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+@pytest.fixture
+def pg_conn():
+    """
+    A connection to a brand-new database, dropped afterwards. Needs
+    TEST_DATABASE_URL pointing at a server the user may CREATE DATABASE on.
+    """
+    dsn = os.getenv("TEST_DATABASE_URL")
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    import psycopg2
+
+    name = f"app1_test_{uuid.uuid4().hex[:12]}"
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    admin.cursor().execute(f"CREATE DATABASE {name}")
+    conn = psycopg2.connect(dsn, dbname=name)
+    try:
+        yield conn
+    finally:
+        conn.close()
+        admin.cursor().execute(f"DROP DATABASE IF EXISTS {name}")
+        admin.close()
@@ -0,0 +1,15 @@
+"""Every hot query must still be servable by its index once all migrations are applied."""
+
+
+def test_migrations_apply_to_an_empty_database(pg_conn, app1):
+    applied = app1.migrate(pg_conn)
+    assert applied == [version for version, _, _ in app1.MIGRATIONS]
+    assert app1.migrate(pg_conn) == []
+
+
+def test_hot_queries_use_their_indexes(pg_conn, app1):
+    app1.migrate(pg_conn)
+    failures = app1.explain_audit(pg_conn)
+    assert failures == [], "\n".join(
+        f"{name}: expected {index}, plan uses {used or 'no index'}" for name, index, used in failures
+    )
@@ -0,0 +1,76 @@
+"""
+S3BlobStore against an S3-compatible store: moto's in-process S3 by default,
+or a real endpoint such as a local MinIO when TEST_S3_ENDPOINT_URL is set
+(credentials then come from the usual AWS_* variables).
+"""
+import contextlib
+import hashlib
+import os
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def s3_bucket(request, monkeypatch):
+    boto3 = pytest.importorskip("boto3")
+    endpoint = os.getenv("TEST_S3_ENDPOINT_URL")
+    if endpoint:
+        backend = contextlib.nullcontext()
+    else:
+        moto = pytest.importorskip("moto")
+        monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+        monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        backend = moto.mock_aws() if hasattr(moto, "mock_aws") else moto.mock_s3()
+    bucket = f"app1-test-{uuid.uuid4().hex[:12]}"
+    with backend:
+        s3 = boto3.client("s3", endpoint_url=endpoint)
+        s3.create_bucket(Bucket=bucket)
+        yield s3, bucket, endpoint
+        for obj in s3.list_objects_v2(Bucket=bucket).get("Contents", []):
+            s3.delete_object(Bucket=bucket, Key=obj["Key"])
+        s3.delete_bucket(Bucket=bucket)
+
+
+@pytest.fixture
+def make_store(s3_bucket, app1, tmp_path):
+    _, bucket, endpoint = s3_bucket
+
+    def make(cache="cache"):
+        return app1.S3BlobStore(bucket, endpoint, prefix="images/", cache_dir=str(tmp_path / cache))
+    return make
+
+
+def blob(data):
+    return hashlib.sha256(data).hexdigest() + ".png", data
+
+
+def test_put_uploads_once_and_deduplicates(make_store, s3_bucket):
+    s3, bucket, _ = s3_bucket
+    store = make_store()
+    key, data = blob(b"\x89PNG first image")
+
+    assert store.put(key, data) is True
+    assert store.put(key, data) is False
+    assert store.exists(key)
+    keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket=bucket)["Contents"]]
+    assert keys == [f"images/{key[:2]}/{key[2:4]}/{key}"]
+
+
+def test_get_downloads_into_a_cold_cache(make_store):
+    key, data = blob(b"\x89PNG second image")
+    make_store("writer").put(key, data)
+
+    reader = make_store("reader")
+    path = reader.local_path(key)
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert reader.local_path(key) == path  # served from the cache the second time
+
+
+def test_missing_blob(make_store):
+    store = make_store()
+    key, _ = blob(b"never stored")
+    assert not store.exists(key)
+    assert store.local_path(key) is None
@@ -29,6 +29,27 @@ interface LinkClicks {
   }>;
 }
 
+function generateAlertMessage(metric: string, change: number): string {
+  const changeText = Math.abs(change).toFixed(2) + (metric.includes('rate') ? '%' : '');
+  if (change > 0) {
+    return `✅ ${metric.replace('_', ' ')} increased by ${changeText} compared to last period.`;
+  } else if (change < 0) {
+    return `⚠️ ${metric.replace('_', ' ')} decreased by ${changeText} compared to last period.`;
+  } else {
+    return `ℹ️ ${metric.replace('_', ' ')} did not change.`;
+  }
+}
+
+// Map an alert from /api/alerts (or the SSE stream) to the panel's shape
+function toAlert(alert: any): Alert {
+  return {
+    ...alert,
+    id: String(alert.id),
+    type: alert.priority === 'high' ? 'danger' : alert.change > 0 ? 'success' : 'warning',
+    message: alert.message || generateAlertMessage(alert.metric, alert.change)
+  };
+}
+
 export default function AlertsPanel() {
   const [alerts, setAlerts] = useState<Alert[]>([]);
   const [linkClicks, setLinkClicks] = useState<LinkClicks>({ data: [] });
@@ -86,8 +107,8 @@ export default function AlertsPanel() {
 
         
         const [alertsRes, linkClicksRes] = await Promise.all([
-          fetch("http://localhost:5000/api/alerts"),
-          fetch("http://localhost:5000/api/link-clicks")
+          fetch("http://localhost:5000/api/alerts", { credentials: "include" }),
+          fetch("http://localhost:5000/api/link-clicks", { credentials: "include" })
         ]);
 
         const [alertsData, linkClicksData] = await Promise.all([
@@ -95,27 +116,7 @@ export default function AlertsPanel() {
           linkClicksRes.json()
         ]);
 
-        // Add this function at the top, before useEffect
-        function generateAlertMessage(metric: string, change: number): string {
-          const changeText = Math.abs(change).toFixed(2) + (metric.includes('rate') ? '%' : '');
-          if (change > 0) {
-            return `✅ ${metric.replace('_', ' ')} increased by ${changeText} compared to last period.`;
-          } else if (change < 0) {
-            return `⚠️ ${metric.replace('_', ' ')} decreased by ${changeText} compared to last period.`;
-          } else {
-            return `ℹ️ ${metric.replace('_', ' ')} did not change.`;
-          }
-        }
-
-        // Transform alerts data to include proper messaging
-        const transformedAlerts = alertsData.map((alert: any) => ({
-          ...alert,
-          id: Math.random().toString(36).substr(2, 9),
-          type: alert.change > 0 ? 'success' : 'warning',
-          message: generateAlertMessage(alert.metric, alert.change)
-        }));
-
-        setAlerts(transformedAlerts);
+        setAlerts(alertsData.map(toAlert));
         setLinkClicks(linkClicksData);
         
 
@@ -129,6 +130,17 @@ export default function AlertsPanel() {
     fetchData();
   }, []);
 
+  // New alerts are pushed as they fire; EventSource reconnects on its own
+  useEffect(() => {
+    if (typeof EventSource === "undefined") return;
+    const source = new EventSource("http://localhost:5000/api/alerts/stream", { withCredentials: true });
+    source.addEventListener("alert", (event) => {
+      const alert = toAlert(JSON.parse((event as MessageEvent).data));
+      setAlerts(prev => prev.some(a => a.id === alert.id) ? prev : [alert, ...prev]);
+    });
+    return () => source.close();
+  }, []);
+
   const dismissAlert = (alertId: string) => {
     setAlerts(prev => prev.map(alert => 
       alert.id === alertId ? { ...alert, dismissed: true } : alert
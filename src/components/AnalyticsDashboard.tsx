@@ -129,6 +129,14 @@ interface HashtagStats {
   };
 }
 
+// Fetch several panels in one round-trip; see /api/dashboard in the backend
+async function fetchDashboard(panels: string[]): Promise<Record<string, any>> {
+  const res = await fetch(`http://localhost:5000/api/dashboard?panels=${panels.join(",")}`, { credentials: "include" });
+  if (!res.ok) throw new Error(`Dashboard request failed: ${res.status}`);
+  const body = await res.json();
+  return body.panels;
+}
+
 // Navigation Component
 function Navigation({ activeTab, setActiveTab }: { activeTab: string; setActiveTab: (tab: string) => void }) {
   const [profile, setProfile] = useState<ProfileData | null>(null);
@@ -329,20 +337,9 @@ function EngagementAnalytics() {
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const [insightsRes, postsRes] = await Promise.all([
-          fetch("http://localhost:5000/api/insights", { credentials: "include" }),
-          fetch("http://localhost:5000/api/posts", { credentials: "include" })
-        ]);
-
-        if (insightsRes.ok) {
-          const insightsData = await insightsRes.json();
-          setInsights(insightsData);
-        }
-
-        if (postsRes.ok) {
-          const postsData = await postsRes.json();
-          setPosts(postsData.data || []);
-        }
+        const panels = await fetchDashboard(["insights", "posts"]);
+        if (panels.insights) setInsights(panels.insights);
+        if (panels.posts) setPosts(panels.posts.data || []);
       } catch (error) {
         console.error("Error fetching engagement data:", error);
       } finally {
@@ -677,18 +674,9 @@ function AudienceAnalytics() {
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const [faRes, demoRes] = await Promise.all([
-          fetch("http://localhost:5000/api/follower-activity", { credentials: "include" }),
-          fetch("http://localhost:5000/api/audience-demographics", { credentials: "include" })
-        ]);
-        if (faRes.ok) {
-          const data = await faRes.json();
-          setFollowerActivity(data);
-        }
-        if (demoRes.ok) {
-          const demoData = await demoRes.json();
-          setDemographics(demoData);
-        }
+        const panels = await fetchDashboard(["follower_activity", "audience_demographics"]);
+        if (panels.follower_activity) setFollowerActivity(panels.follower_activity);
+        if (panels.audience_demographics) setDemographics(panels.audience_demographics);
       } catch (error) {
         console.error("Error fetching audience data:", error);
       } finally {
@@ -845,20 +833,9 @@ function ContentAnalytics() {
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const [postsRes, hashtagRes] = await Promise.all([
-          fetch("http://localhost:5000/api/posts", { credentials: "include" }),
-          fetch("http://localhost:5000/api/hashtag-performance", { credentials: "include" })
-        ]);
-
-        if (postsRes.ok) {
-          const postsData = await postsRes.json();
-          setPosts(postsData.data || []);
-        }
-
-        if (hashtagRes.ok) {
-          const hashtagData = await hashtagRes.json();
-          setHashtagStats(hashtagData);
-        }
+        const panels = await fetchDashboard(["posts", "hashtag_performance"]);
+        if (panels.posts) setPosts(panels.posts.data || []);
+        if (panels.hashtag_performance) setHashtagStats(panels.hashtag_performance);
       } catch (error) {
         console.error("Error fetching content data:", error);
       } finally {
@@ -1117,63 +1094,27 @@ export default function InstagramAnalyticsDashboard() {
         setLoading(true);
         setError(null);
 
-        const [
-          analyticsRes,
-          postsRes,
-          profileRes,
-          insightsRes,
-          followerActivityRes,
-          linkClicksRes,
-          alertsRes,
-          hashtagRes,
-          profileViewsRes
-        ] = await Promise.all([
-          fetch("http://localhost:5000/api/analytics", { credentials: "include" }),
-          fetch("http://localhost:5000/api/posts", { credentials: "include" }),
-          fetch("http://localhost:5000/api/profile", { credentials: "include" }),
-          fetch("http://localhost:5000/api/insights", { credentials: "include" }),
-          fetch("http://localhost:5000/api/follower-activity", { credentials: "include" }),
-          fetch("http://localhost:5000/api/link-clicks", { credentials: "include" }),
-          fetch("http://localhost:5000/api/alerts", { credentials: "include" }),
-          fetch("http://localhost:5000/api/hashtag-performance", { credentials: "include" }),
-          fetch("http://localhost:5000/api/profile-views", { credentials: "include" })
-        ]);
-
-        const responses = [analyticsRes, postsRes, profileRes, insightsRes, followerActivityRes, linkClicksRes, alertsRes, hashtagRes];
-        const failedRequests = responses.filter(res => !res.ok);
-        if (failedRequests.length > 0) throw new Error(`Failed to fetch ${failedRequests.length} endpoints`);
-
-        const [
-          analyticsData,
-          postsData,
-          profileData,
-          insightsData,
-          followerActivityData,
-          linkClicksData,
-          alertsData,
-          hashtagData,
-          profileViewsData
-        ] = await Promise.all([
-          analyticsRes.json(),
-          postsRes.json(),
-          profileRes.json(),
-          insightsRes.json(),
-          followerActivityRes.json(),
-          linkClicksRes.json(),
-          alertsRes.json(),
-          hashtagRes.json(),
-          profileViewsRes.json()
+        const panels = await fetchDashboard([
+          "analytics",
+          "posts",
+          "profile",
+          "insights",
+          "follower_activity",
+          "link_clicks",
+          "alerts",
+          "hashtag_performance",
+          "profile_views"
         ]);
 
-        setAnalytics(analyticsData);
-        setPosts(postsData.data || []);
-        setProfile(profileData);
-        setInsights(insightsData);
-        setFollowerActivity(followerActivityData);
-        setLinkClicks(linkClicksData);
-        setAlerts(alertsData || []);
-        setHashtagStats(hashtagData);
-        setProfileViewsData(profileViewsData);
+        setAnalytics(panels.analytics || null);
+        setPosts(panels.posts?.data || []);
+        setProfile(panels.profile || null);
+        setInsights(panels.insights || null);
+        setFollowerActivity(panels.follower_activity || null);
+        setLinkClicks(panels.link_clicks || null);
+        setAlerts(panels.alerts || []);
+        setHashtagStats(panels.hashtag_performance || null);
+        if (panels.profile_views) setProfileViewsData(panels.profile_views);
       } catch (error) {
         console.error("Error fetching data:", error);
         setError("Failed to fetch analytics data. Check your API connection.");
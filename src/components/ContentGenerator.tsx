@@ -36,6 +36,9 @@ const ContentGenerator: React.FC<ContentGeneratorProps> = ({ onScheduleClick })
   const [generatedContent, setGeneratedContent] = useState('');
   const [generatedImage, setGeneratedImage] = useState('');
   const [filename, setFilename] = useState('');
+  // Bumped on every successful generation: the image store is content
+  // addressed, so regenerating an identical image returns the same filename
+  const [imageVersion, setImageVersion] = useState(0);
   const [isGenerating, setIsGenerating] = useState(false);
   const [showUpgradeModal, setShowUpgradeModal] = useState(false);
   const [isAuthenticated, setIsAuthenticated] = useState(false);
@@ -69,12 +72,12 @@ const ContentGenerator: React.FC<ContentGeneratorProps> = ({ onScheduleClick })
     // Don't load image from localStorage - we'll fetch it properly
   }, []);
 
-  // Fetch image when filename changes
+  // Fetch image when filename changes or a new generation completes
   useEffect(() => {
     if (filename) {
       fetchImage(filename);
     }
-  }, [filename]);
+  }, [filename, imageVersion]);
 
   useEffect(() => {
     const checkAuth = async () => {
@@ -199,26 +202,18 @@ const ContentGenerator: React.FC<ContentGeneratorProps> = ({ onScheduleClick })
       
       const data = await res.json();
 
-      if (data.success && data.caption && data.image) {
-        // Cleanup previous blob URL
+      if (data.success && data.caption && data.filename) {
+        // Show the inline placeholder; the image effect fetches
+        // the full image through the cached get-image endpoint
         if (blobUrlRef.current) {
           URL.revokeObjectURL(blobUrlRef.current);
+          blobUrlRef.current = '';
         }
         
-        // Convert base64 to blob
-        const byteCharacters = atob(data.image);
-        const byteNumbers = new Array(byteCharacters.length);
-        for (let i = 0; i < byteCharacters.length; i++) {
-          byteNumbers[i] = byteCharacters.charCodeAt(i);
-        }
-        const byteArray = new Uint8Array(byteNumbers);
-        const blob = new Blob([byteArray], { type: 'image/png' });
-        const imageUrl = URL.createObjectURL(blob);
-        blobUrlRef.current = imageUrl;
-        
         setGeneratedContent(data.caption);
-        setGeneratedImage(imageUrl);
+        setGeneratedImage(data.placeholder || '');
         setFilename(data.filename);
+        setImageVersion((v) => v + 1);
         
         // Save to localStorage
         localStorage.setItem('lastGeneratedContent', data.caption);
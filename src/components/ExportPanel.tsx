@@ -21,6 +21,8 @@ interface ExportOption {
   format: string;
   size: string;
   color: string;
+  // Backed by the streaming export engine (/api/export-data)
+  dataset?: 'media' | 'insights';
 }
 
 export default function ExportPanel() {
@@ -44,7 +46,8 @@ export default function ExportPanel() {
       icon: <Image className="w-5 h-5" />,
       format: 'CSV',
       size: '854 KB',
-      color: 'chart-secondary'
+      color: 'chart-secondary',
+      dataset: 'media'
     },
     {
       id: 'audience-insights',
@@ -60,9 +63,10 @@ export default function ExportPanel() {
       title: 'Growth Trends Report',
       description: 'Follower growth, reach trends and engagement rate over time',
       icon: <TrendingUp className="w-5 h-5" />,
-      format: 'PDF',
+      format: 'CSV',
       size: '1.7 MB',
-      color: 'chart-accent'
+      color: 'chart-accent',
+      dataset: 'insights'
     },
     {
       id: 'hashtag-analysis',
@@ -85,6 +89,18 @@ export default function ExportPanel() {
   ];
 
   const handleExport = async (optionId: string) => {
+    const option = exportOptions.find(o => o.id === optionId);
+    if (option?.dataset) {
+      // Let the browser stream the file straight to disk instead of buffering a blob
+      const a = document.createElement('a');
+      a.href = `http://localhost:5000/api/export-data?dataset=${option.dataset}&format=${option.format.toLowerCase()}`;
+      document.body.appendChild(a);
+      a.click();
+      document.body.removeChild(a);
+      setExported(prev => [...prev, optionId]);
+      return;
+    }
+
     setExporting(optionId);
     
     // Simulate export process
@@ -518,7 +518,7 @@ const PostScheduler: React.FC<PostSchedulerProps> = ({ initialContent }) => {
                     {post.image_filename && (
                       <div className="mb-3">
                         <img
-                          src={`${API}/api/get-image?filename=${encodeURIComponent(post.image_filename)}`}
+                          src={`${API}/api/get-image?filename=${encodeURIComponent(post.image_filename)}&variant=thumb`}
                           alt="Scheduled post"
                           className="w-full rounded border max-h-[150px] object-contain"
                         />